@@ -3,18 +3,67 @@ import os
 import time
 import hashlib
 import zipfile
-from threading import Thread
+import zlib
+from threading import Thread, BoundedSemaphore, Condition, Lock, get_ident, local
+from collections import OrderedDict, deque
+from contextlib import contextmanager, nullcontext, redirect_stdout
+from concurrent.futures import Future, ThreadPoolExecutor
+import json
+import queue
+import errno
+import struct
+import bisect
+import fnmatch
+import select
 import configparser
-import shutil
-import msvcrt
+import tempfile
 import sys
+import io
+import random
+import tracemalloc
+try:
+    import bz2
+except ImportError:  # 部分自行编译的 Python 缺少 bz2 / lzma 模块，对应的传输压缩算法不可用
+    bz2 = None
+try:
+    import lzma
+except ImportError:
+    lzma = None
 
 CONFIG_DIR = os.path.join(os.path.expanduser("~"), "ipv4files")
 SERVER_CONFIG_PATH = os.path.join(CONFIG_DIR, "server_config.ini")
 CLIENT_CONFIG_PATH = os.path.join(CONFIG_DIR, "client_config.ini")
+DIGEST_CACHE_PATH = os.path.join(CONFIG_DIR, "digest_cache.json")
+ARCHIVE_CACHE_DIR = os.path.join(CONFIG_DIR, "archive_cache")
+HASH_TREE_CACHE_DIR = os.path.join(CONFIG_DIR, "hash_tree_cache")
 
 buf_size = 4096
 chunk_size = 1024
+file_block_size = 1024 * 1024  # 非零拷贝发送时每次读取文件的块大小
+data_frame_size = 1024 * 1024  # 分帧协议中单个 DATA 帧的最大负载
+DOWNLOAD_JOURNAL_SUFFIX = '.ipv4part'  # 未完成下载的日志文件后缀（与下载文件放在一起）
+JOURNAL_SAVE_INTERVAL = 1.0    # 下载日志的更新间隔（秒）
+SEGMENT_MIN_SIZE = 32 * 1024 * 1024  # 自动分段时每段的最小大小
+SEGMENT_RETRIES = 3            # 单个分段失败后的最多尝试次数
+SEGMENT_PIECE_SIZE = 8 * 1024 * 1024  # 分段下载中单次区间请求的大小，也是分段下载续传的粒度
+DELTA_MIN_BLOCK = 2 * 1024     # 增量传输的块大小范围
+DELTA_MAX_BLOCK = 128 * 1024
+DELTA_TEMP_SUFFIX = '.ipv4delta'  # 增量重建新版本时的临时文件后缀
+DELTA_SCAN_LIMIT = 256 * 1024  # 连续这么多字节没有匹配后，改为按块跳跃搜索
+DELTA_SCAN_EVERY = 8           # 跳跃搜索时每隔多少块逐字节搜索一块
+CHUNK_REPAIR_RETRIES = 3       # 校验失败的块最多重新请求的轮数
+BATCH_INLINE_LIMIT = 1024 * 1024  # 批量下载中不超过该大小的文件整块收进内存，交给写盘线程池
+BATCH_WRITE_QUEUE = 64         # 批量下载中已收下、等待写盘的小文件数上限
+TUNE_WINDOW = 0.5              # 自动调优每轮测量吞吐量的时长（秒）
+TUNE_ROUNDS = 4                # 每个连接最多调整的轮数，即只在最初几秒的传输中调整
+TUNE_IDLE_GAP = 0.2            # 两次收发的间隔超过该秒数时重新开始本轮测量
+TUNE_MIN_BYTES = 256 * 1024    # 一轮测量中收发少于该字节数时（只有列表等零星的小消息）不作数
+TUNE_BLOCK_SECONDS = 0.01      # 自动选择的读写块约为链路这么多秒的传输量
+TUNE_BLOCK_RANGE = (64 * 1024, 4 * 1024 * 1024)  # 自动选择的读写块大小范围
+TCP_INFO_RTT_OFFSET = 68       # Linux struct tcp_info 中 tcpi_rtt（微秒）的偏移
+SWARM_SERVER_SLOTS = 2         # 对等分发时每个客户端同时向服务端请求的块数上限
+SWARM_PEER_SLOTS = 2           # 对等分发时向同一个节点同时请求的块数上限
+SWARM_PEER_TIMEOUT = 30        # 对等节点连接的套接字超时（秒）
 
 
 def print_progress_bar(percent):
@@ -27,47 +76,609 @@ def print_progress_bar(percent):
 
 
 
+# ---------------- 分帧协议 ----------------
+# 握手：服务端连接后先发送旧协议的文件列表（见 send_legacy_greeting），客户端发送 PROTOCOL_MAGIC + 支持的最高版本号(1字节)，
+# 服务端回复同样格式的协商版本。
+# 之后双方收发帧：[类型 1字节][请求ID 4字节][负载长度 4字节][负载]，控制消息的负载为 UTF-8 JSON。
+PROTOCOL_MAGIC = b'IV4F'
+PROTOCOL_VERSION = 3  # v2：LIST 支持分页、过滤并返回条目元数据；v3：支持 BATCH
+FRAME_HEADER = struct.Struct('!BII')
+MAX_FRAME_PAYLOAD = 64 * 1024 * 1024
+
+MSG_LIST = 1    # 请求：{"path", "offset", "limit", "prefix", "glob"} 均可选 /
+                # 响应：{"path", "total", "offset", "entries": [{"name", "type", "size", "mtime_ns"}]}（v1 只有名称列表）
+MSG_GET = 2     # 请求：{"name": 名称, 可选区间 "offset"/"length", 可选 "hash_algorithms": 按优先级排列的哈希树算法,
+                #       可选 "compression": 按优先级排列的传输压缩算法, "compression_level"}
+MSG_META = 3    # 响应：{"name", "mode": "FILE"/"ZIP", "size": 字节数或 null(流式), FILE 另有 "mtime_ns"/"offset"/"length",
+                #       协商了传输压缩时有 "compression": 选定的算法}
+MSG_DATA = 4    # 响应：原始数据
+MSG_DIGEST = 5  # 响应：{"sha1": 整个文件的摘要, "range_sha1": 区间摘要}，表示一次传输结束
+MSG_ERROR = 6   # 响应：{"message": ...}
+MSG_BYE = 7     # 请求：结束会话
+MSG_STAT = 8    # 请求：{"name"} / 响应：META 帧 {"name", "mode", "size", "mtime_ns", "sha1": 已缓存的摘要或 null}
+MSG_DELTA = 9   # 请求：{"name", "block_size", "size": 本地旧版本大小}，紧跟一个内容为块签名的 DATA 帧
+MSG_COPY = 10   # 响应：复用客户端旧版本中的块（负载见 DELTA_COPY）
+MSG_MANIFEST = 11  # 请求：{"name": 文件夹} / 响应：{"name", "entries": [{"path": 相对路径, "size", "mtime_ns", "sha1"}]}
+MSG_ZDATA = 12  # 响应：压缩的数据块（负载见 ZDATA_HEADER，只在 META 中带有 "compression" 时出现）
+MSG_BATCH = 13  # 请求：{"names": [名称...], 其余同 GET（不含区间）} / 响应：依次为每一项发送 GET 的响应，META 和 ERROR 带 "index"
+MSG_SWARM = 14  # 请求：{"name", "port": 本端对等服务的端口, "have": 已有块的位图(十六进制), 首次登记带 "hash_algorithms"，
+                #       之后带 "root"，离开时 "leave": true} /
+                # 响应：{"name", "peers": [{"address", "have"}], "served": 服务端已发出的块的位图}，
+                #       首次登记另有 "size"、"mtime_ns"、"tree"（哈希树）
+MSG_CHUNK = 15  # 请求：{"name", "offset", "length", "root", "unserved_only"}（对等节点之间也用它取块）/ 响应：一个 DATA 帧
+
+
+class ProtocolError(Exception):
+    """对端发送了不符合协议的数据"""
+
+
+class RequestError(Exception):
+    """请求无法完成（文件不存在、路径越界等），以 ERROR 帧告知对端，会话继续"""
+
+
+# 处理单个请求时只影响该请求的错误：字段缺失或类型不对（TypeError/AttributeError）也在其中
+REQUEST_ERRORS = (RequestError, OSError, ValueError, KeyError, TypeError, AttributeError)
+
+
+class FramedConnection:
+    """带接收缓冲的分帧连接，服务端和客户端共用（role 为 server 或 client，用于指标的标签）"""
+    def __init__(self, sock, role='client'):
+        self.sock = sock
+        self.role = role
+        self.version = PROTOCOL_VERSION
+        self.recv_buffer = bytearray()
+        # 服务端：当前请求是否已经开始发送响应（开始后出错只能断开连接）
+        self.response_started = False
+        # 服务端：传输压缩的自适应状态（含链路速度的测量），同一连接上的传输沿用
+        self.transport_compressor = None
+        # 套接字的自动调优状态（SocketTuner），收发数据时交给它测量吞吐量
+        self.tuner = None
+
+    def send_frame(self, msg_type, request_id, payload=b''):
+        self.sock.sendall(FRAME_HEADER.pack(msg_type, request_id, len(payload)) + payload)
+
+    def send_json(self, msg_type, request_id, body):
+        self.send_frame(msg_type, request_id, json.dumps(body, ensure_ascii=False).encode('utf-8'))
+
+    def recv_exact(self, length):
+        """读取恰好 length 字节；连接在读到任何数据之前关闭时返回 None"""
+        while len(self.recv_buffer) < length:
+            packet = self.sock.recv(max(length - len(self.recv_buffer), buf_size))
+            if not packet:
+                if self.recv_buffer:
+                    raise ConnectionError('连接在消息中途断开')
+                return None
+            self.recv_buffer += packet
+            metrics.inc('bytes_received_total', len(packet), role=self.role)
+            if self.tuner is not None:
+                self.tuner.observe(len(packet))
+        data = bytes(self.recv_buffer[:length])
+        del self.recv_buffer[:length]
+        return data
+
+    def recv_into(self, view):
+        """把接下来的 len(view) 字节直接读入 view（先取接收缓冲中已有的数据）"""
+        received = min(len(self.recv_buffer), len(view))
+        if received:
+            view[:received] = self.recv_buffer[:received]
+            del self.recv_buffer[:received]
+        while received < len(view):
+            n = self.sock.recv_into(view[received:])
+            if not n:
+                raise ConnectionError('连接在数据传输中途断开')
+            received += n
+            metrics.inc('bytes_received_total', n, role=self.role)
+            if self.tuner is not None:
+                self.tuner.observe(n)
+
+    def recv_frame_header(self):
+        """读取帧头，返回 (类型, 请求ID, 负载长度)；连接正常关闭时返回 None"""
+        header = self.recv_exact(FRAME_HEADER.size)
+        if header is None:
+            return None
+        msg_type, request_id, length = FRAME_HEADER.unpack(header)
+        if length > MAX_FRAME_PAYLOAD:
+            raise ProtocolError('帧过大: ' + str(length))
+        return msg_type, request_id, length
+
+    def recv_frame(self):
+        """读取整帧，返回 (类型, 请求ID, 负载)；连接正常关闭时返回 None"""
+        header = self.recv_frame_header()
+        if header is None:
+            return None
+        msg_type, request_id, length = header
+        payload = self.recv_exact(length) if length else b''
+        if payload is None:
+            raise ConnectionError('连接在消息中途断开')
+        return msg_type, request_id, payload
+
+
+# ---------------- 套接字调优 ----------------
+# 建立连接时按配置设置 TCP_NODELAY 和收发缓冲区。缓冲区或读写块为 auto 时，由 SocketTuner 在连接最初几秒的传输中
+# 测量往返时间和吞吐量：缓冲区小于带宽时延积的两倍时放大（窗口不够时吞吐量只有 缓冲区 / RTT）；
+# 读写块取链路约 TUNE_BLOCK_SECONDS 秒的传输量，慢速链路上块小，限速和进度更平滑，快速链路上块大，系统调用更少。
+def configure_socket(sock, options, connected=False):
+    """
+    按配置（server_options 或 client_options）设置监听套接字或新连接：
+    tcp_nodelay 关闭 Nagle 算法，控制消息和小文件不必等对方的延迟确认；
+    socket_buffer_kb 为固定值时设置收发缓冲区（须在连接建立前设置才能协商足够大的窗口），auto 或 0 时保留系统的自动调整。
+    connected 为 True 表示已建立的连接（服务端 accept 得到的套接字），只设置 tcp_nodelay，缓冲区已从监听套接字继承。
+    """
+    if options["tcp_nodelay"].lower() == 'true':
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    buffer_kb = options["socket_buffer_kb"].lower()
+    if not connected and buffer_kb != 'auto' and int(buffer_kb) > 0:
+        for option in (socket.SO_SNDBUF, socket.SO_RCVBUF):
+            sock.setsockopt(socket.SOL_SOCKET, option, int(buffer_kb) * 1024)
+
+
+def block_option_size(value):
+    """读写块配置项的字节数，auto 时为自动调优的初始值"""
+    return data_frame_size if value.lower() == 'auto' else max(64, int(value)) * 1024
+
+
+def kernel_rtt(sock):
+    """从 TCP_INFO 读出内核平滑后的往返时间（秒），不支持的平台返回 None"""
+    if not sys.platform.startswith('linux') or not hasattr(socket, 'TCP_INFO'):
+        return None
+    try:
+        info = sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_INFO, 128)
+    except OSError:
+        return None
+    if len(info) < TCP_INFO_RTT_OFFSET + 4:
+        return None
+    return struct.unpack_from('I', info, TCP_INFO_RTT_OFFSET)[0] / 1000000 or None
+
+
+class SocketTuner:
+    """
+    连接的自动调优状态，随 FramedConnection 创建，收发数据时调用 observe。
+    只按测得的吞吐量调整读写块的大小；连接建立后不再设置 SO_SNDBUF/SO_RCVBUF：
+    在已建立的连接上设置会关闭系统对该连接缓冲区的自动调整，并被限制在 rmem_max/wmem_max 之内，
+    固定的缓冲区大小由 configure_socket 在连接建立前设置。
+    往返时间取内核 TCP_INFO 和应用层测得的值中较大者（经过代理或隧道时内核只看得到到代理这一段），只用于日志和指标。
+    """
+    def __init__(self, sock, options, block_option, log_prefix):
+        self.sock = sock
+        self.block_option = block_option
+        self.log_prefix = log_prefix
+        self.auto_block = options[block_option].lower() == 'auto'
+        self.block_size = block_option_size(options[block_option])
+        self.rtt = kernel_rtt(sock)
+        self.rate = None
+        # 块大小不自动调整时无需测量
+        self.rounds = 0 if self.auto_block else TUNE_ROUNDS
+        self.window_start = None
+        self.window_bytes = 0
+        self.last_time = None
+
+    def note_rtt(self, rtt):
+        """记录应用层测得的往返时间（客户端的握手耗时，或客户端在请求中告知服务端的值）"""
+        if rtt and (self.rtt is None or rtt > self.rtt):
+            self.rtt = rtt
+
+    def observe(self, size):
+        """记录一次收发的字节数，每测满 TUNE_WINDOW 秒调整一次"""
+        if self.rounds >= TUNE_ROUNDS:
+            return
+        now = time.perf_counter()
+        if self.last_time is None or now - self.last_time > TUNE_IDLE_GAP:
+            # 之前链路空闲过，从这次收发结束时开始计时
+            self.window_start = now
+            self.window_bytes = 0
+        else:
+            self.window_bytes += size
+        self.last_time = now
+        if now - self.window_start >= TUNE_WINDOW:
+            if self.window_bytes >= TUNE_MIN_BYTES:
+                self.rate = self.window_bytes / (now - self.window_start)
+                self.rounds += 1
+                self.adjust()
+            self.window_start = now
+            self.window_bytes = 0
+
+    def adjust(self):
+        block = TUNE_BLOCK_RANGE[0]
+        while block < self.rate * TUNE_BLOCK_SECONDS and block < TUNE_BLOCK_RANGE[1]:
+            block *= 2
+        if block != self.block_size:
+            metrics.inc('socket_tuning_total', option=self.block_option)
+            print('{}Socket tuning: RTT {} ms, {:.2f} MB/s, block {} -> {}'.format(
+                self.log_prefix, '{:.1f}'.format(self.rtt * 1000) if self.rtt else '?',
+                self.rate / 1024 / 1024, format_size(self.block_size), format_size(block)))
+            self.block_size = block
+
+
+class DownloadProgress:
+    """下载进度显示，最多每 progress_interval 秒刷新一次，避免刷新进度本身拖慢接收"""
+    def __init__(self, total_size=None, start_size=0, prefix='下载进度'):
+        self.total_size = total_size
+        self.start_size = start_size
+        self.prefix = prefix
+        self.start_time = time.time()
+        self.interval = float(client_options["progress_interval"])
+        self.last_time = 0
+
+    def update(self, received_size, force=False):
+        now = time.time()
+        if not force and now - self.last_time < self.interval:
+            return
+        self.last_time = now
+        elapsed_time = now - self.start_time
+        download_speed = (received_size - self.start_size) / elapsed_time / 1024 if elapsed_time > 0 else 0
+        if self.total_size:
+            progress = int(received_size / self.total_size * 100)
+            print('\r{}：{}% 下载速度：{:.2f} KB/s    {}'.format(
+                self.prefix, progress, download_speed, print_progress_bar(progress)), end='')
+        else:
+            print('\r已接收：{:.2f} KB 下载速度：{:.2f} KB/s'.format(received_size / 1024, download_speed), end='')
+
+
+def recv_buffer_size(tuner=None):
+    """客户端每次接收使用的缓冲区大小，有连接的调优器时取它当前选择的块大小"""
+    if tuner is not None:
+        return tuner.block_size
+    return block_option_size(client_options["recv_buffer_kb"])
+
+
+def preallocate_file(file, size):
+    """从当前位置起为下载文件预先分配到 size 字节，减少碎片并尽早发现磁盘空间不足（不支持时忽略）"""
+    if not size or not hasattr(os, 'posix_fallocate'):
+        return
+    file.flush()
+    position = file.tell()
+    if size <= position:
+        return
+    try:
+        os.posix_fallocate(file.fileno(), position, size - position)
+    except OSError as e:
+        if e.errno == errno.ENOSPC:
+            raise
+        # 文件系统不支持预分配
+
+
+class PipelinedFileWriter:
+    """
+    下载的磁盘阶段：接收线程把收满的缓冲区放入队列，写盘线程按顺序写入文件并同时计算摘要。
+    写完的缓冲区回到空闲队列复用，磁盘短暂变慢时接收线程还能继续收满其余空闲缓冲区，不会立即停止读套接字。
+    """
+    def __init__(self, file, hasher=None, start_size=0, buffer_size=None):
+        self.file = file
+        self.hasher = hasher
+        self.written_size = start_size
+        self.error = None
+        self.free_buffers = queue.Queue()
+        for _ in range(max(2, int(client_options["write_queue_depth"]))):
+            self.free_buffers.put(bytearray(buffer_size or recv_buffer_size()))
+        self.filled_buffers = queue.Queue()
+        self.closed = False
+        self.thread = Thread(target=self._write_loop, daemon=True)
+        self.thread.start()
+
+    def get_buffer(self, size=None):
+        """
+        取一块空闲缓冲区，全部都在等待写盘时阻塞；写盘出错后抛出该错误。
+        size 大于取到的缓冲区时换成新的缓冲区（自动调优放大了读写块），写完后留在空闲队列中复用。
+        """
+        if self.error is not None:
+            raise self.error
+        buffer = self.free_buffers.get()
+        if size is not None and len(buffer) < size:
+            buffer = bytearray(size)
+        return buffer
+
+    def submit(self, buffer, length):
+        self.filled_buffers.put((buffer, length))
+
+    def wait(self):
+        """等待已提交的数据全部写完"""
+        self.filled_buffers.join()
+
+    def close(self):
+        """写完剩余数据并结束写盘线程（可重复调用）"""
+        if not self.closed:
+            self.closed = True
+            self.filled_buffers.put(None)
+            self.thread.join()
+
+    def finish(self):
+        self.close()
+        if self.error is not None:
+            raise self.error
+
+    def _write_loop(self):
+        while True:
+            item = self.filled_buffers.get()
+            try:
+                if item is None:
+                    return
+                buffer, length = item
+                if self.error is None:
+                    try:
+                        view = memoryview(buffer)[:length]
+                        self.file.write(view)
+                        if self.hasher is not None:
+                            self.hasher.update(view)
+                        self.written_size += length
+                    except Exception as e:
+                        # 之后提交的数据全部丢弃，由接收线程在下次取缓冲区时抛出
+                        self.error = e
+                self.free_buffers.put(buffer)
+            finally:
+                self.filled_buffers.task_done()
+
+
 class FileDownloadThread(Thread):
-    def __init__(self, client_socket, file_name, file_size, download_folder):
+    def __init__(self, client_socket, file_name, file_size, download_folder, extract_folder=None):
         super(FileDownloadThread, self).__init__()
         self.client_socket = client_socket
         self.file_name = file_name
         self.file_size = file_size
         self.download_folder = download_folder
+        # 不为 None 时接收的是 ZIP 流，边接收边解压到该文件夹，不保存压缩包
+        self.extract_folder = extract_folder
+        # 边接收边计算的 SHA-1，下载完成后无需重新读取文件
+        self.received_sha1 = None
+
+    def open_output(self, file_path):
+        """打开接收数据的输出：普通文件，或边接收边解压的 ZipStreamExtractor"""
+        if self.extract_folder is not None:
+            return ZipStreamExtractor(self.extract_folder)
+        return open(file_path, 'wb')
 
     def run(self):
         file_path = os.path.join(self.download_folder, self.file_name)
         received_size = 0
-        start_time = time.time()
+        progress = DownloadProgress(self.file_size)
         sha1_hash = hashlib.sha1()
 
-        with open(file_path, 'wb') as file:
-            while received_size < self.file_size:
-                remaining_size = self.file_size - received_size
-                read_size = min(chunk_size, remaining_size)
-                data = self.recv_all(self.client_socket, read_size)
-                received_size += len(data)
-                file.write(data)
-                sha1_hash.update(data)
-                progress = int(received_size / self.file_size * 100)
-                elapsed_time = time.time() - start_time
-
-                if elapsed_time > 0:
-                    download_speed = received_size / elapsed_time / 1024
-                    print('\r下载进度：{}% 下载速度：{:.2f} KB/s    {}'.format(progress, download_speed, print_progress_bar(progress)), end='')
-                else:
-                    print('\r下载进度：{}%'.format(progress), end='')
+        with self.open_output(file_path) as file:
+            if self.extract_folder is None:
+                preallocate_file(file, self.file_size)
+            # 本线程只负责 recv_into 到空闲缓冲区，写盘和计算摘要在写盘线程中进行
+            writer = PipelinedFileWriter(file, sha1_hash)
+            try:
+                while received_size < self.file_size:
+                    buffer = writer.get_buffer()
+                    read_size = min(len(buffer), self.file_size - received_size)
+                    self.recv_into_all(self.client_socket, memoryview(buffer)[:read_size])
+                    writer.submit(buffer, read_size)
+                    received_size += read_size
+                    progress.update(received_size)
+                writer.finish()
+            finally:
+                writer.close()
+            progress.update(received_size, force=True)
             print('下载完成！')
+        self.received_sha1 = sha1_hash.hexdigest()
 
     def recv_all(self, sock, length):
-        """接收指定长度的数据"""
-        data = b''
-        while len(data) < length:
-            packet = sock.recv(length - len(data))
-            if not packet:
+        """接收指定长度的数据；连接在读到任何数据前关闭时返回 None"""
+        data = bytearray(length)
+        view = memoryview(data)
+        received = 0
+        while received < length:
+            n = sock.recv_into(view[received:])
+            if not n:
+                if received:
+                    raise ConnectionError('连接在数据传输中途断开')
                 return None
-            data += packet
-        return data
+            received += n
+        return bytes(data)
+
+    def recv_into_all(self, sock, view):
+        """把接下来的 len(view) 字节直接读入 view"""
+        received = 0
+        while received < len(view):
+            n = sock.recv_into(view[received:])
+            if not n:
+                raise ConnectionError('连接在数据传输中途断开')
+            received += n
+
+
+class ChunkedDownloadThread(FileDownloadThread):
+    """接收 ChunkedStreamWriter 发送的分块流（总大小事先未知）"""
+    def __init__(self, client_socket, file_name, download_folder, extract_folder=None):
+        super(ChunkedDownloadThread, self).__init__(client_socket, file_name, None, download_folder, extract_folder)
+
+    def run(self):
+        file_path = os.path.join(self.download_folder, self.file_name)
+        received_size = 0
+        progress = DownloadProgress()
+        sha1_hash = hashlib.sha1()
+
+        with self.open_output(file_path) as file:
+            writer = PipelinedFileWriter(file, sha1_hash)
+            try:
+                while True:
+                    header = self.recv_all(self.client_socket, 4)
+                    if header is None:
+                        raise ConnectionError('连接在数据流结束前断开')
+                    length = struct.unpack('!I', header)[0]
+                    if length == 0:
+                        break
+                    while length:
+                        buffer = writer.get_buffer()
+                        read_size = min(len(buffer), length)
+                        self.recv_into_all(self.client_socket, memoryview(buffer)[:read_size])
+                        writer.submit(buffer, read_size)
+                        length -= read_size
+                        received_size += read_size
+                    progress.update(received_size)
+                writer.finish()
+            finally:
+                writer.close()
+            progress.update(received_size, force=True)
+            print('下载完成！')
+        self.received_sha1 = sha1_hash.hexdigest()
+
+
+class FramedDownloadThread(FileDownloadThread):
+    """分帧协议下接收一次 GET 的 DATA 帧，直到 DIGEST 帧；边写边计算 SHA-1"""
+    def __init__(self, connection, request_id, file_name, file_size, download_folder,
+                 offset=0, sha1_hash=None, journal=None, extract_folder=None, tree=None, compression=None):
+        super(FramedDownloadThread, self).__init__(connection.sock, file_name, file_size, download_folder,
+                                                   extract_folder)
+        self.connection = connection
+        self.request_id = request_id
+        # 续传时从 offset 处继续写入，sha1_hash 已包含本地前缀的数据
+        self.offset = offset
+        self.sha1_hash = sha1_hash or hashlib.sha1()
+        # 不为 None 时定期把已写入的位置和前缀摘要记录到下载日志，断线后可续传
+        self.journal = journal
+        # 服务端提供的哈希树，不为 None 时逐块校验，结果在 verifier 中
+        self.tree = tree
+        self.verifier = None
+        # 协商的传输压缩算法，不为 None 时数据可能以 ZDATA 帧到达
+        self.compression = compression
+        self.server_digest = None
+        self.writer = None
+        self.error = None
+
+    def run(self):
+        try:
+            self.receive()
+        except Exception as e:
+            # 异常交给调用方在 join 之后处理
+            self.error = e
+
+    def receive(self):
+        file_path = os.path.join(self.download_folder, self.file_name)
+        os.makedirs(os.path.dirname(file_path) or '.', exist_ok=True)
+        received_size = self.offset
+        progress = DownloadProgress(self.file_size, self.offset)
+        last_journal_time = time.time()
+
+        with (open(file_path, 'r+b') if self.offset else self.open_output(file_path)) as file:
+            hasher = self.sha1_hash
+            if self.extract_folder is None:
+                file.seek(self.offset)
+                file.truncate()
+                if self.tree is not None:
+                    # 续传点位于块中间时，该块的前半部分从本地文件读出
+                    prefix = b''
+                    if self.offset % self.tree["chunk_size"]:
+                        file.seek(self.offset - self.offset % self.tree["chunk_size"])
+                        prefix = file.read(self.offset % self.tree["chunk_size"])
+                    self.verifier = ChunkVerifier(self.tree, self.offset, prefix)
+                    hasher = HashTee(self.sha1_hash, self.verifier)
+                preallocate_file(file, self.file_size)
+            # 本线程只负责接收，写盘和计算摘要在写盘线程中进行
+            tuner = self.connection.tuner
+            buffer_size = recv_buffer_size(tuner)
+            if self.file_size is not None:
+                # 小文件不必分配整块的接收缓冲区
+                buffer_size = min(buffer_size, max(self.file_size - self.offset, 1))
+            writer = self.writer = PipelinedFileWriter(file, hasher, self.offset, buffer_size)
+            if self.journal is not None:
+                self.save_journal(file_path, file)
+            try:
+                while True:
+                    header = self.connection.recv_frame_header()
+                    if header is None:
+                        raise ConnectionError('连接在传输结束前断开')
+                    msg_type, request_id, length = header
+                    if request_id != self.request_id:
+                        raise ProtocolError('响应顺序错误')
+                    if msg_type == MSG_DIGEST:
+                        self.server_digest = json.loads(self.connection.recv_exact(length).decode('utf-8'))
+                        break
+                    if msg_type == MSG_ERROR:
+                        raise RequestError(json.loads(self.connection.recv_exact(length).decode('utf-8'))["message"])
+                    if msg_type == MSG_ZDATA and self.compression is not None:
+                        data = memoryview(decompress_block(self.compression, self.connection.recv_exact(length)))
+                        while data:
+                            buffer = writer.get_buffer()
+                            size = min(len(buffer), len(data))
+                            buffer[:size] = data[:size]
+                            writer.submit(buffer, size)
+                            data = data[size:]
+                            received_size += size
+                    elif msg_type == MSG_DATA:
+                        while length:
+                            block = recv_buffer_size(tuner)
+                            buffer = writer.get_buffer(block)
+                            read_size = min(block, length)
+                            self.connection.recv_into(memoryview(buffer)[:read_size])
+                            writer.submit(buffer, read_size)
+                            length -= read_size
+                            received_size += read_size
+                    else:
+                        raise ProtocolError('意外的消息类型: ' + str(msg_type))
+                    now = time.time()
+                    if self.journal is not None and now - last_journal_time >= JOURNAL_SAVE_INTERVAL:
+                        self.save_journal(file_path, file)
+                        last_journal_time = now
+                    progress.update(received_size)
+                writer.finish()
+                if self.verifier is not None:
+                    self.verifier.finish()
+            except BaseException:
+                # 断线时记录已完整写入的位置，下次从这里续传
+                writer.close()
+                if self.journal is not None:
+                    self.save_journal(file_path, file)
+                raise
+            progress.update(received_size, force=True)
+            print('下载完成！')
+        self.received_sha1 = self.sha1_hash.hexdigest()
+
+    def save_journal(self, file_path, file):
+        # 只记录写盘线程已经写完的部分，此时摘要也恰好覆盖这部分数据
+        self.writer.wait()
+        file.flush()
+        self.journal["offset"] = self.writer.written_size
+        self.journal["sha1_prefix"] = self.sha1_hash.copy().hexdigest()
+        save_download_journal(file_path, self.journal)
+
+
+def download_journal_path(file_path):
+    return file_path + DOWNLOAD_JOURNAL_SUFFIX
+
+
+def load_download_journal(file_path):
+    """读取未完成下载的日志，不存在或损坏时返回 None"""
+    try:
+        with open(download_journal_path(file_path), 'r', encoding='utf-8') as journal_file:
+            return json.load(journal_file)
+    except (OSError, ValueError):
+        return None
+
+
+def save_download_journal(file_path, journal):
+    temp_path = download_journal_path(file_path) + '.tmp'
+    with open(temp_path, 'w', encoding='utf-8') as journal_file:
+        json.dump(journal, journal_file)
+    os.replace(temp_path, download_journal_path(file_path))
+
+
+def remove_download_journal(file_path):
+    try:
+        os.remove(download_journal_path(file_path))
+    except OSError:
+        pass
+
+
+def verify_download_journal(file_path, journal):
+    """
+    重新计算本地已下载前缀的 SHA-1 并与日志中记录的比对。
+    输出:
+    - 一致时返回包含前缀数据的 hashlib 对象（续传时继续使用），否则返回 None
+    """
+    try:
+        if os.path.getsize(file_path) < journal["offset"]:
+            return None
+        sha1_hash = hashlib.sha1()
+        with open(file_path, 'rb') as file:
+            hash_file_region(file, 0, journal["offset"], sha1_hash)
+    except (OSError, KeyError):
+        return None
+    if sha1_hash.hexdigest() != journal.get("sha1_prefix"):
+        return None
+    return sha1_hash
+
+
+FILTER_INDEX_THRESHOLD = 5000  # 选项超过该数量时为筛选建立索引
 WHITE_ON_BLACK = '\033[30;47m'  # 黑字白底
 RESET = '\033[0m'  # 重置颜色
 
@@ -102,432 +713,4540 @@ def input_box_with_prompt(prompt="请输入内容:", confirm_text="确认", canc
                 print(f"  [ {confirm_text} ]   {WHITE_ON_BLACK}[{cancel_text}]{RESET}")
                 
             # 捕获键盘输入
-            key = msvcrt.getch()
+            key = read_key()
+
+            if key == 'enter':  # Enter 键
+                if selected_option == 0:  # 如果当前选项是“确认”
+                    if user_input.strip() == "":  # 如果输入内容为空
+                        break  # 重新输入
+                    else:
+                        return user_input  # 返回用户输入的内容
+                elif selected_option == 1:  # 如果当前选项是“取消”
+                    return False  # 返回 False
+
+            elif key == 'left':  # 左方向键
+                selected_option = (selected_option - 1) % 2
+            elif key == 'right':  # 右方向键
+                selected_option = (selected_option + 1) % 2
+            
+            elif key == 'backspace':  # 退格键
+                user_input = user_input[:-1]  # 删除最后一个字符
+                
+            elif len(key) == 1 and key.isprintable():
+                # 捕获用户输入的字符
+                user_input += key
+
+def show_progress_bar(progress, total, bar_length=40):
+    """
+    在控制台显示进度条。
+    输入:
+    - progress: 当前进度（整数）
+    - total: 总进度（整数）
+    - bar_length: 进度条长度（默认40）
+    输出:
+    - 动态更新的进度条显示
+    """
+    # 计算进度的百分比
+    percent = float(progress) / total
+    # 计算进度条中多少是满的
+    filled_length = int(bar_length * percent)
+    
+    # 生成进度条字符串
+    bar = '█' * filled_length + '-' * (bar_length - filled_length)
+    # 通过覆盖上一行输出，动态显示进度
+    sys.stdout.write(f'\r进度: |{bar}| {percent * 100:.1f}% 已完成')
+    sys.stdout.flush()
+
+    # 在进度完成时换行
+    if progress == total:
+        print()
+def render_options(input_type, array_size=None, options=None, prompt="选择一个选项", visible_rows=25,
+                   multi=False, selectable=None, selected=None):
+    """
+    输入:
+    - input_type: 1表示普通列表，2表示二维数组
+    - array_size: (rows, cols)，二维数组的大小 (仅当 input_type 为 2 时启用)
+    - options: 普通列表或二维数组
+    - text: 要显示的提示词
+    - visible_rows: 最多的显示行数 默认25
+    - multi: 普通列表是否允许多选（空格勾选当前项，Ctrl+A 勾选/取消全部筛选结果）
+    - selectable: 多选时只有前 selectable 个选项可以勾选（其余如翻页等操作项只能回车选择），None 表示全部
+    - selected: 多选时初始勾选的选项下标
+    输出:
+    - 选择的选项的下标（对于列表）或坐标（对于二维数组）；
+      多选时返回 (回车时所在选项的下标, 已勾选的下标列表)
+    只渲染可见的行；PgUp/PgDn 翻页，Home/End 跳到首尾。
+    普通列表可以直接输入文字筛选（不区分大小写的子串匹配），Backspace 删除，Esc 清除。
+    """
+    if input_type == 2:
+        return render_grid_options(array_size, options, prompt, visible_rows)
+    clear_console()
+    option_filter = OptionFilter(options)
+    query = ""
+    matches = None  # 筛选后的选项下标，None 表示未筛选
+    selected_row = 0
+    scroll_offset = 0  # 当前滚动的偏移量
+    selectable = len(options) if selectable is None else selectable
+    checked = set(selected or ())
+
+    while True:
+        count = len(options) if matches is None else len(matches)
+        selected_row = max(0, min(selected_row, count - 1))
+        if selected_row < scroll_offset:
+            scroll_offset = selected_row
+        elif selected_row >= scroll_offset + visible_rows:
+            scroll_offset = selected_row - visible_rows + 1
+        scroll_offset = max(0, min(scroll_offset, count - visible_rows))
+
+        # 只计算可见行的宽度并渲染可见行，光标回到左上角后整屏覆盖，避免闪烁
+        visible = range(scroll_offset, min(scroll_offset + visible_rows, count))
+        rows = [options[row if matches is None else matches[row]] for row in visible]
+        max_width = max((len(option) for option in rows), default=0) + (6 if multi else 2)
+        lines = ["\033[H\033[J" + prompt, ""]
+        for row, option in zip(visible, rows):
+            if multi:
+                index = row if matches is None else matches[row]
+                option = ("[x] " if index in checked else "[ ] " if index < selectable else "    ") + option
+            if row == selected_row:
+                lines.append(f"> {WHITE_ON_BLACK}{option.ljust(max_width)}{RESET}")  # 用白字黑底高亮当前选项
+            else:
+                lines.append(f"  {option.ljust(max_width)}")
+        if count == 0:
+            lines.append("  （没有匹配的选项）")
+        lines.append("")
+        if len(options) > visible_rows or query:
+            lines.append(f"筛选: {query}  [{count}/{len(options)}]  ↑↓选择 PgUp/PgDn翻页 Home/End首尾 Esc清除")
+        if multi:
+            lines.append(f"已选 {len(checked)} 项  空格勾选 Ctrl+A全选 回车确认")
+        sys.stdout.write("\n".join(lines) + "\n")
+        sys.stdout.flush()
+
+        # 捕获键盘输入
+        key = read_key()
+        if key == 'enter':
+            if count:
+                index = selected_row if matches is None else matches[selected_row]  # 选项在原列表中的下标
+                return (index, sorted(checked)) if multi else index
+        elif multi and key == ' ':
+            index = (selected_row if matches is None else matches[selected_row]) if count else selectable
+            if index < selectable:
+                checked.symmetric_difference_update({index})
+                selected_row += 1
+        elif multi and key == 'select_all':
+            shown = [index for index in (range(len(options)) if matches is None else matches) if index < selectable]
+            if all(index in checked for index in shown):
+                checked.difference_update(shown)
+            else:
+                checked.update(shown)
+        elif key == 'up':
+            selected_row -= 1
+        elif key == 'down':
+            selected_row += 1
+        elif key == 'pageup':
+            selected_row -= visible_rows
+        elif key == 'pagedown':
+            selected_row += visible_rows
+        elif key == 'home':
+            selected_row = 0
+        elif key == 'end':
+            selected_row = count - 1
+        elif key in ('backspace', 'escape') or (len(key) == 1 and key.isprintable()):
+            query = query[:-1] if key == 'backspace' else "" if key == 'escape' else query + key
+            matches = option_filter.matches(query)
+            selected_row = 0
+
+
+def render_grid_options(array_size, options, prompt, visible_rows):
+    """二维数组形式的选项，方向键在行列间移动"""
+    clear_console()
+    rows, cols = array_size
+    max_width = max(len(item) for row in options for item in row) + 2
+    selected_row = 0
+    selected_col = 0
+    scroll_offset = 0
+    while True:
+        lines = ["\033[H\033[J" + prompt, ""]
+        for row in range(scroll_offset, min(scroll_offset + visible_rows, rows)):
+            line = ""
+            for col in range(cols):
+                padded_option = options[row][col].ljust(max_width)  # 左对齐并按最大宽度填充
+                if row == selected_row and col == selected_col:
+                    line += f"  {WHITE_ON_BLACK}{padded_option}{RESET}"  # 用白字黑底高亮当前选项
+                else:
+                    line += f"  {padded_option}"
+            lines.append(line)
+        sys.stdout.write("\n".join(lines) + "\n")
+        sys.stdout.flush()
+
+        key = read_key()
+        if key == 'enter':
+            return (selected_row, selected_col)  # 返回二维数组坐标
+        elif key in ('up', 'pageup'):
+            selected_row = max(0, selected_row - (1 if key == 'up' else visible_rows))
+        elif key in ('down', 'pagedown'):
+            selected_row = min(rows - 1, selected_row + (1 if key == 'down' else visible_rows))
+        elif key == 'home':
+            selected_row = 0
+        elif key == 'end':
+            selected_row = rows - 1
+        elif key == 'left':
+            selected_col = (selected_col - 1) % cols
+        elif key == 'right':
+            selected_col = (selected_col + 1) % cols
+        if selected_row < scroll_offset:
+            scroll_offset = selected_row
+        elif selected_row >= scroll_offset + visible_rows:
+            scroll_offset = selected_row - visible_rows + 1
+
+
+class OptionFilter:
+    """
+    render_options 的增量筛选（不区分大小写的子串匹配）。
+    选项较多时在后台线程中建立单字符和双字符索引：一两个字符的查询直接查表，
+    更长的查询只在上一次结果和查询中最少见的双字符的候选项中较小的一方里比较，每次按键的开销与列表总长度无关。
+    """
+    def __init__(self, options):
+        self.keys = [option.lower() for option in options]
+        self.index = None  # 单字符/双字符 -> 包含它的选项下标列表
+        self.history = []  # [(查询, 匹配的下标列表)]，每一项的查询都是下一项的前缀
+        if len(self.keys) >= FILTER_INDEX_THRESHOLD:
+            Thread(target=self.build_index, daemon=True).start()
+
+    def build_index(self):
+        index = {}
+        for position, key in enumerate(self.keys):
+            for gram in set(key) | {key[i:i + 2] for i in range(len(key) - 1)}:
+                index.setdefault(gram, []).append(position)
+        self.index = index
+
+    def matches(self, query):
+        """返回匹配 query 的选项下标列表（保持原顺序）；query 为空时返回 None"""
+        query = query.lower()
+        while self.history and not query.startswith(self.history[-1][0]):
+            self.history.pop()
+        if not query:
+            return None
+        if self.history and self.history[-1][0] == query:
+            return self.history[-1][1]
+        index = self.index
+        if index is not None and len(query) <= 2:
+            result = index.get(query, [])
+        else:
+            # 更长的查询只会匹配上一次结果的子集；匹配项也一定包含查询中的每个双字符，取其中最少的候选项比较
+            candidates = self.history[-1][1] if self.history else range(len(self.keys))
+            if index is not None:
+                for gram in {query[i:i + 2] for i in range(len(query) - 1)}:
+                    gram_matches = index.get(gram, [])
+                    if len(gram_matches) < len(candidates):
+                        candidates = gram_matches
+            keys = self.keys
+            result = [position for position in candidates if query in keys[position]]
+        self.history.append((query, result))
+        return result
+
+
+# read_key 返回的特殊按键名称
+CONTROL_KEYS = {'\r': 'enter', '\n': 'enter', '\x08': 'backspace', '\x7f': 'backspace', '\x1b': 'escape',
+                '\x01': 'select_all'}
+WINDOWS_SPECIAL_KEYS = {'H': 'up', 'P': 'down', 'K': 'left', 'M': 'right',
+                        'I': 'pageup', 'Q': 'pagedown', 'G': 'home', 'O': 'end'}
+ANSI_KEY_SEQUENCES = {
+    b'[A': 'up', b'[B': 'down', b'[C': 'right', b'[D': 'left',
+    b'OA': 'up', b'OB': 'down', b'OC': 'right', b'OD': 'left',
+    b'[5~': 'pageup', b'[6~': 'pagedown',
+    b'[H': 'home', b'[F': 'end', b'OH': 'home', b'OF': 'end',
+    b'[1~': 'home', b'[4~': 'end', b'[7~': 'home', b'[8~': 'end',
+}
+
+
+def read_key():
+    """
+    读取一个按键，Windows 使用 msvcrt，其他平台临时把终端切换到原始模式。
+    输出:
+    - 'enter'、'up'、'down'、'left'、'right'、'pageup'、'pagedown'、'home'、'end'、'backspace'、'escape'、
+      'select_all'(Ctrl+A)，
+      其他按键返回输入的字符（无法识别的控制序列返回空字符串）
+    """
+    if os.name == 'nt':
+        import msvcrt
+        key = msvcrt.getwch()
+        if key in ('\x00', '\xe0'):  # 特殊按键（方向键等）
+            return WINDOWS_SPECIAL_KEYS.get(msvcrt.getwch(), '')
+    else:
+        import termios
+        import tty
+        fd = sys.stdin.fileno()
+        old_attributes = termios.tcgetattr(fd)
+        try:
+            tty.setraw(fd)
+            key = os.read(fd, 1)
+            if key == b'\x1b':
+                # 方向键等以 ESC 开头的序列；单独按下 ESC 时后面没有数据
+                sequence = b''
+                while select.select([fd], [], [], 0.03)[0]:
+                    sequence += os.read(fd, 1)
+                    if len(sequence) > 1 and (sequence[-1:].isalpha() or sequence[-1:] == b'~'):
+                        break
+                return ANSI_KEY_SEQUENCES.get(sequence, '') if sequence else 'escape'
+            if key and key[0] >= 0xc0:
+                # UTF-8 多字节字符（例如中文文件名）
+                key += os.read(fd, 1 if key[0] < 0xe0 else 2 if key[0] < 0xf0 else 3)
+            key = key.decode('utf-8', errors='ignore')
+        finally:
+            termios.tcsetattr(fd, termios.TCSADRAIN, old_attributes)
+    if key == '\x03':
+        # 原始模式下 Ctrl+C 不会产生信号
+        raise KeyboardInterrupt
+    return CONTROL_KEYS.get(key, key)
+
+
+# 已经是压缩格式的文件，再做 DEFLATE 只会浪费 CPU
+COMPRESSED_EXTENSIONS = {
+    '.zip', '.7z', '.rar', '.gz', '.tgz', '.bz2', '.xz', '.zst', '.lz4', '.cab',
+    '.jpg', '.jpeg', '.png', '.gif', '.webp', '.heic', '.avif',
+    '.mp3', '.aac', '.ogg', '.opus', '.flac', '.m4a',
+    '.mp4', '.mkv', '.avi', '.mov', '.webm', '.wmv', '.flv',
+    '.docx', '.xlsx', '.pptx', '.apk', '.jar', '.whl', '.msi',
+}
+COMPRESS_SAMPLE_SIZE = 64 * 1024     # 判断是否值得压缩时采样的字节数
+COMPRESS_SAMPLE_RATIO = 0.95         # 采样压缩后仍大于该比例则直接存储
+COMPRESS_PIECE_SIZE = 4 * 1024 * 1024  # 大文件切片并行压缩的片大小
+ZIP64_THRESHOLD = 0xF0000000         # 超过该大小的条目使用 ZIP64 字段
+
+
+def _gf2_matrix_times(matrix, vector):
+    result = 0
+    index = 0
+    while vector:
+        if vector & 1:
+            result ^= matrix[index]
+        vector >>= 1
+        index += 1
+    return result
+
+
+def _gf2_matrix_square(matrix):
+    return [_gf2_matrix_times(matrix, matrix[n]) for n in range(32)]
+
+
+def crc32_combine(crc1, crc2, length2):
+    """合并两段数据的 CRC32（与 zlib 的 crc32_combine 相同），用于拼接并行计算的分片 CRC"""
+    if length2 <= 0:
+        return crc1
+    odd = [0xEDB88320] + [1 << n for n in range(31)]
+    even = _gf2_matrix_square(odd)
+    odd = _gf2_matrix_square(even)
+    while True:
+        even = _gf2_matrix_square(odd)
+        if length2 & 1:
+            crc1 = _gf2_matrix_times(even, crc1)
+        length2 >>= 1
+        if not length2:
+            break
+        odd = _gf2_matrix_square(even)
+        if length2 & 1:
+            crc1 = _gf2_matrix_times(odd, crc1)
+        length2 >>= 1
+        if not length2:
+            break
+    return crc1 ^ crc2
+
+
+def is_worth_compressing(file_path, sample=None):
+    """根据扩展名和开头一段数据的试压缩结果判断文件是否值得 DEFLATE"""
+    if os.path.splitext(file_path)[1].lower() in COMPRESSED_EXTENSIONS:
+        return False
+    if sample is None:
+        with open(file_path, 'rb') as file:
+            sample = file.read(COMPRESS_SAMPLE_SIZE)
+    if not sample:
+        return False
+    sample = sample[:COMPRESS_SAMPLE_SIZE]
+    return len(zlib.compress(sample, 1)) < len(sample) * COMPRESS_SAMPLE_RATIO
+
+
+def compress_piece(file_path, offset, length, method, level, final):
+    """
+    压缩进程池中执行的任务：读取文件的一片并计算 CRC32，按需压缩。
+    输入:
+    - method: zipfile.ZIP_STORED / zipfile.ZIP_DEFLATED，或 None 表示根据内容自动选择（仅用于整文件一片的情况）
+    - final: 是否为文件的最后一片（最后一片以 Z_FINISH 结束，其余片以 Z_FULL_FLUSH 对齐，可直接首尾拼接）
+    输出:
+    - (压缩数据, CRC32, 原始长度, 实际使用的方法)；存储方式不返回数据，由调用方直接从文件发送
+    """
+    with open(file_path, 'rb') as file:
+        file.seek(offset)
+        data = file.read(length)
+    if method is None:
+        method = zipfile.ZIP_DEFLATED if level > 0 and is_worth_compressing(file_path, data) else zipfile.ZIP_STORED
+    crc = zlib.crc32(data)
+    if method == zipfile.ZIP_STORED:
+        return None, crc, len(data), method
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    compressed = compressor.compress(data) + compressor.flush(zlib.Z_FINISH if final else zlib.Z_FULL_FLUSH)
+    return compressed, crc, len(data), method
+
+
+compress_executor = None
+compress_executor_lock = Lock()
+
+def compress_worker_count():
+    return int(server_options["compress_workers"]) or (os.cpu_count() or 1)
+
+
+def importable_by_name():
+    """
+    子进程能否按模块名找到本模块的函数：进程池把任务函数按“模块名.函数名”传给子进程，
+    子进程（spawn 启动）重新导入该模块。直接运行本文件（__main__）或通过 ipv4files.py 导入时可以；
+    用 importlib 以其他名称加载时，即使登记到了 sys.modules，子进程也无法按该名称导入，这时只能使用线程池。
+    """
+    module = sys.modules.get(__name__)
+    if module is None or getattr(module, 'compress_piece', None) is not compress_piece:
+        return False
+    if __name__ == '__main__':
+        return True
+    from importlib.machinery import PathFinder
+    return PathFinder.find_spec(__name__.partition('.')[0]) is not None
+
+
+def get_compress_executor():
+    """获取（首次调用时创建）全局压缩进程池；无法创建进程池的环境退回线程池（zlib 压缩时会释放 GIL）"""
+    global compress_executor
+    with compress_executor_lock:
+        if compress_executor is None:
+            workers = compress_worker_count()
+            if os.name == 'nt':
+                workers = min(workers, 61)
+            try:
+                if not importable_by_name():
+                    raise ImportError(__name__ + ' 不能在子进程中按名称导入')
+                # 进程池和管理端口等只在用到时才导入，减少无交互模式的启动时间
+                import multiprocessing
+                from concurrent.futures import ProcessPoolExecutor
+                # 进程池在会话线程中创建：fork 出的子进程会继承已打开的客户端连接和监听套接字，
+                # 使连接在会话结束后仍不关闭，所以各平台都用 spawn 启动子进程
+                compress_executor = ProcessPoolExecutor(max_workers=workers,
+                                                        mp_context=multiprocessing.get_context('spawn'))
+            except (OSError, NotImplementedError, ImportError):
+                compress_executor = ThreadPoolExecutor(max_workers=workers)
+            print('[Main_Server_Output]Compress workers:' + str(workers))
+        return compress_executor
+
+
+class ZipEntryState:
+    """ParallelZipWriter 中单个条目的写入状态"""
+    def __init__(self, file_path, arc_name, file_stat):
+        self.file_path = file_path
+        self.arc_name = arc_name
+        self.file_stat = file_stat
+        self.method = None
+        self.crc = 0
+        self.raw_size = 0
+        self.compressed_size = 0
+        self.header_offset = 0
+        self.flags = 0x800 if not arc_name.isascii() else 0
+        self.zip64 = file_stat.st_size >= ZIP64_THRESHOLD
+
+
+class ParallelZipWriter:
+    """
+    按顺序写出标准 ZIP 流，条目的压缩工作分发到进程池并行完成。
+    - 每个文件按内容选择 STORED 或 DEFLATED；
+    - 大文件切片并行压缩，分片以 Z_FULL_FLUSH 对齐后直接拼接，CRC 通过 crc32_combine 合并；
+    - 只顺序写入 out，out 可以是不可 seek 的流（如 ChunkedStreamWriter）。
+    """
+    def __init__(self, out, level=6, executor=None, workers=1, piece_size=COMPRESS_PIECE_SIZE):
+        """workers: executor 的并行度，决定同时在途的分片数"""
+        self.out = out
+        self.level = level
+        self.executor = executor
+        self.piece_size = piece_size
+        self.position = 0
+        self.entries = []
+        # 同时在途的分片数，限制内存占用
+        self.window = 2 * max(1, workers)
+
+    def _write(self, data):
+        self.out.write(data)
+        self.position += len(data)
+
+    def _plan(self, entries):
+        """为每个条目生成压缩任务：(条目, 偏移, 长度, 方法, 是否最后一片)"""
+        for entry in entries:
+            size = entry.file_stat.st_size
+            if size <= self.piece_size:
+                yield entry, 0, size, (zipfile.ZIP_STORED if self.level <= 0 else None), True
+                continue
+            # 大文件先采样决定压缩方式，再切片分发
+            method = zipfile.ZIP_DEFLATED if self.level > 0 and is_worth_compressing(entry.file_path) else zipfile.ZIP_STORED
+            for offset in range(0, size, self.piece_size):
+                length = min(self.piece_size, size - offset)
+                yield entry, offset, length, method, offset + length >= size
+
+    def _submit(self, *task):
+        if self.executor is None:
+            future = Future()
+            future.set_result(compress_piece(*task))
+            return future
+        return self.executor.submit(compress_piece, *task)
+
+    def add_folder(self, folder_path, progress_callback=None):
+        entries = []
+        for root, _, files in os.walk(folder_path):
+            for file in files:
+                file_path = os.path.join(root, file)
+                arc_name = os.path.relpath(file_path, folder_path).replace(os.sep, '/')
+                entries.append(ZipEntryState(file_path, arc_name, os.stat(file_path)))
+        self.add_entries(entries, progress_callback)
+
+    def add_entries(self, entries, progress_callback=None):
+        pending = deque()
+        finished = 0
+        for entry, offset, length, method, final in self._plan(entries):
+            future = self._submit(entry.file_path, offset, length, method, self.level, final)
+            pending.append((entry, offset, final, future))
+            while len(pending) >= self.window:
+                if self._write_piece(*pending.popleft()) and progress_callback:
+                    finished += 1
+                    progress_callback(finished, len(entries))
+        while pending:
+            if self._write_piece(*pending.popleft()) and progress_callback:
+                finished += 1
+                progress_callback(finished, len(entries))
+
+    def _write_piece(self, entry, offset, final, future):
+        """按顺序写出一个分片，返回该条目是否已写完"""
+        data, crc, raw_length, method = future.result()
+        if offset == 0:
+            entry.method = method
+            entry.crc = crc
+        else:
+            entry.crc = crc32_combine(entry.crc, crc, raw_length)
+        entry.raw_size += raw_length
+
+        if method == zipfile.ZIP_STORED:
+            # 存储方式：CRC 全部算完后写文件头，再原样输出文件内容
+            if final:
+                entry.compressed_size = entry.raw_size
+                self._write_local_header(entry)
+                self._copy_file(entry)
+            return final
+
+        if offset == 0 and final:
+            # 单片压缩：大小已知，不需要数据描述符
+            entry.compressed_size = len(data)
+            self._write_local_header(entry)
+            self._write(data)
+            return True
+        if offset == 0:
+            # 多片压缩：大小在写完最后一片后才知道，使用数据描述符（bit 3）
+            entry.flags |= 0x08
+            self._write_local_header(entry)
+        entry.compressed_size += len(data)
+        self._write(data)
+        if final:
+            if entry.zip64:
+                self._write(struct.pack('<IIQQ', 0x08074b50, entry.crc, entry.compressed_size, entry.raw_size))
+            else:
+                self._write(struct.pack('<IIII', 0x08074b50, entry.crc, entry.compressed_size, entry.raw_size))
+        return final
+
+    def _copy_file(self, entry):
+        remaining = entry.raw_size
+        with open(entry.file_path, 'rb') as file:
+            while remaining > 0:
+                data = file.read(min(file_block_size, remaining))
+                if not data:
+                    raise IOError('文件在压缩过程中被修改: ' + entry.file_path)
+                self._write(data)
+                remaining -= len(data)
+
+    @staticmethod
+    def _dos_datetime(mtime):
+        t = time.localtime(mtime)
+        if t.tm_year < 1980:
+            return 0, (1 << 5) | 1
+        dos_time = (t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2)
+        dos_date = ((t.tm_year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday
+        return dos_time, dos_date
+
+    def _write_local_header(self, entry):
+        entry.header_offset = self.position
+        name = entry.arc_name.encode('utf-8')
+        dos_time, dos_date = self._dos_datetime(entry.file_stat.st_mtime)
+        if entry.zip64:
+            extra = struct.pack('<HHQQ', 0x0001, 16, entry.raw_size if not entry.flags & 0x08 else 0,
+                                entry.compressed_size if not entry.flags & 0x08 else 0)
+            sizes = (0xFFFFFFFF, 0xFFFFFFFF)
+        else:
+            extra = b''
+            sizes = (0, 0) if entry.flags & 0x08 else (entry.compressed_size, entry.raw_size)
+        crc = 0 if entry.flags & 0x08 else entry.crc
+        version = 45 if entry.zip64 else 20
+        self._write(struct.pack('<IHHHHHIIIHH', 0x04034b50, version, entry.flags, entry.method,
+                                dos_time, dos_date, crc, sizes[0], sizes[1], len(name), len(extra)))
+        self._write(name + extra)
+        self.entries.append(entry)
+
+    def close(self):
+        """写出中央目录和结束记录"""
+        central_offset = self.position
+        for entry in self.entries:
+            name = entry.arc_name.encode('utf-8')
+            dos_time, dos_date = self._dos_datetime(entry.file_stat.st_mtime)
+            # ZIP64 扩展字段中只包含主记录里被置为 0xFFFFFFFF 的字段，顺序固定
+            zip64_fields = []
+            raw_size, compressed_size, header_offset = entry.raw_size, entry.compressed_size, entry.header_offset
+            if entry.zip64 or raw_size >= 0xFFFFFFFF:
+                zip64_fields.append(raw_size)
+                raw_size = 0xFFFFFFFF
+            if entry.zip64 or compressed_size >= 0xFFFFFFFF:
+                zip64_fields.append(compressed_size)
+                compressed_size = 0xFFFFFFFF
+            if header_offset >= 0xFFFFFFFF:
+                zip64_fields.append(header_offset)
+                header_offset = 0xFFFFFFFF
+            extra = b''
+            if zip64_fields:
+                extra = struct.pack('<HH' + 'Q' * len(zip64_fields), 0x0001, 8 * len(zip64_fields), *zip64_fields)
+            version = 45 if zip64_fields else 20
+            create_system = 0 if os.name == 'nt' else 3
+            external_attr = (entry.file_stat.st_mode & 0xFFFF) << 16
+            self._write(struct.pack('<IHHHHHHIIIHHHHHII', 0x02014b50, (create_system << 8) | version, version,
+                                    entry.flags, entry.method, dos_time, dos_date, entry.crc,
+                                    compressed_size, raw_size, len(name), len(extra), 0, 0, 0,
+                                    external_attr, header_offset))
+            self._write(name + extra)
+        central_size = self.position - central_offset
+        count = len(self.entries)
+        if count >= 0xFFFF or central_offset >= 0xFFFFFFFF or central_size >= 0xFFFFFFFF:
+            zip64_end_offset = self.position
+            self._write(struct.pack('<IQHHIIQQQQ', 0x06064b50, 44, 45, 45, 0, 0,
+                                    count, count, central_size, central_offset))
+            self._write(struct.pack('<IIQI', 0x07064b50, 0, zip64_end_offset, 1))
+            self._write(struct.pack('<IHHHHIIH', 0x06054b50, 0, 0, 0xFFFF, 0xFFFF,
+                                    0xFFFFFFFF, 0xFFFFFFFF, 0))
+        else:
+            self._write(struct.pack('<IHHHHIIH', 0x06054b50, 0, 0, count, count,
+                                    central_size, central_offset, 0))
+
+
+def compress_folder(folder_path, zip_target, show_progress=True, level=None):
+    """
+    把文件夹压缩为 ZIP，压缩工作由进程池并行完成。
+    输入:
+    - folder_path: 要压缩的文件夹
+    - zip_target: ZIP 文件路径，或可写的文件对象（可以是不可 seek 的流，如 ChunkedStreamWriter）
+    - show_progress: 是否打印压缩进度
+    - level: 压缩级别，None 表示使用配置的 compress_level
+    """
+    def report(processed_files, total_files):
+        if show_progress:
+            progress = processed_files / total_files * 100
+            print('\r压缩进度：{}'.format(print_progress_bar(round(progress))), end='')
+
+    if level is None:
+        level = int(server_options["compress_level"])
+    if isinstance(zip_target, str):
+        with open(zip_target, 'wb') as zip_file:
+            zip_writer = ParallelZipWriter(zip_file, level, get_compress_executor(), compress_worker_count())
+            zip_writer.add_folder(folder_path, report)
+            zip_writer.close()
+    else:
+        zip_writer = ParallelZipWriter(zip_target, level, get_compress_executor(), compress_worker_count())
+        zip_writer.add_folder(folder_path, report)
+        zip_writer.close()
+
+
+class RawSocketSink:
+    """旧协议使用的输出：数据原样发送到套接字"""
+    def __init__(self, sock):
+        self.sock = sock
+        self.bytes_written = 0
+
+    def write(self, data):
+        self.sock.sendall(data)
+        self.bytes_written += len(data)
+        return len(data)
+
+    def send_file(self, file, offset, count, hasher=None):
+        sent = send_file_data(self.sock, file, offset, count, hasher)
+        self.bytes_written += sent
+        return sent
+
+    def close(self):
+        pass
+
+
+class ChunkedStreamWriter:
+    """
+    供 zipfile 直接写入的套接字流。
+    数据按 [4字节大端长度][数据] 分块发送，长度为 0 的块表示结束；
+    写入的同时计算 SHA-1，不落盘、不回读。
+    """
+    def __init__(self, sock, chunk_limit=256 * 1024):
+        self.sock = sock
+        self.chunk_limit = chunk_limit
+        self.buffer = bytearray()
+        self.sha1_hash = hashlib.sha1()
+        self.bytes_written = 0
+        self.tuner = None  # 连接的 SocketTuner，发出的数据量交给它测量吞吐量
+        self.auto_chunk = False  # 数据块大小是否跟随 tuner 选择的读写块大小
+
+    def _send_header(self, length):
+        self.sock.sendall(struct.pack('!I', length))
+
+    def observe(self, size):
+        if self.tuner is not None:
+            self.tuner.observe(size)
+            if self.auto_chunk:
+                self.chunk_limit = self.tuner.block_size
+
+    def write(self, data):
+        self.buffer += data
+        self.sha1_hash.update(data)
+        self.bytes_written += len(data)
+        if len(self.buffer) >= self.chunk_limit:
+            self.flush()
+        return len(data)
+
+    def flush(self):
+        if self.buffer:
+            self._send_header(len(self.buffer))
+            self.sock.sendall(self.buffer)
+            self.observe(len(self.buffer))
+            self.buffer.clear()
+
+    def send_file(self, file, offset, count, hasher=None, max_chunk=None):
+        """
+        把文件的一段作为若干数据块发送，不经过 write 的缓冲。
+        未传入 hasher 时走零拷贝，这部分数据不计入 sha1_hash，调用方需已知其摘要。
+        """
+        self.flush()
+        sent = 0
+        while sent < count:
+            length = min(count - sent, max_chunk or self.chunk_limit)
+            self._send_header(length)
+            if send_file_data(self.sock, file, offset + sent, length, hasher) != length:
+                raise IOError('文件在发送过程中被截断')
+            sent += length
+            self.observe(length)
+        self.bytes_written += sent
+        return sent
+
+    def close(self):
+        self.flush()
+        self._send_header(0)
+
+
+class DataFrameSink(ChunkedStreamWriter):
+    """新协议的输出：数据以 DATA 帧发送，传输结束由随后的 DIGEST 帧表示"""
+    def __init__(self, connection, request_id, chunk_limit=None):
+        tuner = connection.tuner
+        auto_chunk = chunk_limit is None and tuner is not None and tuner.auto_block
+        super(DataFrameSink, self).__init__(connection.sock, tuner.block_size if auto_chunk else
+                                            chunk_limit or data_frame_size)
+        self.request_id = request_id
+        self.tuner = tuner
+        self.auto_chunk = auto_chunk
+
+    def _send_header(self, length):
+        self.sock.sendall(FRAME_HEADER.pack(MSG_DATA, self.request_id, length))
+
+    def close(self):
+        self.flush()
+
+
+# ---------------- 传输压缩 ----------------
+# GET 请求带上客户端支持的算法，服务端选定后在 META 中返回，之后每个数据块独立压缩为 ZDATA 帧；
+# 服务端逐块决定是否压缩，不值得压缩的块仍以 DATA 帧原样发送，客户端两种帧都接受。
+ZDATA_HEADER = struct.Struct('!I')  # ZDATA 帧负载开头：解压后的长度，其后是压缩数据
+TRANSPORT_PIPELINE_DEPTH = 4  # 每个传输最多同时在压缩的块数（压缩在线程池中进行，与发送重叠）
+TRANSPORT_INLINE_LIMIT = 256 * 1024  # 小于该大小且前面没有排队的块直接在发送线程中压缩，省去线程切换
+TRANSPORT_BYPASS_BLOCKS = 16  # 压缩比直接发送还慢时暂停压缩的块数，之后从最低级别重新试探
+TRANSPORT_PROBE_INTERVAL = (2, 64)  # 连续这么多块测不到链路速度时原样发送几块重新测量，间隔每次加倍直到上限
+TRANSPORT_PROBE_LIMIT = 8      # 每次测量最多原样发送的块数
+TRANSPORT_IDLE_GAP = 0.002     # 两次发送间隔超过该秒数视为链路空闲过，发送缓冲区需要重新填满
+TRANSPORT_SMOOTHING = 0.3     # 压缩耗时、发送耗时和压缩比的指数平滑系数
+
+# 算法名 -> (压缩函数(数据, 级别), 解压对象的工厂)
+TRANSPORT_COMPRESSORS = {"zlib": (zlib.compress, zlib.decompressobj)}
+if bz2 is not None:
+    TRANSPORT_COMPRESSORS["bz2"] = (bz2.compress, bz2.BZ2Decompressor)
+if lzma is not None:
+    TRANSPORT_COMPRESSORS["lzma"] = (lambda data, level: lzma.compress(data, preset=level, check=lzma.CHECK_NONE),
+                                     lzma.LZMADecompressor)
+
+transport_executor = None
+transport_executor_lock = Lock()
+
+
+def get_transport_executor():
+    """获取（首次调用时创建）传输压缩线程池，所有会话共用；zlib、bz2、lzma 压缩时都会释放 GIL"""
+    global transport_executor
+    with transport_executor_lock:
+        if transport_executor is None:
+            transport_executor = ThreadPoolExecutor(max_workers=compress_worker_count())
+        return transport_executor
+
+
+def choose_transport_compression(request):
+    """选出客户端请求的算法中服务端也允许的第一个，返回 (算法, 级别)；不压缩时算法为 None"""
+    allowed = [method.strip() for method in server_options["compression"].split(',')]
+    method = next((method for method in request.get("compression", [])
+                   if method in allowed and method in TRANSPORT_COMPRESSORS), None)
+    level = int(request.get("compression_level") or server_options["compression_level"])
+    return method, max(1, min(9, level))
+
+
+def compress_transport_block(method, data, level):
+    """
+    在线程池中压缩一个数据块。先用 zlib 最低级别试压缩开头一段，几乎不变小则不压缩。
+    输出:
+    - (压缩后的数据或 None, 压缩耗时秒数)
+    """
+    if len(data) > COMPRESS_SAMPLE_SIZE:
+        sample = data[:COMPRESS_SAMPLE_SIZE]
+        if len(zlib.compress(sample, 1)) >= len(sample) * COMPRESS_SAMPLE_RATIO:
+            return None, 0
+    start = time.perf_counter()
+    compressed = TRANSPORT_COMPRESSORS[method][0](data, level)
+    return compressed, time.perf_counter() - start
+
+
+def decompress_block(method, payload):
+    """解压 ZDATA 帧的负载；解压结果最多取帧头声明的长度，防止异常数据耗尽内存"""
+    if len(payload) < ZDATA_HEADER.size:
+        raise ProtocolError('压缩数据块过短')
+    raw_length = ZDATA_HEADER.unpack_from(payload)[0]
+    if raw_length > MAX_FRAME_PAYLOAD:
+        raise ProtocolError('压缩数据块过大: ' + str(raw_length))
+    try:
+        data = TRANSPORT_COMPRESSORS[method][1]().decompress(memoryview(payload)[ZDATA_HEADER.size:], raw_length)
+    except Exception as e:
+        raise ProtocolError('压缩数据块损坏: ' + str(e))
+    if len(data) != raw_length:
+        raise ProtocolError('压缩数据块长度不符')
+    return data
+
+
+def _smooth(average, value):
+    return value if average is None else average + (value - average) * TRANSPORT_SMOOTHING
+
+
+class AdaptiveCompressor:
+    """
+    为每个数据块选择压缩级别（或不压缩），使传输的总耗时最小。
+    压缩与发送重叠进行，每个原始字节的耗时约为 max(压缩耗时 / 并行数, 压缩比 × 发送耗时)：
+    - 从最低级别开始，链路是瓶颈且压缩还有富余时逐级提高，最高到请求的级别；
+    - 压缩跟不上链路时降低级别；
+    - 压缩比发送原始数据还慢时暂停压缩若干块，之后从最低级别重新试探。
+    发送耗时只在链路持续繁忙时才测得准，压缩一直是瓶颈时链路会空闲，此时定期原样发送几块来测量链路速度。
+    测量结果属于连接，同一连接上的后续传输（流水线 GET、BATCH 中的各项）沿用同一个对象。
+    """
+    def __init__(self, method, level, parallelism):
+        self.method = method
+        self.max_level = level
+        self.level = 1
+        self.parallelism = parallelism
+        self.bypass = 0
+        self.probing = 0           # 为测量链路速度还要原样发送的块数
+        self.unmeasured = 0        # 上次测得链路速度以来发送的块数
+        self.probe_interval = TRANSPORT_PROBE_INTERVAL[0]
+        self.compress_cost = None  # 当前级别下每个原始字节的压缩耗时（秒）
+        self.send_cost = None      # 每个字节的发送耗时（秒），链路越慢越大
+        self.ratio = None          # 压缩后大小 / 原始大小
+        # 连续无间隔发送的字节数超过发送缓冲区大小后，sendall 的耗时才反映链路速度
+        self.busy_bytes = 0
+        self.last_send_end = None
+
+    def next_level(self):
+        """下一个数据块使用的压缩级别，None 表示直接发送"""
+        if self.probing:
+            self.probing -= 1
+            return None
+        if self.bypass:
+            self.bypass -= 1
+            return None
+        if self.unmeasured >= self.probe_interval:
+            self.unmeasured = 0
+            self.probe_interval = min(self.probe_interval * 2, TRANSPORT_PROBE_INTERVAL[1])
+            self.probing = TRANSPORT_PROBE_LIMIT - 1
+            return None
+        return self.level
+
+    def record_send(self, size, start, end, send_buffer_size):
+        """记录一次从 start 到 end 的发送"""
+        if self.last_send_end is None or start - self.last_send_end > TRANSPORT_IDLE_GAP:
+            # 等待压缩或读盘期间链路空闲，发送缓冲区已排空，之后的 sendall 会很快返回
+            self.busy_bytes = 0
+        measured = self.busy_bytes >= send_buffer_size
+        self.busy_bytes += size
+        self.last_send_end = end
+        if not measured:
+            self.unmeasured += 1
+            return
+        self.send_cost = _smooth(self.send_cost, (end - start) / size)
+        self.unmeasured = 0
+        self.probing = 0
+
+    def record_compress(self, level, raw_size, compressed_size, seconds):
+        if level != self.level:
+            # 级别调整之前提交的块，耗时不代表当前级别
+            return
+        self.compress_cost = _smooth(self.compress_cost, seconds / raw_size)
+        self.ratio = _smooth(self.ratio, compressed_size / raw_size)
+        if self.send_cost is None:
+            return
+        cost = self.compress_cost / self.parallelism
+        if cost > self.send_cost:
+            self.level = 1
+            self.bypass = TRANSPORT_BYPASS_BLOCKS
+        elif cost > self.ratio * self.send_cost and self.level > 1:
+            self.level -= 1
+        elif cost < self.ratio * self.send_cost / 2 and self.level < self.max_level:
+            self.level += 1
+        else:
+            return
+        # 级别变化后重新测量
+        self.compress_cost = None
+        self.ratio = None
+
+
+def get_transport_compressor(connection, method, level):
+    """取得连接上沿用的 AdaptiveCompressor，算法或级别变化时重新创建"""
+    compressor = connection.transport_compressor
+    if compressor is None or compressor.method != method or compressor.max_level != level:
+        compressor = AdaptiveCompressor(method, level, min(TRANSPORT_PIPELINE_DEPTH, compress_worker_count()))
+        connection.transport_compressor = compressor
+    return compressor
+
+
+class CompressedFrameSink(DataFrameSink):
+    """
+    协商了传输压缩时的输出：每个数据块由 AdaptiveCompressor 决定压缩为 ZDATA 帧还是原样作为 DATA 帧发送。
+    最多 TRANSPORT_PIPELINE_DEPTH 个块同时在线程池中压缩，发送线程按顺序取出发送。
+    """
+    def __init__(self, connection, request_id, compressor):
+        super(CompressedFrameSink, self).__init__(connection, request_id, data_frame_size)
+        self.method = compressor.method
+        self.compressor = compressor
+        self.executor = get_transport_executor()
+        self.depth = compressor.parallelism
+        self.pending = deque()  # (原始数据, 压缩级别, Future 或 None)
+        self.wire_bytes = 0
+        self.compress_seconds = 0  # 各块压缩耗时之和（线程池中并行的部分也计入）
+
+    def flush(self):
+        if self.buffer:
+            self._submit_block(self.buffer)
+            self.buffer.clear()
+
+    def _submit_block(self, data):
+        level = self.compressor.next_level()
+        if not self.pending and (level is None or len(data) < TRANSPORT_INLINE_LIMIT):
+            compressed = None
+            if level is not None:
+                compressed, seconds = compress_transport_block(self.method, data, level)
+                compressed = self._accept(level, data, compressed, seconds)
+            self._send_frame(data, compressed)
+            return
+        # 调用方会复用缓冲区，排队的块需要复制
+        data = bytes(data)
+        future = None if level is None else self.executor.submit(compress_transport_block, self.method, data, level)
+        self.pending.append((data, level, future))
+        while len(self.pending) > self.depth:
+            self._send_pending()
+
+    def _send_pending(self):
+        data, level, future = self.pending.popleft()
+        compressed = None
+        if future is not None:
+            compressed = self._accept(level, data, *future.result())
+        self._send_frame(data, compressed)
+
+    def _accept(self, level, data, compressed, seconds):
+        """记录压缩结果，压缩后没有明显变小时返回 None（原样发送）"""
+        self.compress_seconds += seconds
+        if compressed is None:
+            return None
+        self.compressor.record_compress(level, len(data), len(compressed), seconds)
+        return compressed if len(compressed) < len(data) * COMPRESS_SAMPLE_RATIO else None
+
+    def _send_frame(self, data, compressed):
+        if compressed is None:
+            header = FRAME_HEADER.pack(MSG_DATA, self.request_id, len(data))
+        else:
+            header = FRAME_HEADER.pack(MSG_ZDATA, self.request_id, ZDATA_HEADER.size + len(compressed)) + \
+                ZDATA_HEADER.pack(len(data))
+            data = compressed
+        start = time.perf_counter()
+        self.sock.sendall(header)
+        self.sock.sendall(data)
+        # 发送缓冲区大小随内核自动调整，每次重新读取
+        self.compressor.record_send(len(header) + len(data), start, time.perf_counter(),
+                                    self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF))
+        self.wire_bytes += len(header) + len(data)
+        self.observe(len(header) + len(data))
+
+    def drain(self):
+        """发送所有排队的块"""
+        self.flush()
+        while self.pending:
+            self._send_pending()
+
+    def send_file(self, file, offset, count, hasher=None, max_chunk=None):
+        """读出文件的一段逐块压缩发送（压缩需要把数据读到用户态，不走零拷贝），返回前全部发出"""
+        self.flush()
+        file.seek(offset)
+        block = bytearray(self.chunk_limit)
+        view = memoryview(block)
+        sent = 0
+        while sent < count:
+            n = file.readinto(view[:min(self.chunk_limit, count - sent)])
+            if not n:
+                raise IOError('文件在发送过程中被截断')
+            if hasher is not None:
+                hasher.update(view[:n])
+            self._submit_block(view[:n])
+            sent += n
+        self.drain()
+        self.bytes_written += sent
+        return sent
+
+    def close(self):
+        self.drain()
+
+
+def send_file_data(sock, file, offset=0, count=None, hasher=None):
+    """
+    把文件内容发送到套接字。
+    支持 os.sendfile 的平台上由内核直接从页缓存发送（零拷贝），
+    否则退回到使用可复用缓冲区的读取-发送循环。
+    需要同时计算摘要时走读取-发送循环，边发送边更新摘要，文件只读一遍。
+    输入:
+    - sock: 目标套接字
+    - file: 以二进制模式打开的文件对象
+    - offset: 起始偏移
+    - count: 发送的字节数，None 表示发送到文件末尾
+    - hasher: 可选的 hashlib 对象，发送的数据会同时送入该对象
+    输出:
+    - 实际发送的字节数
+    """
+    if hasher is None and hasattr(os, 'sendfile') and server_options["zero_copy"].lower() == 'true':
+        return sock.sendfile(file, offset, count)
+
+    file.seek(offset)
+    block = bytearray(file_block_size)
+    view = memoryview(block)
+    total_sent = 0
+    while count is None or total_sent < count:
+        read_size = file_block_size if count is None else min(file_block_size, count - total_sent)
+        n = file.readinto(view[:read_size])
+        if not n:
+            break
+        if hasher is not None:
+            hasher.update(view[:n])
+        sock.sendall(view[:n])
+        total_sent += n
+    return total_sent
+
+
+def hash_file_region(file, offset, count, hasher):
+    """用可复用缓冲区读取文件的一段并送入 hasher，内存占用与文件大小无关"""
+    file.seek(offset)
+    block = bytearray(file_block_size)
+    view = memoryview(block)
+    remaining = count
+    while remaining > 0:
+        n = file.readinto(view[:min(file_block_size, remaining)])
+        if not n:
+            raise IOError('文件比预期的短')
+        hasher.update(view[:n])
+        remaining -= n
+
+
+class HashTee:
+    """把数据同时送入多个 hashlib 对象"""
+    def __init__(self, *hashers):
+        self.hashers = hashers
+
+    def update(self, data):
+        for hasher in self.hashers:
+            hasher.update(data)
+
+
+def send_file_with_digest(sink, file_path, file_stat):
+    """
+    发送整个文件并返回其 SHA-1。
+    摘要缓存命中时直接零拷贝发送；未命中时边发送边计算摘要并写入缓存。
+    输入:
+    - sink: 输出（RawSocketSink / DataFrameSink）
+    - file_path: 文件路径
+    - file_stat: 发送前获取的 os.stat 结果（文件大小已按此告知客户端）
+    输出:
+    - 文件的 SHA-1 十六进制字符串
+    """
+    cached_sha1 = digest_cache.get(file_path, file_stat)
+    with open(file_path, 'rb') as file:
+        if cached_sha1 is not None:
+            print('[Main_Server_Output]SHA-1 cache hit')
+            sink.send_file(file, 0, file_stat.st_size)
+            return cached_sha1
+        sha1_hash = hashlib.sha1()
+        sink.send_file(file, 0, file_stat.st_size, hasher=sha1_hash)
+    file_sha1 = sha1_hash.hexdigest()
+    # 发送期间文件被修改过则不缓存，避免把混合内容的摘要记到新版本上
+    if DigestCache.make_key(file_path, os.stat(file_path)) == DigestCache.make_key(file_path, file_stat):
+        digest_cache.put(file_path, file_stat, file_sha1)
+    return file_sha1
+
+
+def cached_file_digest(file_path, file_stat):
+    """返回文件的 SHA-1，优先使用摘要缓存，未命中时读一遍文件并写入缓存"""
+    file_sha1 = digest_cache.get(file_path, file_stat)
+    if file_sha1 is None:
+        sha1_hash = hashlib.sha1()
+        with metrics.span('hash', name=os.path.basename(file_path), bytes=file_stat.st_size), \
+                open(file_path, 'rb') as file:
+            hash_file_region(file, 0, file_stat.st_size, sha1_hash)
+        file_sha1 = sha1_hash.hexdigest()
+        digest_cache.put(file_path, file_stat, file_sha1)
+    return file_sha1
+
+
+def send_file_range(sink, file_path, file_stat, offset, length, range_digest=False, file_digest=False):
+    """
+    发送文件的 [offset, offset + length) 区间。
+    输入:
+    - range_digest: 是否计算该区间数据的 SHA-1（分段下载用于校验每一段）
+    - file_digest: 是否需要整个文件的 SHA-1（续传时客户端用它校验完整文件）；
+      摘要缓存未命中且区间到达文件末尾时，先从本地磁盘读一遍前缀，再在发送时继续计算
+    输出:
+    - (区间 SHA-1 或 None, 整个文件的 SHA-1 或 None)
+    """
+    if offset == 0 and length == file_stat.st_size:
+        file_sha1 = send_file_with_digest(sink, file_path, file_stat)
+        return file_sha1, file_sha1
+    range_hash = hashlib.sha1() if range_digest else None
+    file_hash = None
+    file_sha1 = digest_cache.get(file_path, file_stat)
+    with open(file_path, 'rb') as file:
+        if file_sha1 is None and file_digest and offset + length == file_stat.st_size:
+            file_hash = hashlib.sha1()
+            hash_file_region(file, 0, offset, file_hash)
+        hashers = [hasher for hasher in (range_hash, file_hash) if hasher is not None]
+        sink.send_file(file, offset, length, hasher=HashTee(*hashers) if hashers else None)
+    if file_hash is not None:
+        file_sha1 = file_hash.hexdigest()
+        if DigestCache.make_key(file_path, os.stat(file_path)) == DigestCache.make_key(file_path, file_stat):
+            digest_cache.put(file_path, file_stat, file_sha1)
+    return (range_hash.hexdigest() if range_hash else None), file_sha1
+
+
+# ---------------- 增量传输 ----------------
+# 客户端把本地旧版本按 block_size 切块，发送每块的弱校验值（adler32，可滚动计算）和强摘要（SHA-1）；
+# 服务端在新版本上逐字节滚动弱校验值查找相同的块，用 COPY 帧引用客户端已有的块，其余数据用 DATA 帧发送。
+DELTA_SIGNATURE = struct.Struct('!I20s')  # 每块：弱校验值, 强摘要
+DELTA_COPY = struct.Struct('!II')         # COPY 帧负载：起始块号, 连续块数
+ADLER_MOD = 65521
+
+
+def choose_delta_block_size(file_size):
+    """块大小取约为文件大小的平方根（对齐到 1KB），并保证签名能放进一个帧"""
+    block_size = max(DELTA_MIN_BLOCK, min(DELTA_MAX_BLOCK, (int(file_size ** 0.5) + 1023) // 1024 * 1024))
+    max_blocks = MAX_FRAME_PAYLOAD // DELTA_SIGNATURE.size
+    return max(block_size, -(-file_size // max_blocks))
+
+
+def compute_block_signatures(file_path, block_size):
+    """计算本地文件每一块的签名，返回打包后的字节串"""
+    signatures = bytearray()
+    with open(file_path, 'rb') as file:
+        while True:
+            block = file.read(block_size)
+            if not block:
+                break
+            signatures += DELTA_SIGNATURE.pack(zlib.adler32(block), hashlib.sha1(block).digest())
+    return bytes(signatures)
+
+
+def send_file_delta(connection, request_id, file_path, block_size, basis_size, signature_data):
+    """
+    以客户端旧版本的块签名为基准，发送 file_path 的增量指令。
+    输出:
+    - (整个新文件的 SHA-1, 以 DATA 帧发送的字节数, 以 COPY 帧复用的字节数)
+    """
+    table = {}
+    tail = None
+    block_count = len(signature_data) // DELTA_SIGNATURE.size
+    for index, (weak, strong) in enumerate(DELTA_SIGNATURE.iter_unpack(signature_data)):
+        if index == block_count - 1 and basis_size - index * block_size < block_size:
+            # 最后一块不足 block_size，只能和新文件的末尾比较
+            tail = (index, basis_size - index * block_size, strong)
+        else:
+            table.setdefault(weak, []).append((strong, index))
+
+    sha1_hash = hashlib.sha1()
+    literal = bytearray()
+    stats = {"literal": 0, "copied": 0}
+    pending_copy = []  # [起始块号, 块数]
+
+    def flush_literal():
+        if literal:
+            connection.send_frame(MSG_DATA, request_id, bytes(literal))
+            stats["literal"] += len(literal)
+            literal.clear()
+
+    def flush_copy():
+        if pending_copy:
+            connection.send_frame(MSG_COPY, request_id, DELTA_COPY.pack(*pending_copy))
+            pending_copy.clear()
+
+    def copy_block(index, length):
+        if pending_copy and pending_copy[0] + pending_copy[1] == index:
+            pending_copy[1] += 1
+        else:
+            flush_copy()
+            flush_literal()
+            pending_copy[:] = [index, 1]
+        stats["copied"] += length
+
+    window = bytearray()
+    pos = 0
+    weak = None
+    eof = False
+    miss_run = 0  # 距离上一次匹配的字节数
+    with open(file_path, 'rb') as file:
+        while True:
+            available = len(window) - pos
+            if available < block_size and not eof:
+                del window[:pos]
+                pos = 0
+                data = file.read(max(file_block_size, block_size))
+                if data:
+                    sha1_hash.update(data)
+                    window += data
+                else:
+                    eof = True
+                continue
+            if available < block_size:
+                break
+            if weak is None:
+                weak = zlib.adler32(window[pos:pos + block_size])
+                a, b = weak & 0xffff, weak >> 16
+            candidates = table.get(weak)
+            if candidates:
+                strong = hashlib.sha1(window[pos:pos + block_size]).digest()
+                match = next((index for digest, index in candidates if digest == strong), None)
+                if match is not None:
+                    copy_block(match, block_size)
+                    pos += block_size
+                    weak = None
+                    miss_run = 0
+                    continue
+            if pending_copy:
+                flush_copy()
+            if miss_run >= DELTA_SCAN_LIMIT and (miss_run // block_size) % DELTA_SCAN_EVERY:
+                # 长时间没有匹配（大段新数据）：整块跳过，只在块边界上比较，
+                # 每 DELTA_SCAN_EVERY 块中仍逐字节搜索一块，以便找回错位的旧数据
+                literal += window[pos:pos + block_size]
+                if len(literal) >= data_frame_size:
+                    flush_literal()
+                pos += block_size
+                miss_run += block_size
+                weak = None
+                continue
+            # 没有匹配：当前字节作为新数据发送，窗口向后滚动一个字节
+            out_byte = window[pos]
+            literal.append(out_byte)
+            miss_run += 1
+            if len(literal) >= data_frame_size:
+                flush_literal()
+            if available > block_size:
+                a = (a - out_byte + window[pos + block_size]) % ADLER_MOD
+                b = (b - block_size * out_byte + a - 1) % ADLER_MOD
+                weak = (b << 16) | a
+            else:
+                weak = None
+            pos += 1
+    rest = bytes(window[pos:])
+    if tail is not None and rest and len(rest) == tail[1] and hashlib.sha1(rest).digest() == tail[2]:
+        copy_block(tail[0], len(rest))
+    else:
+        if pending_copy:
+            flush_copy()
+        literal += rest
+    flush_copy()
+    flush_literal()
+    return sha1_hash.hexdigest(), stats["literal"], stats["copied"]
+
+
+# ---------------- 哈希树 ----------------
+# 文件按 chunk_size 分块，每块的摘要是一片叶子，两两拼接后再求摘要直到只剩根。
+# 叶子和内部节点的摘要分别以 0x00、0x01 开头计算，一块数据无法冒充由两个子节点拼成的内部节点。
+# 服务端在 META 中发送全部叶子和根，客户端边接收边逐块校验，只重新请求校验失败的块。
+HASH_ALGORITHMS = {
+    "blake2b": lambda data=b'': hashlib.blake2b(data, digest_size=32),
+    "sha256": hashlib.sha256,
+    "sha1": hashlib.sha1,
+}
+
+
+LEAF_PREFIX = b'\x00'
+NODE_PREFIX = b'\x01'
+
+
+def new_leaf_hash(algorithm, data=b''):
+    """计算一块数据（叶子）摘要的 hashlib 对象，已加入叶子前缀"""
+    leaf_hash = HASH_ALGORITHMS[algorithm](LEAF_PREFIX)
+    leaf_hash.update(data)
+    return leaf_hash
+
+
+def merkle_root(leaves, algorithm):
+    """由叶子摘要（十六进制）计算根摘要；奇数个节点时最后一个直接进入上一层"""
+    new_hash = HASH_ALGORITHMS[algorithm]
+    level = [bytes.fromhex(leaf) for leaf in leaves]
+    if not level:
+        return new_hash().hexdigest()
+    while len(level) > 1:
+        next_level = [new_hash(NODE_PREFIX + level[i] + level[i + 1]).digest() for i in range(0, len(level) - 1, 2)]
+        if len(level) % 2:
+            next_level.append(level[-1])
+        level = next_level
+    return level[0].hex()
+
+
+def hash_tree_cache_path(file_path, algorithm, chunk_size):
+    """哈希树缓存放在 HASH_TREE_CACHE_DIR 中（不写入共享文件夹），以文件的绝对路径、算法和块大小命名"""
+    name = '{}|{}|{}'.format(os.path.abspath(file_path), algorithm, chunk_size)
+    return os.path.join(HASH_TREE_CACHE_DIR, hashlib.sha1(name.encode('utf-8')).hexdigest() + '.json')
+
+
+def load_hash_tree(file_path, file_stat, algorithm, chunk_size):
+    """
+    读取文件的哈希树缓存，缓存不存在或文件已变化时重新计算并尝试写回。
+    输出:
+    - {"algorithm", "chunk_size", "leaves", "root"}
+    """
+    key = [file_stat.st_size, file_stat.st_mtime_ns, file_stat.st_ino, algorithm, chunk_size]
+    cache_path = hash_tree_cache_path(file_path, algorithm, chunk_size)
+    # 只有一块的文件直接计算，不值得多一个缓存文件（批量下载大量小文件时尤其如此）
+    cacheable = file_stat.st_size > chunk_size
+    if cacheable:
+        try:
+            with open(cache_path, 'r', encoding='utf-8') as cache_file:
+                cached = json.load(cache_file)
+            if cached["key"] == key:
+                return cached["tree"]
+        except (OSError, ValueError, KeyError):
+            pass
+    leaves = []
+    with metrics.span('hash_tree', name=os.path.basename(file_path), bytes=file_stat.st_size), \
+            open(file_path, 'rb') as file:
+        for offset in range(0, file_stat.st_size, chunk_size):
+            chunk_hash = new_leaf_hash(algorithm)
+            hash_file_region(file, offset, min(chunk_size, file_stat.st_size - offset), chunk_hash)
+            leaves.append(chunk_hash.hexdigest())
+    tree = {"algorithm": algorithm, "chunk_size": chunk_size, "leaves": leaves,
+            "root": merkle_root(leaves, algorithm)}
+    if not cacheable:
+        return tree
+    try:
+        os.makedirs(HASH_TREE_CACHE_DIR, exist_ok=True)
+        temp_path = cache_path + '.tmp.' + str(get_ident())
+        with open(temp_path, 'w', encoding='utf-8') as cache_file:
+            json.dump({"key": key, "tree": tree}, cache_file)
+        os.replace(temp_path, cache_path)
+    except OSError:
+        pass
+    return tree
+
+
+class ChunkVerifier:
+    """接收时按块计算摘要并与哈希树的叶子比较，可作为 PipelinedFileWriter 的 hasher"""
+    def __init__(self, tree, position=0, prefix=b''):
+        self.tree = tree
+        self.chunk_size = tree["chunk_size"]
+        # 续传时从块中间开始，prefix 是本地已有的该块前半部分
+        self.index = position // self.chunk_size
+        self.filled = len(prefix)
+        self.hasher = new_leaf_hash(tree["algorithm"], prefix)
+        self.computed = {}  # 块号 -> 实际收到的数据的摘要
+        self.failed = []
+
+    def update(self, data):
+        view = memoryview(data)
+        while view:
+            take = min(len(view), self.chunk_size - self.filled)
+            self.hasher.update(view[:take])
+            self.filled += take
+            view = view[take:]
+            if self.filled == self.chunk_size:
+                self._check()
+
+    def _check(self):
+        digest = self.hasher.hexdigest()
+        self.computed[self.index] = digest
+        if self.index >= len(self.tree["leaves"]) or digest != self.tree["leaves"][self.index]:
+            self.failed.append(self.index)
+        self.index += 1
+        self.filled = 0
+        self.hasher = new_leaf_hash(self.tree["algorithm"])
+
+    def finish(self):
+        """收完最后一块（可能不足 chunk_size）后调用"""
+        if self.filled:
+            self._check()
+
+
+def encode_chunk_map(have):
+    """对等分发的块图：每块一位，第 0 块是第一个字节的最高位，编码为十六进制字符串"""
+    bits = bytearray((len(have) + 7) // 8)
+    for index, present in enumerate(have):
+        if present:
+            set_chunk_bit(bits, index)
+    return bits.hex()
+
+
+def chunk_map_has(bits, index):
+    """块图（bytes）中是否有第 index 块"""
+    return (index >> 3) < len(bits) and bool(bits[index >> 3] & (0x80 >> (index & 7)))
+
+
+def set_chunk_bit(bits, index):
+    """在块图（bytearray）中加入第 index 块，不够长时补齐；输出: 该块原先是否不在块图中"""
+    if len(bits) <= index >> 3:
+        bits.extend(bytes((index >> 3) + 1 - len(bits)))
+    added = not bits[index >> 3] & (0x80 >> (index & 7))
+    bits[index >> 3] |= 0x80 >> (index & 7)
+    return added
+
+
+class DigestCache:
+    """
+    服务端文件 SHA-1 缓存。
+    以 (路径, 大小, mtime_ns, inode) 为键，文件任何变化都会使旧条目失效；
+    超出容量时按最近最少使用淘汰，并持久化到 server_config.ini 所在目录。
+    """
+    def __init__(self, cache_path, max_entries, save_interval=5):
+        self.cache_path = cache_path
+        self.max_entries = max_entries
+        self.save_interval = save_interval
+        self.entries = OrderedDict()
+        self.lock = Lock()
+        self.dirty = False
+        self.last_save = 0
+        self.load()
+
+    @staticmethod
+    def make_key(file_path, file_stat):
+        return '|'.join([os.path.abspath(file_path), str(file_stat.st_size),
+                         str(file_stat.st_mtime_ns), str(file_stat.st_ino)])
+
+    def get(self, file_path, file_stat):
+        key = self.make_key(file_path, file_stat)
+        with self.lock:
+            digest = self.entries.get(key)
+            if digest is not None:
+                self.entries.move_to_end(key)
+            return digest
+
+    def put(self, file_path, file_stat, digest):
+        key = self.make_key(file_path, file_stat)
+        with self.lock:
+            self.entries[key] = digest
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+            self.dirty = True
+        if time.time() - self.last_save >= self.save_interval:
+            self.save()
+
+    def load(self):
+        try:
+            with open(self.cache_path, 'r', encoding='utf-8') as cache_file:
+                items = json.load(cache_file)
+        except (OSError, ValueError):
+            return
+        with self.lock:
+            # 文件中按从旧到新的顺序保存，载入后保持 LRU 顺序
+            for key, digest in items[-self.max_entries:]:
+                self.entries[key] = digest
+
+    def save(self):
+        with self.lock:
+            if not self.dirty:
+                return
+            items = list(self.entries.items())
+            self.dirty = False
+            self.last_save = time.time()
+        try:
+            os.makedirs(os.path.dirname(self.cache_path), exist_ok=True)
+            temp_path = self.cache_path + '.tmp.' + str(os.getpid()) + '.' + str(get_ident())
+            with open(temp_path, 'w', encoding='utf-8') as cache_file:
+                json.dump(items, cache_file)
+            os.replace(temp_path, self.cache_path)
+        except OSError as e:
+            print('[Main_Server_Output]Digest cache save ERROR:' + str(e))
+
+
+def send_folder_archive(folder_path, sink, announce, level=None):
+    """
+    把文件夹的 ZIP 压缩包写入 sink。
+    内容未变化的文件夹直接从压缩包缓存零拷贝发送；否则边压缩边发送，并把结果写入缓存。
+    输入:
+    - folder_path: 文件夹路径
+    - sink: 输出（ChunkedStreamWriter / DataFrameSink）
+    - announce: 开始发送数据前调用 announce(size)，缓存命中时 size 为压缩包大小，流式压缩时为 None；
+      返回 False 表示放弃发送
+    - level: ZIP 压缩级别，None 表示使用配置的 compress_level（传输层压缩时用 0 只打包不压缩）
+    输出:
+    - 压缩包的 SHA-1，放弃发送时返回 None
+    """
+    if level is None:
+        level = int(server_options["compress_level"])
+    fingerprint = folder_fingerprint(folder_path, level)
+    cached = archive_cache.acquire(folder_path, fingerprint, level)
+    if cached is not None:
+        metrics.inc('archive_cache_total', result='hit')
+        try:
+            print('[Main_Server_Output]Archive cache hit')
+            with open(archive_cache.path_for(fingerprint), 'rb') as zip_file:
+                if announce(cached["size"]) is False:
+                    return None
+                print('[Main_Server_Output]Sending...')
+                sink.send_file(zip_file, 0, cached["size"], max_chunk=64 * 1024 * 1024)
+                sink.close()
+            return cached["sha1"]
+        finally:
+            archive_cache.release(fingerprint)
+
+    if announce(None) is False:
+        return None
+    metrics.inc('archive_cache_total', result='miss')
+    print('[Main_Server_Output]Streaming...')
+    cache_temp_path = archive_cache.begin_build(fingerprint)
+    try:
+        if cache_temp_path is None:
+            compress_folder(folder_path, sink, level=level)
+        else:
+            with open(cache_temp_path, 'wb') as cache_file:
+                compress_folder(folder_path, TeeWriter(sink, cache_file), level=level)
+        sink.close()
+    except BaseException:
+        if cache_temp_path is not None:
+            archive_cache.abort(fingerprint, cache_temp_path)
+        raise
+    file_sha1 = sink.sha1_hash.hexdigest()
+    if cache_temp_path is not None:
+        archive_cache.commit(folder_path, fingerprint, cache_temp_path, sink.bytes_written, file_sha1, level)
+    print('\n[Main_Server_Output]Finshed. Sent ' + str(sink.bytes_written) + ' bytes')
+    return file_sha1
+
+
+def send_folder(client_socket, folder_name, folder_path):
+    """旧协议：以 ZIP 形式发送文件夹（默认为旧版客户端支持的整包 ZIP 模式，zip_stream = true 时为 ZSTREAM 分块流）"""
+    if server_options["zip_stream"].lower() == 'true':
+        print('[Main_Server_Output]Cilent Download Mode:ZIP STREAM')
+
+        def announce(size):
+            client_socket.send(b'ZSTREAM')
+            print('[Main_Server_Output]Mode sent')
+            # 等待客户端确认后再发送数据，避免模式字符串和数据块粘在一起
+            if client_socket.recv(buf_size) != b'OK':
+                print('[Main_Server_Output]Cilent does not support ZIP STREAM')
+                return False
+
+        file_sha1 = send_folder_archive(folder_path, ChunkedStreamWriter(client_socket), announce)
+        if file_sha1 is None:
+            return
+
+    else:
+        print('[Main_Server_Output]Cilent Download Mode:ZIP')
+        # 发送压缩文件的通知
+        client_socket.send(b'ZIP')
+        print('[Main_Server_Output]Mode sent')
+
+        level = int(server_options["compress_level"])
+        fingerprint = folder_fingerprint(folder_path, level)
+        cached = archive_cache.acquire(folder_path, fingerprint, level)
+        if cached is not None:
+            try:
+                with open(archive_cache.path_for(fingerprint), 'rb') as zip_file:
+                    print('[Main_Server_Output]Sending...')
+                    client_socket.send(str(cached["size"]).encode())
+                    send_file_data(client_socket, zip_file, 0, cached["size"])
+                print('[Main_Server_Output]Finshed.')
+                file_sha1 = cached["sha1"]
+            finally:
+                archive_cache.release(fingerprint)
+        else:
+            # 压缩到缓存的临时文件（每个会话独立，避免并发请求同一文件夹时冲突）；缓存关闭时用系统临时文件
+            cache_temp_path = archive_cache.begin_build(fingerprint)
+            if cache_temp_path is None:
+                zip_fd, zip_file_path = tempfile.mkstemp(prefix=folder_name + '_', suffix='.zip')
+                os.close(zip_fd)
+            else:
+                zip_file_path = cache_temp_path
+            committed = False
+            try:
+                print('[Main_Server_Output]压缩中...')
+                compress_folder(folder_path, zip_file_path)
+                print('\n[Main_Server_Output]压缩完成:'+zip_file_path)
+
+                # 发送压缩文件
+                print('[Main_Server_Output]Starting Send File...')
+                with open(zip_file_path, 'rb') as zip_file:
+                    print('[Main_Server_Output]Sending...')
+                    file_size = os.path.getsize(zip_file_path)
+                    client_socket.send(str(file_size).encode())
+                    # 边发送边计算压缩文件的SHA-1值
+                    sha1_hash = hashlib.sha1()
+                    send_file_data(client_socket, zip_file, 0, file_size, hasher=sha1_hash)
+                    file_sha1 = sha1_hash.hexdigest()
+                print('[Main_Server_Output]Finshed.')
+                if cache_temp_path is not None:
+                    archive_cache.commit(folder_path, fingerprint, cache_temp_path, file_size, file_sha1, level)
+                    committed = True
+            finally:
+                # 删除压缩文件
+                if cache_temp_path is None:
+                    os.remove(zip_file_path)
+                elif not committed:
+                    archive_cache.abort(fingerprint, cache_temp_path)
+
+    # 将SHA-1值发送给客户端
+    print('[Main_Server_Output]Sending SHA-1...')
+    client_socket.send(file_sha1.encode())
+    print('[Main_Server_Output]SHA-1 sent :' + file_sha1)
+
+
+def folder_fingerprint(folder_path, level):
+    """由相对路径、大小、mtime 和压缩级别计算文件夹指纹，任何文件变化都会改变指纹"""
+    sha1_hash = hashlib.sha1(('v1|' + str(level)).encode())
+    for root, dirs, files in os.walk(folder_path):
+        dirs.sort()
+        for file in sorted(files):
+            file_path = os.path.join(root, file)
+            file_stat = os.stat(file_path)
+            rel_path = os.path.relpath(file_path, folder_path).replace(os.sep, '/')
+            sha1_hash.update('{}\0{}\0{}\n'.format(rel_path, file_stat.st_size, file_stat.st_mtime_ns).encode('utf-8'))
+    return sha1_hash.hexdigest()
+
+
+class TeeWriter:
+    """把同一份数据写入多个输出（如同时发给客户端并写入缓存）"""
+    def __init__(self, *outputs):
+        self.outputs = outputs
+
+    def write(self, data):
+        for output in self.outputs:
+            output.write(data)
+        return len(data)
+
+
+class ArchiveCache:
+    """
+    文件夹压缩包缓存，以文件夹指纹为键。
+    - 总大小超过上限时按最近最少使用淘汰，正在被读取的压缩包不会被删除；
+    - 同一文件夹指纹变化时旧压缩包立即失效；
+    - 索引持久化到缓存目录的 index.json。
+    """
+    def __init__(self, cache_dir, max_bytes):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.index_path = os.path.join(cache_dir, 'index.json')
+        self.entries = OrderedDict()  # 指纹 -> {"size", "sha1"}
+        self.folders = {}             # 文件夹路径|压缩级别 -> 当前指纹
+        self.readers = {}             # 指纹 -> 正在读取的会话数
+        self.stale = set()            # 已失效但仍有读取者、待释放后删除的指纹
+        self.building = set()
+        self.lock = Lock()
+        if self.max_bytes > 0:
+            os.makedirs(cache_dir, exist_ok=True)
+            self.load()
+
+    def path_for(self, fingerprint):
+        return os.path.join(self.cache_dir, fingerprint + '.zip')
+
+    @staticmethod
+    def folder_key(folder_path, level):
+        # 同一文件夹不同压缩级别的压缩包各自缓存
+        return os.path.abspath(folder_path) + '|' + str(level)
+
+    def acquire(self, folder_path, fingerprint, level):
+        """查找缓存，命中时增加读取计数并返回条目，调用方用完后必须 release"""
+        folder_key = self.folder_key(folder_path, level)
+        with self.lock:
+            old_fingerprint = self.folders.get(folder_key)
+            if old_fingerprint is not None and old_fingerprint != fingerprint:
+                # 文件夹内容已变化，旧压缩包作废
+                del self.folders[folder_key]
+                self._discard(old_fingerprint)
+            entry = self.entries.get(fingerprint)
+            if entry is None:
+                return None
+            self.entries.move_to_end(fingerprint)
+            self.readers[fingerprint] = self.readers.get(fingerprint, 0) + 1
+            return entry
+
+    def release(self, fingerprint):
+        with self.lock:
+            self.readers[fingerprint] -= 1
+            if self.readers[fingerprint] == 0:
+                del self.readers[fingerprint]
+                if fingerprint in self.stale:
+                    self.stale.discard(fingerprint)
+                    self._remove_file(fingerprint)
+
+    def begin_build(self, fingerprint):
+        """开始构建缓存条目，返回临时文件路径；缓存关闭或其他会话正在构建同一指纹时返回 None"""
+        if self.max_bytes <= 0:
+            return None
+        with self.lock:
+            if fingerprint in self.building or fingerprint in self.entries:
+                return None
+            self.building.add(fingerprint)
+        return self.path_for(fingerprint) + '.tmp.' + str(get_ident())
+
+    def commit(self, folder_path, fingerprint, temp_path, size, sha1, level):
+        # 压缩期间文件夹被修改过则不缓存
+        if folder_fingerprint(folder_path, level) != fingerprint or size > self.max_bytes:
+            self.abort(fingerprint, temp_path)
+            return
+        os.replace(temp_path, self.path_for(fingerprint))
+        with self.lock:
+            self.building.discard(fingerprint)
+            self.entries[fingerprint] = {"size": size, "sha1": sha1}
+            self.folders[self.folder_key(folder_path, level)] = fingerprint
+            self._evict()
+        self.save()
+
+    def abort(self, fingerprint, temp_path):
+        with self.lock:
+            self.building.discard(fingerprint)
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+
+    def _discard(self, fingerprint):
+        if self.entries.pop(fingerprint, None) is None:
+            return
+        if fingerprint in self.readers:
+            self.stale.add(fingerprint)
+        else:
+            self._remove_file(fingerprint)
+
+    def _evict(self):
+        total = sum(entry["size"] for entry in self.entries.values())
+        for fingerprint in list(self.entries):
+            if total <= self.max_bytes:
+                break
+            if fingerprint in self.readers:
+                continue
+            total -= self.entries.pop(fingerprint)["size"]
+            self._remove_file(fingerprint)
+        live = set(self.entries)
+        self.folders = {folder: fp for folder, fp in self.folders.items() if fp in live}
+
+    def _remove_file(self, fingerprint):
+        try:
+            os.remove(self.path_for(fingerprint))
+        except OSError:
+            pass
+
+    def load(self):
+        try:
+            with open(self.index_path, 'r', encoding='utf-8') as index_file:
+                index = json.load(index_file)
+        except (OSError, ValueError):
+            index = {"entries": [], "folders": {}}
+        for fingerprint, size, sha1 in index["entries"]:
+            path = self.path_for(fingerprint)
+            if os.path.exists(path) and os.path.getsize(path) == size:
+                self.entries[fingerprint] = {"size": size, "sha1": sha1}
+        self.folders = {folder: fp for folder, fp in index["folders"].items() if fp in self.entries}
+        # 清理索引之外的残留文件（包括上次异常退出留下的临时文件）
+        for name in os.listdir(self.cache_dir):
+            if name != 'index.json' and name[:-4] not in self.entries:
+                try:
+                    os.remove(os.path.join(self.cache_dir, name))
+                except OSError:
+                    pass
+        self._evict()
+
+    def save(self):
+        with self.lock:
+            index = {"entries": [[fp, entry["size"], entry["sha1"]] for fp, entry in self.entries.items()],
+                     "folders": dict(self.folders)}
+        try:
+            temp_path = self.index_path + '.tmp.' + str(get_ident())
+            with open(temp_path, 'w', encoding='utf-8') as index_file:
+                json.dump(index, index_file)
+            os.replace(temp_path, self.index_path)
+        except OSError as e:
+            print('[Main_Server_Output]Archive cache save ERROR:' + str(e))
+
+
+class DirectoryIndex:
+    """
+    共享文件夹的目录列表缓存，避免每次 LIST 都遍历并 stat 整个目录。
+    目录自身的 mtime 变化（条目增删、重命名）时立即重新扫描；
+    条目的大小和修改时间最多缓存 ttl 秒。
+    """
+    def __init__(self, ttl, max_dirs=256):
+        self.ttl = ttl
+        self.max_dirs = max_dirs
+        self.dirs = OrderedDict()  # 目录路径 -> (目录 mtime_ns, 扫描时间, 条目列表, 名称列表)
+        self.lock = Lock()
+
+    def listing(self, dir_path):
+        """返回按名称排序的 (条目列表, 名称列表)，两者都不可修改"""
+        dir_mtime = os.stat(dir_path).st_mtime_ns
+        now = time.monotonic()
+        with self.lock:
+            cached = self.dirs.get(dir_path)
+            if cached is not None and cached[0] == dir_mtime and now - cached[1] < self.ttl:
+                self.dirs.move_to_end(dir_path)
+                return cached[2], cached[3]
+        entries = self.scan(dir_path)
+        names = [entry["name"] for entry in entries]
+        with self.lock:
+            self.dirs[dir_path] = (dir_mtime, now, entries, names)
+            self.dirs.move_to_end(dir_path)
+            while len(self.dirs) > self.max_dirs:
+                self.dirs.popitem(last=False)
+        return entries, names
+
+    @staticmethod
+    def scan(dir_path):
+        entries = []
+        with os.scandir(dir_path) as iterator:
+            for entry in iterator:
+                try:
+                    is_dir = entry.is_dir()
+                    entry_stat = entry.stat()
+                except OSError:
+                    continue
+                entries.append({"name": entry.name, "type": "dir" if is_dir else "file",
+                                "size": None if is_dir else entry_stat.st_size,
+                                "mtime_ns": entry_stat.st_mtime_ns})
+        entries.sort(key=lambda entry: entry["name"])
+        return entries
+
+    def query(self, dir_path, prefix=None, pattern=None):
+        """按名称前缀（二分查找）和通配符过滤目录条目"""
+        entries, names = self.listing(dir_path)
+        if prefix:
+            start = bisect.bisect_left(names, prefix)
+            end = start
+            while end < len(names) and names[end].startswith(prefix):
+                end += 1
+            entries = entries[start:end]
+        if pattern:
+            entries = [entry for entry in entries if fnmatch.fnmatch(entry["name"], pattern)]
+        return entries
+
+
+def resolve_served_path(name):
+    """
+    把客户端请求的名称解析为共享文件夹内的路径，拒绝 .. 或绝对路径等越界访问。
+    输出:
+    - 绝对路径；越界时抛出 RequestError
+    """
+    root = os.path.realpath(server_files_folder)
+    path = os.path.realpath(os.path.join(root, name))
+    if path != root and not path.startswith(root.rstrip(os.sep) + os.sep):
+        raise RequestError('非法路径: ' + name)
+    return path
+
+
+# ---------------- 指标 ----------------
+# 服务端和客户端共用一个进程内的指标表：计数器、仪表、直方图，以及最近若干个阶段（span）的明细。
+# 服务端配置 admin_port 后可在本机通过 HTTP 读取（Prometheus 文本格式或 JSON），客户端可在结束时写入 metrics_file。
+METRICS_PREFIX = 'ipv4files_'
+RECENT_SPANS = 500  # 保留的最近阶段明细条数
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 60, 300)  # 阶段耗时直方图的上界（秒）
+THROUGHPUT_BUCKETS = tuple(64 * 1024 * 4 ** i for i in range(8))  # 传输速度直方图的上界（字节/秒），64KB/s 到 1GB/s
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # 最后一格是超过所有上界的值
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        """[(上界, 不超过该上界的次数)]，最后一项上界为 +Inf"""
+        total = 0
+        result = []
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+
+class Metrics:
+    """
+    线程安全的指标表，名称不含 METRICS_PREFIX 前缀，标签以关键字参数传入。
+    阶段通过 span 记录：耗时进入 phase_seconds 直方图，带 bytes 的阶段同时记录传输速度，
+    并连同所属会话一起保存在最近阶段明细中，用于排查某一次传输为什么慢。
+    """
+    def __init__(self):
+        self.lock = Lock()
+        self.counters = {}    # (名称, 标签) -> 值
+        self.gauges = {}
+        self.histograms = {}
+        self.spans = deque(maxlen=RECENT_SPANS)
+        self.session_count = 0
+        self.current = local()  # 当前线程所属的会话
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        key = self._key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def value(self, name, **labels):
+        with self.lock:
+            return self.counters.get(self._key(name, labels), 0)
+
+    def add_gauge(self, name, value, **labels):
+        key = self._key(name, labels)
+        with self.lock:
+            self.gauges[key] = self.gauges.get(key, 0) + value
+
+    def observe(self, name, value, buckets=LATENCY_BUCKETS, **labels):
+        key = self._key(name, labels)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram(buckets)
+            histogram.observe(value)
+
+    def begin_session(self, role, peer):
+        """把当前线程标记为一个会话（role 为 server 或 client，peer 为对端地址）"""
+        with self.lock:
+            self.session_count += 1
+            self.current.session = {"id": self.session_count, "role": role, "peer": peer}
+        self.add_gauge('sessions_active', 1, role=role)
+
+    def end_session(self):
+        session = getattr(self.current, "session", None)
+        if session is not None:
+            self.add_gauge('sessions_active', -1, role=session["role"])
+            self.current.session = None
+
+    @contextmanager
+    def span(self, phase, **attributes):
+        """
+        记录一个阶段的耗时。返回的字典可以在阶段内补充属性，其中 bytes 用于计算传输速度。
+        阶段内抛出异常时记为 error 并原样抛出。
+        """
+        session = getattr(self.current, "session", None) or {"id": None, "role": "none", "peer": None}
+        record = dict(attributes)
+        status = 'ok'
+        start_time = time.time()
+        start = time.perf_counter()
+        try:
+            yield record
+        except BaseException:
+            status = 'error'
+            raise
+        finally:
+            seconds = time.perf_counter() - start
+            role = session["role"]
+            self.observe('phase_seconds', seconds, role=role, phase=phase)
+            if status == 'error':
+                self.inc('phase_errors_total', role=role, phase=phase)
+            if record.get("bytes") and seconds > 0:
+                self.observe('transfer_bytes_per_second', record["bytes"] / seconds, THROUGHPUT_BUCKETS,
+                             role=role, phase=phase)
+            record.update({"session": session["id"], "role": role, "peer": session["peer"], "phase": phase,
+                           "start": round(start_time, 3), "seconds": round(seconds, 6), "status": status})
+            with self.lock:
+                self.spans.append(record)
+
+    def snapshot(self):
+        """JSON 格式的全部指标和最近阶段明细"""
+        with self.lock:
+            return {
+                "counters": [{"name": name, "labels": dict(labels), "value": value}
+                             for (name, labels), value in sorted(self.counters.items())],
+                "gauges": [{"name": name, "labels": dict(labels), "value": value}
+                           for (name, labels), value in sorted(self.gauges.items())],
+                "histograms": [{"name": name, "labels": dict(labels), "count": histogram.count,
+                                "sum": histogram.sum,
+                                "buckets": [[None if bound == float('inf') else bound, count]
+                                            for bound, count in histogram.cumulative()]}
+                               for (name, labels), histogram in sorted(self.histograms.items())],
+                "recent_spans": list(self.spans),
+            }
+
+    def prometheus_text(self):
+        """Prometheus 文本格式（0.0.4）"""
+        lines = []
+
+        def format_labels(labels, extra=()):
+            pairs = list(labels) + list(extra)
+            if not pairs:
+                return ''
+            return '{' + ','.join('{}="{}"'.format(key, str(value).replace('\\', '\\\\').replace('"', '\\"')
+                                                    .replace('\n', '\\n')) for key, value in pairs) + '}'
+
+        with self.lock:
+            for kind, table in (('counter', self.counters), ('gauge', self.gauges)):
+                typed = set()
+                for (name, labels), value in sorted(table.items()):
+                    if name not in typed:
+                        lines.append('# TYPE {}{} {}'.format(METRICS_PREFIX, name, kind))
+                        typed.add(name)
+                    lines.append('{}{}{} {}'.format(METRICS_PREFIX, name, format_labels(labels), value))
+            typed = set()
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                if name not in typed:
+                    lines.append('# TYPE {}{} histogram'.format(METRICS_PREFIX, name))
+                    typed.add(name)
+                for bound, count in histogram.cumulative():
+                    lines.append('{}{}_bucket{} {}'.format(METRICS_PREFIX, name, format_labels(
+                        labels, [("le", '+Inf' if bound == float('inf') else repr(bound))]), count))
+                lines.append('{}{}_sum{} {}'.format(METRICS_PREFIX, name, format_labels(labels), histogram.sum))
+                lines.append('{}{}_count{} {}'.format(METRICS_PREFIX, name, format_labels(labels), histogram.count))
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
+
+
+class SessionProfiler:
+    """
+    按会话采样的 cProfile：每 sample_every 个会话中对一个会话的线程启用 cProfile，结果累加。
+    只覆盖会话线程本身，线程池和压缩进程中的耗时不在其中。
+    """
+    def __init__(self, sample_every):
+        self.sample_every = sample_every
+        self.sessions = 0
+        self.sampled = 0
+        self.stats = None
+        self.lock = Lock()
+
+    def start(self):
+        """在会话线程开始时调用，被采样时返回已启用的 Profile，否则返回 None"""
+        with self.lock:
+            self.sessions += 1
+            if self.sessions % self.sample_every:
+                return None
+        import cProfile
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # Python 3.12 起同一时间只能有一个 cProfile 在运行，前一个被采样的会话还没结束
+            return None
+        return profile
+
+    def finish(self, profile):
+        import pstats
+        profile.disable()
+        with self.lock:
+            self.sampled += 1
+            if self.stats is None:
+                self.stats = pstats.Stats(profile)
+            else:
+                self.stats.add(profile)
+
+    def report(self, limit=40, reset=False):
+        with self.lock:
+            if self.stats is None:
+                return '尚无采样的会话（共 {} 个会话，每 {} 个采样一个）\n'.format(self.sessions, self.sample_every)
+            stream = io.StringIO()
+            stream.write('已采样 {} / {} 个会话\n'.format(self.sampled, self.sessions))
+            self.stats.stream = stream
+            self.stats.sort_stats('cumulative').print_stats(limit)
+            if reset:
+                self.stats = None
+                self.sampled = 0
+            return stream.getvalue()
+
+
+session_profiler = None
+
+
+def tracemalloc_report(limit=30):
+    """当前内存分配最多的代码位置"""
+    if not tracemalloc.is_tracing():
+        return '未启用 tracemalloc（在 server_config.ini 中设置 tracemalloc_frames）\n'
+    current, peak = tracemalloc.get_traced_memory()
+    snapshot = tracemalloc.take_snapshot().filter_traces((
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, '<frozen importlib._bootstrap*>'),
+    ))
+    lines = ['当前 {:.1f} MB，峰值 {:.1f} MB'.format(current / 1024 / 1024, peak / 1024 / 1024)]
+    lines += [str(stat) for stat in snapshot.statistics('lineno')[:limit]]
+    return '\n'.join(lines) + '\n'
+
+
+def start_admin_server(port):
+    """在后台线程中启动管理端口，返回 HTTP 服务器对象（退出时调用 shutdown）"""
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class AdminRequestHandler(BaseHTTPRequestHandler):
+        """
+        管理端口（只监听本机）：
+        /metrics       Prometheus 文本格式
+        /metrics.json  JSON 格式，含最近阶段明细
+        /profile       cProfile 采样结果，?reset=1 读取后清空
+        /tracemalloc   内存分配最多的代码位置
+        """
+        def do_GET(self):
+            path, _, query = self.path.partition('?')
+            content_type = 'text/plain; charset=utf-8'
+            if path == '/metrics':
+                body = metrics.prometheus_text()
+                content_type = 'text/plain; version=0.0.4; charset=utf-8'
+            elif path == '/metrics.json':
+                body = json.dumps(metrics.snapshot(), ensure_ascii=False)
+                content_type = 'application/json; charset=utf-8'
+            elif path == '/profile':
+                if session_profiler is None:
+                    body = '未启用采样（在 server_config.ini 中设置 profile_sample）\n'
+                else:
+                    body = session_profiler.report(reset='reset=1' in query)
+            elif path == '/tracemalloc':
+                body = tracemalloc_report()
+            else:
+                self.send_error(404)
+                return
+            data = body.encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, format, *args):
+            # 不把每次抓取都打印到服务端控制台
+            pass
+
+    admin_server = ThreadingHTTPServer(('127.0.0.1', port), AdminRequestHandler)
+    admin_server.daemon_threads = True
+    Thread(target=admin_server.serve_forever, daemon=True).start()
+    return admin_server
+
+
+def write_metrics_file(path):
+    """把指标快照写入 JSON 文件（客户端结束时使用）"""
+    with open(path, 'w', encoding='utf-8') as file:
+        json.dump(metrics.snapshot(), file, ensure_ascii=False, indent=2)
+
+
+# ---------------- 限速 ----------------
+# 服务端配置了总上传速度或每个客户端的速度上限时，会话使用 ThrottledSocket 代替客户端套接字，
+# 每次发送前按块（见 throttle_quantum）向限速器申请额度。限速器按令牌桶计算速度：
+# 额度不足时申请排队，同一优先级内按到达顺序轮流发放，每块大小相同，因此各会话平分带宽；
+# 列表、元数据等控制消息和小文件排在大传输前面，但为避免大传输饿死，每发放
+# SMALL_TRANSFER_WEIGHT 块小传输的额度后，若有大传输在等待则先发放一块给它。
+BANDWIDTH_BURST = 0.05         # 空闲后令牌桶最多积累的额度（秒），即允许的突发长度
+SMALL_TRANSFER_WEIGHT = 4      # 大小传输都在等待时，每块大传输之前最多发放的小传输块数
+
+
+class BandwidthLimiter:
+    """
+    令牌桶限速器，rate 为字节/秒。
+    额度可以透支：排在队首的申请只要桶内余额不为负就立即发放，透支的部分由之后的申请等待偿还，
+    因此单次申请的大小不受桶容量限制。小传输还可以再多透支一个桶容量，不必等大传输刚透支的额度还清。
+    """
+    def __init__(self, rate):
+        self.rate = rate
+        self.burst = rate * BANDWIDTH_BURST
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.condition = Condition()
+        self.queues = (deque(), deque())  # 小传输、大传输的等待队列
+        self.small_streak = 0             # 上次发放给大传输之后连续发放给小传输的次数
+
+    def _next_queue(self):
+        small, bulk = self.queues
+        if small and (not bulk or self.small_streak < SMALL_TRANSFER_WEIGHT):
+            return small
+        return bulk
+
+    def acquire(self, size, bulk=False):
+        """等到轮到这次申请且桶内余额不为负时扣除 size 字节的额度"""
+        ticket = object()
+        floor = 0 if bulk else -self.burst
+        with self.condition:
+            queue = self.queues[bulk]
+            queue.append(ticket)
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self._next_queue()[0] is ticket:
+                    if self.tokens >= floor:
+                        break
+                    # 队首等待余额回到可发放的水平，其余申请等待队首发放后的通知
+                    self.condition.wait((floor - self.tokens) / self.rate)
+                else:
+                    self.condition.wait()
+            queue.popleft()
+            self.small_streak = 0 if bulk else self.small_streak + 1
+            self.tokens -= size
+            self.condition.notify_all()
+
+
+class ThrottledSocket:
+    """限速时代替客户端套接字：发送的数据按块向各限速器申请额度后再发出，其余操作交给原套接字"""
+    def __init__(self, sock, limiters, quantum, small_size):
+        self.sock = sock
+        self.limiters = limiters
+        self.quantum = quantum
+        self.small_size = small_size
+        self.bulk = False  # 当前传输是否按大传输排队，见 mark_transfer_size
+
+    def __getattr__(self, name):
+        return getattr(self.sock, name)
+
+    def _acquire(self, size):
+        for limiter in self.limiters:
+            limiter.acquire(size, self.bulk)
+
+    def send(self, data):
+        data = memoryview(data)[:self.quantum]
+        self._acquire(len(data))
+        return self.sock.send(data)
+
+    def sendall(self, data):
+        view = memoryview(data).cast('B')
+        for start in range(0, len(view), self.quantum):
+            chunk = view[start:start + self.quantum]
+            self._acquire(len(chunk))
+            self.sock.sendall(chunk)
+
+    def sendfile(self, file, offset=0, count=None):
+        """与 socket.sendfile 相同，按块申请额度后零拷贝发送"""
+        if count is None:
+            count = os.fstat(file.fileno()).st_size - offset
+        sent = 0
+        while sent < count:
+            length = min(self.quantum, count - sent)
+            self._acquire(length)
+            n = self.sock.sendfile(file, offset + sent, length)
+            if not n:
+                break
+            sent += n
+        return sent
+
+
+def throttle_quantum(rate):
+    """每次申请额度的块大小：约 20ms 的数据量，块越小各会话轮转越快、控制消息等待越短"""
+    return max(4 * 1024, min(256 * 1024, int(rate / 50)))
+
+
+class TransferScheduler:
+    """
+    按 server_options 创建总限速器和每个客户端（按 IP，同一客户端的多个连接共用）的限速器，
+    为会话包装套接字。都不限速时套接字原样使用。
+    """
+    def __init__(self, rate, client_rate, small_size):
+        self.limiter = BandwidthLimiter(rate) if rate > 0 else None
+        self.client_rate = client_rate
+        self.small_size = small_size
+        self.clients = {}  # IP -> [限速器, 使用中的连接数]
+        self.lock = Lock()
+
+    def open(self, sock, client_ip):
+        """返回会话使用的套接字，会话结束后须调用 close(client_ip)"""
+        limiters = [] if self.limiter is None else [self.limiter]
+        if self.client_rate > 0:
+            with self.lock:
+                client = self.clients.setdefault(client_ip, [BandwidthLimiter(self.client_rate), 0])
+                client[1] += 1
+            limiters.insert(0, client[0])
+        if not limiters:
+            return sock
+        quantum = throttle_quantum(min(limiter.rate for limiter in limiters))
+        return ThrottledSocket(sock, limiters, quantum, self.small_size)
+
+    def close(self, client_ip):
+        if self.client_rate > 0:
+            with self.lock:
+                client = self.clients[client_ip]
+                client[1] -= 1
+                if not client[1]:
+                    del self.clients[client_ip]
+
+
+def mark_transfer_size(sock, size):
+    """告诉限速器接下来要发送的传输大小（None 表示未知），超过 small_transfer_kb 的按大传输排队"""
+    if isinstance(sock, ThrottledSocket):
+        sock.bulk = size is None or size > sock.small_size
+
+
+def is_protocol_handshake(data):
+    """
+    客户端发来的第一段数据是否为分帧协议的握手：PROTOCOL_MAGIC 加 1 字节版本号。
+    版本号是控制字符，旧版客户端发来的文件名不会以“IV4F”加控制字符开头。
+    """
+    return len(data) > len(PROTOCOL_MAGIC) and data.startswith(PROTOCOL_MAGIC) and data[len(PROTOCOL_MAGIC)] < 0x20
+
+
+def handle_client(client_socket, client_address):
+    """
+    处理单个客户端会话（在独立线程中运行）。
+    旧版客户端连接后不发送任何数据、一直等待文件列表，所以先立即发送文件列表，
+    再按客户端发来的第一段数据选择协议：以握手开头的是新版客户端，否则是旧版客户端请求的名称。
+    新版客户端连接后立即发送握手，握手在发送列表之前就已到达时只发送空列表。
+    输入:
+    - client_socket: 已连接的客户端套接字
+    - client_address: 客户端地址
+    """
+    handshake_arrived = select.select([client_socket], [], [], 0)[0]
+    send_legacy_greeting(client_socket, [] if handshake_arrived else None)
+    first = client_socket.recv(buf_size)
+    # 握手可能分几段到达；只有收到的恰好是握手的开头时才等待其余部分（旧版客户端的名称是一次发出的）
+    while first and len(first) <= len(PROTOCOL_MAGIC) and PROTOCOL_MAGIC.startswith(first):
+        if not select.select([client_socket], [], [], float(server_options["legacy_detect_timeout"]))[0]:
+            break
+        more = client_socket.recv(buf_size)
+        if not more:
+            break
+        first += more
+    if not first:
+        return
+    if not is_protocol_handshake(first):
+        metrics.inc('sessions_total', role='server', protocol='legacy')
+        handle_legacy_session(client_socket, client_address, first.decode())
+        return
+    metrics.inc('sessions_total', role='server', protocol='framed')
+    connection = FramedConnection(client_socket, 'server')
+    connection.tuner = SocketTuner(client_socket, server_options, "io_block_kb", '[Main_Server_Output]')
+    connection.recv_buffer += first[len(PROTOCOL_MAGIC) + 1:]
+    connection.version = min(first[len(PROTOCOL_MAGIC)], PROTOCOL_VERSION)
+    client_socket.sendall(PROTOCOL_MAGIC + bytes([connection.version]))
+    print('[Main_Server_Output]Framed protocol v' + str(connection.version))
+    handle_framed_session(connection, client_address)
+
+
+def handle_framed_session(connection, client_address):
+    """
+    分帧协议会话：循环读取请求帧并按顺序处理，直到客户端发送 BYE 或断开。
+    客户端可以不等响应连续发送多个请求（流水线），响应按请求顺序返回并带有请求 ID。
+    """
+    while True:
+        frame = connection.recv_frame()
+        if frame is None or frame[0] == MSG_BYE:
+            return
+        msg_type, request_id, payload = frame
+        handler = FRAMED_HANDLERS.get(msg_type)
+        if handler is None:
+            connection.send_json(MSG_ERROR, request_id, {"message": "不支持的消息类型: " + str(msg_type)})
+            continue
+        try:
+            with metrics.span(REQUEST_PHASES[msg_type]):
+                request = json.loads(payload.decode('utf-8')) if payload else {}
+                if not isinstance(request, dict):
+                    raise RequestError('请求内容必须是 JSON 对象')
+                if "rtt_ms" in request:
+                    connection.tuner.note_rtt(float(request["rtt_ms"]) / 1000)
+                handler(connection, request_id, request)
+        except REQUEST_ERRORS as e:
+            # 尚未开始发送数据前的错误只影响当前请求，会话继续
+            if connection.response_started:
+                raise
+            print('[Main_Server_Output]Request ERROR:' + str(e))
+            connection.send_json(MSG_ERROR, request_id, {"message": str(e)})
+        finally:
+            connection.response_started = False
+            mark_transfer_size(connection.sock, 0)
+
+
+def handle_list_request(connection, request_id, request):
+    """
+    LIST：返回共享文件夹（或其中的子文件夹 path）的条目。
+    可按 prefix/glob 过滤，并用 offset/limit 只取一页；v1 客户端只收到名称列表。
+    """
+    path = request.get("path", "")
+    entries = directory_index.query(resolve_served_path(path), request.get("prefix"), request.get("glob"))
+    offset = int(request.get("offset", 0))
+    limit = request.get("limit")
+    page = entries[offset:None if limit is None else offset + int(limit)]
+    if connection.version < 2:
+        connection.send_json(MSG_LIST, request_id, {"entries": [entry["name"] for entry in page]})
+    else:
+        connection.send_json(MSG_LIST, request_id, {"path": path, "total": len(entries), "offset": offset,
+                                                    "entries": page})
+    print('[Main_Server_Output]Files list sent!')
+
+
+def handle_get_request(connection, request_id, request):
+    """
+    GET：发送 META，随后是 DATA 帧，最后以 DIGEST 帧结束。
+    普通文件支持区间请求：{"offset", "length", "range_digest", "full_digest", "expect": {"size", "mtime_ns"}}。
+    """
+    send_get_response(connection, request_id, request["name"], request)
+
+
+def handle_batch_request(connection, request_id, request):
+    """
+    BATCH：按顺序连续发送多个条目，每一项的响应与 GET 相同，META 中带有该项在 "names" 中的下标 "index"。
+    某一项在开始发送之前出错时发送带 "index" 的 ERROR 帧并继续下一项。
+    """
+    names = request["names"]
+    if not isinstance(names, list) or not all(isinstance(name, str) for name in names):
+        raise RequestError('BATCH 的 names 必须是名称列表')
+    print('[Main_Server_Output]BATCH ' + str(len(names)) + ' items')
+    for index, name in enumerate(names):
+        connection.response_started = False
+        mark_transfer_size(connection.sock, 0)
+        try:
+            send_get_response(connection, request_id, name, request, index)
+        except REQUEST_ERRORS as e:
+            if connection.response_started:
+                raise
+            print('[Main_Server_Output]Request ERROR:' + str(e))
+            metrics.inc('phase_errors_total', role='server', phase='batch_item')
+            connection.send_json(MSG_ERROR, request_id, {"message": str(e), "index": index})
+
+
+def send_get_response(connection, request_id, name, request, index=None):
+    """发送一个条目的 GET 响应（META、DATA/ZDATA 帧、DIGEST），index 不为 None 时写入 META（批量下载）"""
+    path = resolve_served_path(name)
+    method, level = choose_transport_compression(request)
+    if method is None:
+        sink = DataFrameSink(connection, request_id)
+    else:
+        print('[Main_Server_Output]Compression:' + method + ' level ' + str(level))
+        sink = CompressedFrameSink(connection, request_id, get_transport_compressor(connection, method, level))
+    if os.path.isdir(path):
+        print('[Main_Server_Output]GET ' + name + ' Mode:ZIP')
+
+        def announce(size):
+            mark_transfer_size(connection.sock, size)
+            meta = {"name": name, "mode": "ZIP", "size": size}
+            if index is not None:
+                meta["index"] = index
+            if method is not None:
+                meta["compression"] = method
+            connection.send_json(MSG_META, request_id, meta)
+            connection.response_started = True
+
+        # 传输层压缩时 ZIP 只打包不压缩，由传输层按链路速度决定是否压缩
+        with metrics.span('archive', name=name) as span:
+            file_sha1 = send_folder_archive(path, sink, announce, level=None if method is None else 0)
+            span["bytes"] = sink.bytes_written
+        metrics.inc('bytes_sent_total', sink.bytes_written, mode='ZIP')
+        connection.send_json(MSG_DIGEST, request_id, {"sha1": file_sha1})
+        print('[Main_Server_Output]SHA-1 sent :' + file_sha1)
+    else:
+        print('[Main_Server_Output]GET ' + name + ' Mode:FILE')
+        file_stat = os.stat(path)
+        offset = int(request.get("offset", 0))
+        expect = request.get("expect")
+        if expect and (expect.get("size") != file_stat.st_size or expect.get("mtime_ns") != file_stat.st_mtime_ns):
+            # 客户端续传的是旧版本文件，改为从头发送
+            offset = 0
+        length = request.get("length")
+        length = file_stat.st_size - offset if length is None else int(length)
+        if offset < 0 or length < 0 or offset + length > file_stat.st_size:
+            raise RequestError('请求的范围超出文件大小')
+        if offset or length != file_stat.st_size:
+            print('[Main_Server_Output]Range:' + str(offset) + '+' + str(length))
+        meta = {"name": name, "mode": "FILE", "size": file_stat.st_size, "mtime_ns": file_stat.st_mtime_ns,
+                "offset": offset, "length": length}
+        if index is not None:
+            meta["index"] = index
+        if method is not None:
+            meta["compression"] = method
+        # 客户端支持哈希树时选择双方都支持的第一个算法
+        algorithm = next((a for a in request.get("hash_algorithms", []) if a in HASH_ALGORITHMS), None)
+        if algorithm is not None:
+            meta["tree"] = load_hash_tree(path, file_stat, algorithm,
+                                          int(server_options["hash_tree_chunk_kb"]) * 1024)
+        mark_transfer_size(connection.sock, length)
+        connection.send_json(MSG_META, request_id, meta)
+        connection.response_started = True
+        with metrics.span('send', name=name, bytes=length):
+            range_sha1, file_sha1 = send_file_range(
+                sink, path, file_stat, offset, length,
+                range_digest=bool(request.get("range_digest")), file_digest=bool(request.get("full_digest")))
+        metrics.inc('bytes_sent_total', length, mode='FILE')
+        connection.send_json(MSG_DIGEST, request_id, {"sha1": file_sha1, "range_sha1": range_sha1})
+        print('[Main_Server_Output]SHA-1 sent :' + str(file_sha1))
+    if method is not None:
+        metrics.inc('compression_input_bytes_total', sink.bytes_written, method=method)
+        metrics.inc('compression_output_bytes_total', sink.wire_bytes, method=method)
+        metrics.inc('compression_seconds_total', sink.compress_seconds, method=method)
+        print('[Main_Server_Output]Compressed ' + str(sink.bytes_written) + ' -> ' + str(sink.wire_bytes) + ' bytes')
+
+
+def handle_stat_request(connection, request_id, request):
+    """STAT：只返回文件或文件夹的元数据（分段下载前用来获取文件大小和服务端的空闲会话名额）"""
+    name = request["name"]
+    path = resolve_served_path(name)
+    file_stat = os.stat(path)
+    if os.path.isdir(path):
+        body = {"name": name, "mode": "ZIP", "size": None, "mtime_ns": file_stat.st_mtime_ns, "sha1": None}
+    else:
+        body = {"name": name, "mode": "FILE", "size": file_stat.st_size, "mtime_ns": file_stat.st_mtime_ns,
+                "sha1": digest_cache.get(path, file_stat), "free_sessions": session_slots.free()}
+    connection.send_json(MSG_META, request_id, body)
+
+
+def handle_delta_request(connection, request_id, request):
+    """
+    DELTA：请求后紧跟一个 DATA 帧，内容是客户端旧版本的块签名。
+    响应 META 后用 COPY 帧（复用客户端已有的块）和 DATA 帧（新数据）描述新版本，最后以 DIGEST 帧结束。
+    """
+    # 先读走签名帧，这样请求出错时会话仍能继续
+    frame = connection.recv_frame()
+    if frame is None:
+        raise ConnectionError('连接在消息中途断开')
+    msg_type, signature_id, signature_data = frame
+    if msg_type != MSG_DATA or signature_id != request_id:
+        raise ProtocolError('DELTA 请求缺少块签名')
+    name = request["name"]
+    path = resolve_served_path(name)
+    if os.path.isdir(path):
+        raise RequestError('文件夹不支持增量传输: ' + name)
+    block_size = int(request["block_size"])
+    basis_size = int(request["size"])
+    if not 0 < block_size <= MAX_FRAME_PAYLOAD or \
+            len(signature_data) != -(-basis_size // block_size) * DELTA_SIGNATURE.size:
+        raise RequestError('块签名与块大小不符')
+    print('[Main_Server_Output]GET ' + name + ' Mode:DELTA')
+    file_stat = os.stat(path)
+    mark_transfer_size(connection.sock, file_stat.st_size)
+    connection.send_json(MSG_META, request_id, {
+        "name": name, "mode": "DELTA", "size": file_stat.st_size, "mtime_ns": file_stat.st_mtime_ns})
+    connection.response_started = True
+    file_sha1, literal_size, copied_size = send_file_delta(
+        connection, request_id, path, block_size, basis_size, signature_data)
+    metrics.inc('bytes_sent_total', literal_size, mode='DELTA')
+    metrics.inc('delta_reused_bytes_total', copied_size)
+    if DigestCache.make_key(path, os.stat(path)) == DigestCache.make_key(path, file_stat):
+        digest_cache.put(path, file_stat, file_sha1)
+    connection.send_json(MSG_DIGEST, request_id, {"sha1": file_sha1})
+    print('[Main_Server_Output]Delta: {} bytes sent, {} bytes reused'.format(literal_size, copied_size))
+    print('[Main_Server_Output]SHA-1 sent :' + file_sha1)
+
+
+def handle_manifest_request(connection, request_id, request):
+    """MANIFEST：返回文件夹内所有文件的相对路径、大小、修改时间和 SHA-1，供客户端增量同步"""
+    name = request["name"]
+    path = resolve_served_path(name)
+    if not os.path.isdir(path):
+        raise RequestError('不是文件夹: ' + name)
+    print('[Main_Server_Output]MANIFEST ' + name)
+    entries = []
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for file in sorted(files):
+            file_path = os.path.join(root, file)
+            try:
+                file_stat = os.stat(file_path)
+                file_sha1 = cached_file_digest(file_path, file_stat)
+            except OSError:
+                # 遍历期间被删除或无法读取的文件不出现在清单中
+                continue
+            entries.append({"path": os.path.relpath(file_path, path).replace(os.sep, '/'),
+                            "size": file_stat.st_size, "mtime_ns": file_stat.st_mtime_ns, "sha1": file_sha1})
+    connection.send_json(MSG_MANIFEST, request_id, {"name": name, "entries": entries})
+    print('[Main_Server_Output]Manifest sent: ' + str(len(entries)) + ' files')
+
+
+class SwarmTracker:
+    """
+    对等分发的登记表：文件版本（哈希树根摘要）-> 参与分发的客户端的对等服务地址及其块图，
+    以及服务端已经向其中的节点发出过的块。客户端定期重新登记，超过 ttl 秒没有登记的节点视为已离开。
+    """
+    def __init__(self, ttl, max_peers):
+        self.ttl = ttl
+        self.max_peers = max_peers
+        self.lock = Lock()
+        # 根摘要 -> {"peers": {地址: (块图, 最近登记时间)}, "chunk_size": 块大小, "served": 已发出的块的位图}
+        self.swarms = {}
+
+    def announce(self, root, address, chunk_map, leave=False, chunk_size=None):
+        """
+        登记（leave 为 True 时注销）一个节点；chunk_size 在首次登记（已读取哈希树）时传入。
+        输出:
+        - (其他节点 [{"address", "have"}], 服务端已发出的块的位图)；
+          其他节点随机选取最多 max_peers 个，避免所有客户端都挤向同样的节点
+        """
+        now = time.monotonic()
+        with self.lock:
+            swarm = self.swarms.setdefault(root, {"peers": {}, "chunk_size": None, "served": bytearray()})
+            swarm["chunk_size"] = swarm["chunk_size"] or chunk_size
+            peers = swarm["peers"]
+            for other, (_, seen) in list(peers.items()):
+                if now - seen > self.ttl:
+                    del peers[other]
+            if leave:
+                peers.pop(address, None)
+            else:
+                peers[address] = (chunk_map, now)
+            others = [{"address": other, "have": have} for other, (have, _) in peers.items() if other != address]
+            served = swarm["served"].hex()
+            if not peers:
+                del self.swarms[root]
+        random.shuffle(others)
+        return others[:self.max_peers], served
+
+    def note_served(self, root, offset):
+        """
+        服务端开始发送某一块：其他节点应等持有它的节点登记后向节点取，而不是再向服务端要一份。
+        输出:
+        - 该块此前是否没有发出过（不在登记表中的文件版本视为没有）
+        """
+        with self.lock:
+            swarm = self.swarms.get(root)
+            if swarm is None or not swarm["chunk_size"]:
+                return True
+            return set_chunk_bit(swarm["served"], offset // swarm["chunk_size"])
+
+
+swarm_tracker = None
+
+
+def handle_swarm_request(connection, request_id, request):
+    """
+    SWARM：登记为对等分发的节点并取得其他节点的块图。
+    首次登记不带 root，服务端计算（或读取缓存的）哈希树一并返回，客户端据此分块并校验从其他节点收到的每一块；
+    之后带上 root 定期重新登记，根摘要同时标识文件的版本，文件变化后新旧版本的节点不会混在一起。
+    """
+    if server_options["swarm"].lower() != 'true':
+        raise RequestError('服务端未开启对等分发')
+    name = request["name"]
+    root = request.get("root")
+    body = {"name": name}
+    chunk_size = None
+    if root is None:
+        path = resolve_served_path(name)
+        if not os.path.isfile(path):
+            raise RequestError('只能对普通文件进行对等分发: ' + name)
+        file_stat = os.stat(path)
+        algorithm = next((a for a in request.get("hash_algorithms", []) if a in HASH_ALGORITHMS), 'blake2b')
+        tree = load_hash_tree(path, file_stat, algorithm, int(server_options["hash_tree_chunk_kb"]) * 1024)
+        root = tree["root"]
+        chunk_size = tree["chunk_size"]
+        body.update(size=file_stat.st_size, mtime_ns=file_stat.st_mtime_ns, tree=tree)
+        print('[Main_Server_Output]SWARM ' + name)
+    # 对等服务的地址取服务端看到的客户端 IP，客户端不必知道自己在局域网中的地址
+    address = '{}:{}'.format(connection.sock.getpeername()[0], int(request["port"]))
+    body["peers"], body["served"] = swarm_tracker.announce(root, address, request.get("have", ''),
+                                                           bool(request.get("leave")), chunk_size)
+    connection.send_json(MSG_SWARM, request_id, body)
+
+
+def handle_chunk_request(connection, request_id, request):
+    """
+    CHUNK：以一个 DATA 帧发送普通文件的一段（对等分发中还没有其他节点持有的块向服务端取）。
+    带 "unserved_only" 时，该块已经发给过同一文件版本的其他节点则只回复 ERROR {"served": true}：
+    客户端的块图最多晚一个登记间隔，多个客户端同时开始时常会选中同一块，由服务端按实际发送情况去重。
+    """
+    name = request["name"]
+    path = resolve_served_path(name)
+    if not os.path.isfile(path):
+        raise RequestError('不是普通文件: ' + name)
+    file_stat = os.stat(path)
+    offset = int(request["offset"])
+    length = int(request["length"])
+    if offset < 0 or length <= 0 or length > MAX_FRAME_PAYLOAD or offset + length > file_stat.st_size:
+        raise RequestError('请求的区间超出文件范围: ' + name)
+    if "root" in request and not swarm_tracker.note_served(request["root"], offset) and \
+            request.get("unserved_only"):
+        connection.send_json(MSG_ERROR, request_id, {"message": "该块已发给其他节点", "served": True})
+        return
+    # 每块都不大，但属于整个文件的分发，按文件大小排队，不抢占列表等交互请求
+    mark_transfer_size(connection.sock, file_stat.st_size)
+    connection.response_started = True
+    with open(path, 'rb') as file, metrics.span('send', name=name, bytes=length):
+        DataFrameSink(connection, request_id, length).send_file(file, offset, length)
+    metrics.inc('bytes_sent_total', length, mode='CHUNK')
+
+
+# 分帧协议的请求类型 -> 指标中的阶段名
+REQUEST_PHASES = {
+    MSG_LIST: 'list',
+    MSG_GET: 'get',
+    MSG_STAT: 'stat',
+    MSG_DELTA: 'delta',
+    MSG_MANIFEST: 'manifest',
+    MSG_BATCH: 'batch',
+    MSG_SWARM: 'swarm',
+    MSG_CHUNK: 'chunk',
+}
+
+# 分帧协议的请求类型 -> 处理函数
+FRAMED_HANDLERS = {
+    MSG_LIST: handle_list_request,
+    MSG_GET: handle_get_request,
+    MSG_STAT: handle_stat_request,
+    MSG_DELTA: handle_delta_request,
+    MSG_MANIFEST: handle_manifest_request,
+    MSG_BATCH: handle_batch_request,
+    MSG_SWARM: handle_swarm_request,
+    MSG_CHUNK: handle_chunk_request,
+}
+
+
+def send_legacy_greeting(client_socket, file_list=None):
+    """
+    连接后立即发送的旧协议文件列表（以 <<EOF>> 结尾），file_list 为 None 时列出共享文件夹。
+    列表末尾多一个换行，表示本服务端支持分帧协议；旧版客户端按行分割列表时会忽略它。
+    """
+    if file_list is None:
+        file_list = directory_index.listing(os.path.realpath(server_files_folder))[1]
+        print('[Main_Server_Output]Files list sent!')
+    client_socket.sendall(''.join(name + '\n' for name in file_list).encode() + b'<<EOF>>')
+
+
+def handle_legacy_session(client_socket, client_address, folder_name):
+    """旧协议会话：文件列表已经发出，folder_name 是客户端请求的名称，发送该文件或文件夹后结束"""
+    # 判断是否是文件夹，是则压缩发送
+    folder_path = resolve_served_path(folder_name)
+    if os.path.isdir(folder_path):
+        mark_transfer_size(client_socket, None)
+        with metrics.span('legacy_archive', name=folder_name):
+            send_folder(client_socket, folder_name, folder_path)
+
+    else:
+        # 如果不是文件夹，则发送普通文件
+        client_socket.send(b'FILE')
+        print('[Main_Server_Output]Cilent Download Mode:NORMAL FILE')
+
+        # 发送文件大小
+        print('[Main_Server_Output]Sending File Size:')
+        file_stat = os.stat(folder_path)
+        mark_transfer_size(client_socket, file_stat.st_size)
+        client_socket.send(str(file_stat.st_size).encode())
+        print('[Main_Server_Output]Sent!')
+
+        # 发送文件内容，同时得到文件的SHA-1值
+        print('[Main_Server_Output]Starting Send File...')
+        print('[Main_Server_Output]Sending...')
+        with metrics.span('legacy_send', name=folder_name, bytes=file_stat.st_size):
+            file_sha1 = send_file_with_digest(RawSocketSink(client_socket), folder_path, file_stat)
+        metrics.inc('bytes_sent_total', file_stat.st_size, mode='LEGACY')
+        print('[Main_Server_Output]Finshed!')
+        # 将SHA-1值发送给客户端
+        print('[Main_Server_Output]Sending SHA-1...')
+        client_socket.send(file_sha1.encode())
+        print('[Main_Server_Output]SHA-1 sent :' + file_sha1)
+
+
+class SessionSlots:
+    """会话名额：达到 max_sessions 时不再 accept，新连接在内核队列中等待"""
+    def __init__(self, max_sessions):
+        self.semaphore = BoundedSemaphore(max_sessions)
+        self.lock = Lock()
+        self.max_sessions = max_sessions
+        self.active = 0
+
+    def acquire(self):
+        self.semaphore.acquire()
+        with self.lock:
+            self.active += 1
+
+    def release(self):
+        with self.lock:
+            self.active -= 1
+        self.semaphore.release()
+
+    def free(self):
+        """当前空闲的名额数（只是参考值，随时可能被其他连接占用）"""
+        with self.lock:
+            return self.max_sessions - self.active
+
+
+session_slots = None
+
+
+class ClientSessionThread(Thread):
+    """每个客户端连接对应一个会话线程，会话内的异常只影响该连接"""
+    def __init__(self, client_socket, client_address, session_slots):
+        super(ClientSessionThread, self).__init__(daemon=True)
+        self.client_socket = client_socket
+        self.client_address = client_address
+        self.session_slots = session_slots
+
+    def run(self):
+        client_ip = self.client_address[0]
+        metrics.begin_session('server', client_ip)
+        profile = session_profiler.start() if session_profiler is not None else None
+        try:
+            self.client_socket.settimeout(int(server_options["session_timeout"]) or None)
+            configure_socket(self.client_socket, server_options, connected=True)
+            with metrics.span('session'):
+                handle_client(transfer_scheduler.open(self.client_socket, client_ip), self.client_address)
+        except Exception as e:
+            print('[Main_Server_Output]Session ERROR ' + client_ip + ':' + str(e))
+        finally:
+            if profile is not None:
+                session_profiler.finish(profile)
+            metrics.end_session()
+            transfer_scheduler.close(client_ip)
+            self.client_socket.close()
+            # 释放会话名额，让等待中的客户端被接受
+            self.session_slots.release()
+            print('[Main_Server_Output]Cilent '+self.client_address[0]+' losted contiune')
+
+
+def run_server(options=None):
+    """启动服务端并一直接受连接；options 为已读出的配置项（无交互模式），None 时读取 server_config.ini"""
+    global server_options, digest_cache, archive_cache, directory_index, compress_executor, transport_executor, \
+        transfer_scheduler, session_profiler, swarm_tracker, session_slots
+    server_options = options or load_server_options()
+    directory_index = DirectoryIndex(float(server_options["index_ttl"]))
+    digest_cache = DigestCache(DIGEST_CACHE_PATH, int(server_options["digest_cache_entries"]))
+    archive_cache = ArchiveCache(ARCHIVE_CACHE_DIR, int(server_options["archive_cache_mb"]) * 1024 * 1024)
+    transfer_scheduler = TransferScheduler(float(server_options["bandwidth_limit_kb"]) * 1024,
+                                           float(server_options["client_bandwidth_limit_kb"]) * 1024,
+                                           int(server_options["small_transfer_kb"]) * 1024)
+    swarm_tracker = SwarmTracker(float(server_options["swarm_peer_ttl"]), int(server_options["swarm_max_peers"]))
+    profile_sample = int(server_options["profile_sample"])
+    session_profiler = SessionProfiler(profile_sample) if profile_sample > 0 else None
+    tracemalloc_frames = int(server_options["tracemalloc_frames"])
+    if tracemalloc_frames > 0 and not tracemalloc.is_tracing():
+        tracemalloc.start(tracemalloc_frames)
+    admin_server = None
+    admin_port = int(server_options["admin_port"])
+    if admin_port:
+        admin_server = start_admin_server(admin_port)
+        print('[Main_Server_Output]Admin port:127.0.0.1:' + str(admin_port))
+    host = ''
+    port = int(server_port)
+    print('[Main_Server_Output]Port Opened:'+str(port))
+    backlog = int(server_options["backlog"])
+    max_sessions = int(server_options["max_sessions"])
+    server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    if os.name != 'nt':
+        # 允许服务端重启后立即重新绑定端口（Windows 下该选项语义不同，不设置）
+        server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    # 固定的缓冲区大小设在监听套接字上，接受的连接继承后才能在握手时协商对应的窗口
+    configure_socket(server_socket, server_options)
+    server_socket.bind((host, port))
+    server_socket.listen(backlog)
+    print('[Main_Server_Output]Max sessions:' + str(max_sessions))
+    print('[Main_Server_Output]Bandwidth limit:' + server_options["bandwidth_limit_kb"] + ' KB/s, per client:' +
+          server_options["client_bandwidth_limit_kb"] + ' KB/s')
+    print('[Main_Server_Output]Socket: nodelay ' + server_options["tcp_nodelay"] + ', buffer ' +
+          server_options["socket_buffer_kb"] + ' KB, block ' + server_options["io_block_kb"] + ' KB')
+    print('等待客户端连接...')
+
+    session_slots = SessionSlots(max_sessions)
+    try:
+        while True:
+            session_slots.acquire()
+            try:
+                client_socket, client_address = server_socket.accept()
+            except OSError as e:
+                # 单次 accept 失败不影响监听套接字
+                session_slots.release()
+                print('[Main_Server_Output]Accept ERROR:' + str(e))
+                continue
+            print('[Main_Server_Output]Cilent conntining')
+            print('客户端 %s 连接成功！' % client_address[0])
+            ClientSessionThread(client_socket, client_address, session_slots).start()
+    finally:
+        server_socket.close()
+        if admin_server is not None:
+            admin_server.shutdown()
+            admin_server.server_close()
+        if tracemalloc_frames > 0:
+            tracemalloc.stop()
+        digest_cache.save()
+        if compress_executor is not None:
+            compress_executor.shutdown(wait=False)
+            compress_executor = None
+        if transport_executor is not None:
+            transport_executor.shutdown(wait=False)
+            transport_executor = None
+
+
+def print_verify_result(received_hash, server_sha1):
+    """打印并返回 SHA-1 校验结果"""
+    print("服务器发送的SHA-1校验值：" + server_sha1 +
+        "\n"+"客户端计算的SHA-1下载值:"+received_hash)
+    if received_hash == server_sha1:
+        print("文件完整性校验通过")
+        return True
+    print("文件完整性校验失败")
+    return False
+
+
+def split_relative_path(name):
+    """
+    把 ZIP 条目或同步清单中的相对路径拆成各级名称，拒绝可能写到目标文件夹之外的路径。
+    输出:
+    - 各级名称的列表；含 '..'、盘符或为空时抛出 ValueError
+    """
+    parts = [part for part in name.replace('\\', '/').split('/') if part not in ('', '.')]
+    if not parts or '..' in parts or ':' in parts[0] or any(os.path.splitdrive(part)[0] for part in parts):
+        raise ValueError('非法的路径: ' + name)
+    return parts
+
+
+class ZipStreamExtractor:
+    """
+    边接收边解压 ZIP 流：顺序解析本地文件头，把每个条目直接写到目标文件夹中的最终位置，不落地压缩包。
+    支持 STORED/DEFLATED、数据描述符（bit 3）和 ZIP64 扩展字段，每个条目都校验 CRC；读到中央目录后忽略其余数据。
+    目标文件已存在时重命名为 名称_1.扩展名、名称_2.扩展名 ...
+    通过 write() 接收数据，可以直接作为 PipelinedFileWriter 的输出文件。
+    """
+    def __init__(self, target_folder):
+        self.target_folder = target_folder
+        self.pending = bytearray()
+        self.state = 'signature'
+        self.need = 4
+        self.header = None
+        self.entry_path = None
+        self.out = None
+        self.remaining = 0
+        self.crc = 0
+        self.decompressor = None
+        self.extracted_count = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def write(self, data):
+        view = memoryview(data)
+        while view:
+            if self.state == 'end':
+                return
+            if self.state == 'stored':
+                view = self._write_stored(view)
+            elif self.state == 'deflated':
+                view = self._write_deflated(view)
+            else:
+                take = min(len(view), self.need - len(self.pending))
+                self.pending += view[:take]
+                view = view[take:]
+                if len(self.pending) == self.need:
+                    record = bytes(self.pending)
+                    self.pending.clear()
+                    self._parse_record(record)
+
+    def _parse_record(self, record):
+        if self.state == 'signature':
+            signature = struct.unpack('<I', record)[0]
+            if signature == 0x04034b50:
+                self.state, self.need = 'header', 26
+            elif signature in (0x02014b50, 0x06054b50, 0x06064b50):
+                # 中央目录：所有条目都已解压
+                self.state = 'end'
+            else:
+                raise ValueError('无法识别的 ZIP 记录: 0x{:08x}'.format(signature))
+        elif self.state == 'header':
+            (_, flags, method, _, _, crc, compressed_size, raw_size,
+             name_length, extra_length) = struct.unpack('<HHHHHIIIHH', record)
+            self.header = {"flags": flags, "method": method, "crc": crc, "compressed_size": compressed_size,
+                           "raw_size": raw_size, "name_length": name_length, "zip64": False}
+            self.state, self.need = 'name', name_length + extra_length
+            if self.need == 0:
+                raise ValueError('ZIP 条目缺少文件名')
+        elif self.state == 'name':
+            self._start_entry(record)
+        elif self.state in ('descriptor', 'descriptor_crc'):
+            value = struct.unpack('<I', record)[0]
+            if self.state == 'descriptor' and value == 0x08074b50:
+                # 数据描述符的签名是可选的
+                self.state = 'descriptor_crc'
+                return
+            self.header["crc"] = value
+            self.state, self.need = 'descriptor_sizes', 16 if self.header["zip64"] else 8
+        elif self.state == 'descriptor_sizes':
+            self._finish_entry()
+
+    def _start_entry(self, record):
+        header = self.header
+        name_bytes = record[:header["name_length"]]
+        extra = record[header["name_length"]:]
+        name = name_bytes.decode('utf-8' if header["flags"] & 0x800 else 'cp437')
+        # ZIP64 扩展字段依次包含被置为 0xFFFFFFFF 的原始大小和压缩后大小
+        position = 0
+        while position + 4 <= len(extra):
+            field_id, field_length = struct.unpack('<HH', extra[position:position + 4])
+            if field_id == 0x0001:
+                header["zip64"] = True
+                values = extra[position + 4:position + 4 + field_length]
+                for key in ("raw_size", "compressed_size"):
+                    if header[key] == 0xFFFFFFFF and len(values) >= 8:
+                        header[key] = struct.unpack('<Q', values[:8])[0]
+                        values = values[8:]
+            position += 4 + field_length
+        if header["flags"] & 0x01:
+            raise ValueError('不支持加密的 ZIP 条目: ' + name)
+        if header["method"] not in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED):
+            raise ValueError('不支持的压缩方式 {}: {}'.format(header["method"], name))
+        if header["method"] == zipfile.ZIP_STORED and header["flags"] & 0x08:
+            raise ValueError('无法流式解压大小未知的存储条目: ' + name)
+
+        parts = split_relative_path(name)
+        target_path = os.path.join(self.target_folder, *parts)
+        self.crc = 0
+        if name.endswith('/'):
+            os.makedirs(target_path, exist_ok=True)
+            self.out = None
+        else:
+            os.makedirs(os.path.dirname(target_path), exist_ok=True)
+            # 如果目标文件已经存在，重命名文件
+            if os.path.exists(target_path):
+                base_name, ext = os.path.splitext(target_path)
+                index = 1
+                while os.path.exists(base_name + f"_{index}" + ext):
+                    index += 1
+                new_target_path = base_name + f"_{index}" + ext
+                print(f"文件 '{target_path}' 已存在，重命名为 '{new_target_path}'")
+                target_path = new_target_path
+            self.out = open(target_path, 'wb')
+        self.entry_path = target_path
+        if header["method"] == zipfile.ZIP_DEFLATED:
+            self.decompressor = zlib.decompressobj(-15)
+            self.state = 'deflated'
+        else:
+            self.remaining = header["compressed_size"]
+            self.state = 'stored'
+            if self.remaining == 0:
+                self._end_entry_data()
+
+    def _write_entry_data(self, data):
+        if data:
+            self.crc = zlib.crc32(data, self.crc)
+            if self.out is not None:
+                self.out.write(data)
+
+    def _write_stored(self, view):
+        take = min(len(view), self.remaining)
+        self._write_entry_data(view[:take])
+        self.remaining -= take
+        if self.remaining == 0:
+            self._end_entry_data()
+        return view[take:]
+
+    def _write_deflated(self, view):
+        while True:
+            # 限制每次解压输出的大小，避免高压缩比的数据一次占用大量内存
+            data = self.decompressor.decompress(view, file_block_size)
+            self._write_entry_data(data)
+            if self.decompressor.eof:
+                rest = len(self.decompressor.unused_data)
+                self._end_entry_data()
+                return view[len(view) - rest:]
+            tail = self.decompressor.unconsumed_tail
+            if not tail and len(data) < file_block_size:
+                return view[len(view):]
+            view = memoryview(tail)
+
+    def _end_entry_data(self):
+        if self.header["flags"] & 0x08:
+            self.state, self.need = 'descriptor', 4
+        else:
+            self._finish_entry()
+
+    def _finish_entry(self):
+        if self.crc != self.header["crc"]:
+            self.abort()
+            raise ValueError('CRC 校验失败: ' + self.entry_path)
+        if self.out is not None:
+            self.out.close()
+            self.out = None
+        self.extracted_count += 1
+        self.decompressor = None
+        self.state, self.need = 'signature', 4
+
+    def close(self):
+        """数据流结束：确认最后一个条目完整"""
+        if self.state != 'end' and not (self.state == 'signature' and not self.pending):
+            self.abort()
+            raise ConnectionError('ZIP 数据流不完整')
+        print('已解压 {} 个文件到 {}'.format(self.extracted_count, self.target_folder))
+
+    def abort(self):
+        """出错时删除写了一半的条目"""
+        if self.out is not None:
+            self.out.close()
+            self.out = None
+            try:
+                os.remove(self.entry_path)
+            except OSError:
+                pass
+
+
+def write_batch_file(file_path, data, server_sha1):
+    """批量下载的写盘线程：写入一个已整块收下的小文件并校验 SHA-1"""
+    os.makedirs(os.path.dirname(file_path) or '.', exist_ok=True)
+    with open(file_path, 'wb') as file:
+        file.write(data)
+    return hashlib.sha1(data).hexdigest() == server_sha1
+
+
+class ChunkRepair:
+    """接收完成但有块校验失败的文件，等待 ClientSession.repair_chunks 补传"""
+    def __init__(self, name, file_path, meta, verifier):
+        self.name = name
+        self.file_path = file_path
+        self.meta = meta
+        self.verifier = verifier
+
+
+def print_tree_result(verifier):
+    """由实际收到的数据的块摘要计算根摘要，与服务端的根比较并打印"""
+    tree = verifier.tree
+    # 续传时断点之前的块已由下载日志中的 SHA-1 前缀校验过
+    leaves = [verifier.computed.get(index, leaf) for index, leaf in enumerate(tree["leaves"])]
+    root = merkle_root(leaves, tree["algorithm"])
+    print("哈希树根摘要({})：{}".format(tree["algorithm"], root))
+    if root == tree["root"]:
+        print("逐块校验通过")
+        return True
+    print("逐块校验失败")
+    return False
+
+
+class ClientSession:
+    """分帧协议的客户端会话：一个连接上可以连续（或以流水线方式）发出多个请求"""
+    def __init__(self, connection, server_ip=None):
+        self.connection = connection
+        self.server_ip = server_ip
+        self.next_request_id = 1
+
+    def send_request(self, msg_type, body):
+        request_id = self.next_request_id
+        self.next_request_id += 1
+        self.connection.send_json(msg_type, request_id, body)
+        return request_id
+
+    def read_response(self, request_id, expected_types):
+        """读取一个控制帧，返回 (类型, JSON 内容)；ERROR 帧抛出 RequestError"""
+        frame = self.connection.recv_frame()
+        if frame is None:
+            raise ConnectionError('服务器关闭了连接')
+        msg_type, response_id, payload = frame
+        if response_id != request_id:
+            raise ProtocolError('响应顺序错误: 期望 {} 收到 {}'.format(request_id, response_id))
+        body = json.loads(payload.decode('utf-8')) if payload else {}
+        if msg_type == MSG_ERROR:
+            raise RequestError(body.get("message", ""))
+        if msg_type not in expected_types:
+            raise ProtocolError('意外的消息类型: ' + str(msg_type))
+        return msg_type, body
+
+    def list_files(self, path='', offset=0, limit=None, prefix=None, pattern=None):
+        """
+        请求一页目录列表。
+        输出:
+        - {"total", "offset", "entries": [{"name", "type", "size", "mtime_ns"}]}；
+          v1 服务端不支持分页和过滤，返回全部条目且只有名称
+        """
+        body = {"path": path, "offset": offset}
+        for key, value in (("limit", limit), ("prefix", prefix), ("glob", pattern)):
+            if value is not None:
+                body[key] = value
+        request_id = self.send_request(MSG_LIST, body)
+        listing = self.read_response(request_id, (MSG_LIST,))[1]
+        if self.connection.version < 2:
+            entries = [{"name": name, "type": None, "size": None, "mtime_ns": None} for name in listing["entries"]]
+            listing = {"path": path, "total": len(entries), "offset": 0, "entries": entries}
+        return listing
+
+    def stat(self, name):
+        request_id = self.send_request(MSG_STAT, {"name": name})
+        return self.read_response(request_id, (MSG_META,))[1]
+
+    def get(self, name, download_folder):
+        return self.get_many([name], download_folder)[0]
+
+    def swarm_announce(self, name, port, chunk_map='', root=None, leave=False):
+        """SWARM：登记为对等分发的节点，返回服务端的响应（首次登记即 root 为 None 时含哈希树）"""
+        body = {"name": name, "port": port, "have": chunk_map}
+        if root is None:
+            body.update((key, value) for key, value in self.transfer_options().items() if key == "hash_algorithms")
+        else:
+            body["root"] = root
+        if leave:
+            body["leave"] = True
+        request_id = self.send_request(MSG_SWARM, body)
+        return self.read_response(request_id, (MSG_SWARM,))[1]
+
+    def get_chunk(self, name, offset, length, root=None, unserved_only=False):
+        """
+        CHUNK：向服务端或对等节点取文件的一段，返回数据（由调用方按哈希树校验）；
+        unserved_only 时服务端已把该块发给过其他节点则返回 None
+        """
+        body = {"name": name, "offset": offset, "length": length}
+        if root is not None:
+            body["root"] = root
+        if unserved_only:
+            body["unserved_only"] = True
+        request_id = self.send_request(MSG_CHUNK, body)
+        frame = self.connection.recv_frame()
+        if frame is None:
+            raise ConnectionError('对端关闭了连接')
+        msg_type, response_id, payload = frame
+        if response_id != request_id:
+            raise ProtocolError('响应顺序错误: 期望 {} 收到 {}'.format(request_id, response_id))
+        if msg_type == MSG_ERROR:
+            error = json.loads(payload.decode('utf-8'))
+            if error.get("served"):
+                return None
+            raise RequestError(error.get("message", ""))
+        if msg_type != MSG_DATA or len(payload) != length:
+            raise ProtocolError('块数据不完整')
+        return payload
+
+    def download(self, name, download_folder):
+        """
+        下载一个条目：文件夹按清单增量同步，开启 swarm 时普通文件与其他客户端对等分发，
+        本地已有旧版本的普通文件走增量传输，足够大的普通文件用多连接分段下载，其余（续传等）走普通 GET
+        """
+        file_path = os.path.join(download_folder, name)
+        journal = load_download_journal(file_path)
+        if journal is None or "segments" in journal:
+            meta = self.stat(name)
+            if journal is not None:
+                # 分段下载中断后留下的日志
+                if self.server_ip is not None and resumable_segment_journal(journal, meta, file_path):
+                    return segmented_download(self.server_ip, name, download_folder, meta, journal)
+                print(f"{name} 无法续传，重新下载")
+                remove_download_journal(file_path)
+            if meta["mode"] == "ZIP" and client_options["folder_sync"].lower() == 'true':
+                return self.sync_folder(name, download_folder)
+            if meta["mode"] == "FILE":
+                if client_options["swarm"].lower() == 'true' and self.server_ip is not None:
+                    verified = SwarmDownload(self, name, download_folder).run()
+                    if verified is not None:
+                        return verified
+                if client_options["delta"].lower() == 'true' and os.path.isfile(file_path) \
+                        and os.path.getsize(file_path) > 0:
+                    return self.delta_get(name, download_folder)
+                if self.server_ip is not None and choose_segment_count(meta["size"], meta.get("free_sessions")) > 1:
+                    return segmented_download(self.server_ip, name, download_folder, meta)
+        return self.get(name, download_folder)
+
+    def download_many(self, entries, download_folder):
+        """
+        下载多个列表条目：不需要增量传输或分段下载的普通文件合并为一个 BATCH 请求，其余条目逐个按 download 处理。
+        输入:
+        - entries: list_files 返回的条目
+        输出:
+        - 是否全部校验通过
+        """
+        batch = []
+        others = []
+        for entry in entries:
+            file_path = os.path.join(download_folder, entry["name"])
+            has_basis = client_options["delta"].lower() == 'true' and os.path.isfile(file_path) \
+                and os.path.getsize(file_path) > 0
+            if entry["type"] == "file" and not has_basis and \
+                    (self.server_ip is None or choose_segment_count(entry["size"]) == 1):
+                batch.append(entry["name"])
+            else:
+                others.append(entry["name"])
+        results = self.get_batch(batch, download_folder) if batch else []
+        for name in others:
+            results.append(self.download(name, download_folder))
+        return all(results)
+
+    def sync_folder(self, name, download_folder):
+        """
+        按服务端清单同步文件夹：只下载本地缺失或内容不同的文件，
+        多余的本地文件按 sync_extras 配置删除或保留。
+        输出:
+        - 所有下载的文件是否都校验通过
+        """
+        request_id = self.send_request(MSG_MANIFEST, {"name": name})
+        entries = self.read_response(request_id, (MSG_MANIFEST,))[1]["entries"]
+        local_root = os.path.join(download_folder, name)
+        fetch, changed, extras, current = plan_folder_sync(entries, local_root)
+        print('同步 {}：共 {} 个文件，需下载 {} 个，本地多余 {} 个'.format(
+            name, len(entries), len(fetch) + len(changed), len(extras)))
+        results = []
+        synced = list(current)
+        if fetch:
+            results += self.get_batch([name + '/' + entry["path"] for entry in fetch], download_folder)
+            synced += [entry for entry, verified in zip(fetch, results) if verified]
+        for entry in changed:
+            # 本地已有旧版本的文件走增量传输
+            results.append(self.delta_get(name + '/' + entry["path"], download_folder))
+            if results[-1]:
+                synced.append(entry)
+        for entry in synced:
+            # 同步修改时间，下次同步时大小和时间一致的文件无需再比对内容；
+            # 下载失败的文件保留本地的修改时间，下次同步时仍会重新比对
+            try:
+                os.utime(os.path.join(local_root, *split_relative_path(entry["path"])),
+                         ns=(entry["mtime_ns"], entry["mtime_ns"]))
+            except OSError:
+                pass
+        if extras and client_options["sync_extras"].lower() == 'delete':
+            for path in extras:
+                try:
+                    os.remove(path)
+                except OSError as e:
+                    print('删除 {} 失败：{}'.format(path, e))
+                    continue
+                print('删除本地多余文件 ' + os.path.relpath(path, download_folder))
+            for root, dirs, files in os.walk(local_root, topdown=False):
+                if root != local_root and not os.listdir(root):
+                    os.rmdir(root)
+        verified = all(results)
+        print('同步完成' if verified else '同步完成，部分文件校验失败')
+        return verified
+
+    def delta_get(self, name, download_folder):
+        """发送本地旧版本的块签名，按服务端的增量指令在临时文件中重建新版本，校验通过后替换旧文件"""
+        file_path = os.path.join(download_folder, name)
+        basis_size = os.path.getsize(file_path)
+        block_size = choose_delta_block_size(basis_size)
+        signatures = compute_block_signatures(file_path, block_size)
+        request_id = self.send_request(MSG_DELTA, {"name": name, "block_size": block_size, "size": basis_size})
+        self.connection.send_frame(MSG_DATA, request_id, signatures)
+        try:
+            return self.receive_delta(request_id, file_path, block_size)
+        except RequestError as e:
+            print(f"下载 {name} 失败：{e}")
+            return False
+
+    def receive_delta(self, request_id, file_path, block_size):
+        _, meta = self.read_response(request_id, (MSG_META,))
+        temp_path = file_path + DELTA_TEMP_SUFFIX
+        sha1_hash = hashlib.sha1()
+        literal_size = copied_size = 0
+        start_time = time.time()
+        buffer = bytearray(data_frame_size)
+        view = memoryview(buffer)
+        try:
+            with open(file_path, 'rb') as basis, open(temp_path, 'wb') as file:
+                while True:
+                    header = self.connection.recv_frame_header()
+                    if header is None:
+                        raise ConnectionError('连接在传输结束前断开')
+                    msg_type, response_id, length = header
+                    if response_id != request_id:
+                        raise ProtocolError('响应顺序错误')
+                    if msg_type == MSG_DIGEST:
+                        server_digest = json.loads(self.connection.recv_exact(length).decode('utf-8'))
+                        break
+                    if msg_type == MSG_ERROR:
+                        raise RequestError(json.loads(self.connection.recv_exact(length).decode('utf-8'))["message"])
+                    if msg_type == MSG_COPY:
+                        first_block, block_count = DELTA_COPY.unpack(self.connection.recv_exact(length))
+                        basis.seek(first_block * block_size)
+                        remaining = block_count * block_size
+                        while remaining:
+                            n = basis.readinto(view[:min(remaining, len(buffer))])
+                            if not n:
+                                break
+                            file.write(view[:n])
+                            sha1_hash.update(view[:n])
+                            remaining -= n
+                            copied_size += n
+                    elif msg_type == MSG_DATA:
+                        if length > len(buffer):
+                            buffer = bytearray(length)
+                            view = memoryview(buffer)
+                        self.connection.recv_into(view[:length])
+                        file.write(view[:length])
+                        sha1_hash.update(view[:length])
+                        literal_size += length
+                    else:
+                        raise ProtocolError('意外的消息类型: ' + str(msg_type))
+                    elapsed_time = time.time() - start_time
+                    if elapsed_time > 0 and meta["size"]:
+                        progress = int((literal_size + copied_size) / meta["size"] * 100)
+                        download_speed = literal_size / elapsed_time / 1024
+                        print('\r重建进度：{}% 下载速度：{:.2f} KB/s    {}'.format(
+                            progress, download_speed, print_progress_bar(progress)), end='')
+            print('下载完成！')
+            print('增量传输：接收 {:.2f} KB，复用本地 {:.2f} KB'.format(literal_size / 1024, copied_size / 1024))
+            verified = print_verify_result(sha1_hash.hexdigest(), server_digest["sha1"])
+            if verified:
+                os.replace(temp_path, file_path)
+            return verified
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+    def get_many(self, names, download_folder):
+        """
+        流水线下载多个文件：不等上一个完成就发出后续 GET（最多 pipeline_depth 个在途），按顺序接收。
+        输出:
+        - 每个文件的校验结果（True/False）
+        """
+        depth = max(1, int(client_options["pipeline_depth"]))
+        pending = deque()
+        results = []
+        for name in names:
+            body, resume_hash = self.prepare_get(name, download_folder)
+            pending.append((self.send_request(MSG_GET, body), name, resume_hash))
+            if len(pending) >= depth:
+                results.append(self._receive_one(download_folder, *pending.popleft()))
+        while pending:
+            results.append(self._receive_one(download_folder, *pending.popleft()))
+        # 校验失败的块等流水线排空后再补传，避免补传的响应与在途的响应交错
+        for index, result in enumerate(results):
+            if isinstance(result, ChunkRepair):
+                results[index] = self.repair_chunks(result)
+        return results
+
+    def _receive_one(self, download_folder, request_id, name, resume_hash):
+        try:
+            return self.receive_get(request_id, name, download_folder, resume_hash)
+        except RequestError as e:
+            print(f"下载 {name} 失败：{e}")
+            return False
+
+    def transfer_options(self):
+        """GET / BATCH 请求中与具体文件无关的部分：哈希树算法和传输压缩"""
+        options = {}
+        algorithms = [a.strip() for a in client_options["hash_algorithms"].split(',') if a.strip() in HASH_ALGORITHMS]
+        if algorithms:
+            options["hash_algorithms"] = algorithms
+        methods = [m.strip() for m in client_options["compression"].split(',') if m.strip() in TRANSPORT_COMPRESSORS]
+        if methods:
+            options["compression"] = methods
+            if client_options["compression_level"]:
+                options["compression_level"] = int(client_options["compression_level"])
+        if self.connection.tuner is not None and self.connection.tuner.rtt:
+            # 服务端经过代理或隧道时测不到真实的往返时间，由客户端告知
+            options["rtt_ms"] = round(self.connection.tuner.rtt * 1000, 3)
+        return options
+
+    def prepare_get(self, name, download_folder):
+        """
+        构造 GET 请求。本地存在该文件未完成的下载日志且已下载部分校验通过时，请求从断点续传。
+        输出:
+        - (请求内容, 续传用的 hashlib 对象或 None)
+        """
+        body = {"name": name}
+        body.update(self.transfer_options())
+        file_path = os.path.join(download_folder, name)
+        journal = load_download_journal(file_path)
+        if journal is None:
+            return body, None
+        resume_hash = verify_download_journal(file_path, journal)
+        if resume_hash is None:
+            print(f"{name} 的本地部分校验失败，重新下载")
+            remove_download_journal(file_path)
+            return body, None
+        print(f"{name} 从 {journal['offset']} 字节处续传")
+        body.update({"offset": journal["offset"], "full_digest": True,
+                     "expect": {"size": journal["size"], "mtime_ns": journal["mtime_ns"]}})
+        return body, resume_hash
+
+    def receive_get(self, request_id, name, download_folder, resume_hash=None):
+        _, meta = self.read_response(request_id, (MSG_META,))
+        return self.receive_item(request_id, name, meta, download_folder, resume_hash)
+
+    def receive_item(self, request_id, name, meta, download_folder, resume_hash=None):
+        """接收 META 之后的数据直到 DIGEST，返回校验结果，有块校验失败时返回 ChunkRepair"""
+        if meta["mode"] == "ZIP":
+            file_name = name + ".zip"
+            file_download_thread = FramedDownloadThread(
+                self.connection, request_id, file_name, meta["size"], download_folder,
+                extract_folder=os.path.join(download_folder, name), compression=meta.get("compression"))
+        else:
+            file_name = name
+            # 服务端返回的 offset 为 0 表示文件已变化，从头下载
+            offset = meta.get("offset", 0)
+            journal = {"name": name, "size": meta["size"], "mtime_ns": meta["mtime_ns"]}
+            file_download_thread = FramedDownloadThread(
+                self.connection, request_id, file_name, meta["size"], download_folder,
+                offset=offset, sha1_hash=resume_hash if offset else None, journal=journal, tree=meta.get("tree"),
+                compression=meta.get("compression"))
+        file_download_thread.start()
+        file_download_thread.join()
+        if file_download_thread.error is not None:
+            raise file_download_thread.error
+        if meta["mode"] != "ZIP":
+            remove_download_journal(os.path.join(download_folder, file_name))
+        verifier = file_download_thread.verifier
+        if verifier is not None and verifier.failed:
+            print(f"{name} 有 {len(verifier.failed)} 个块校验失败，稍后重新请求这些块")
+            return ChunkRepair(name, os.path.join(download_folder, file_name), meta, verifier)
+        verified = print_verify_result(file_download_thread.received_sha1,
+                                       file_download_thread.server_digest["sha1"])
+        if verifier is not None:
+            verified = print_tree_result(verifier) and verified
+        return verified
+
+    def repair_chunks(self, repair):
+        """
+        用区间 GET 重新请求校验失败的块（流水线发出），校验通过后写回文件中的原位置。
+        输出:
+        - 所有块最终是否都校验通过且根摘要一致
+        """
+        tree = repair.verifier.tree
+        chunk_size = tree["chunk_size"]
+        file_size = repair.meta["size"]
+        expect = {"size": file_size, "mtime_ns": repair.meta["mtime_ns"]}
+        failed = repair.verifier.failed
+        with open(repair.file_path, 'r+b') as file:
+            for attempt in range(CHUNK_REPAIR_RETRIES):
+                if not failed:
+                    break
+                print(f"重新请求 {repair.name} 的 {len(failed)} 个块（第 {attempt + 1} 轮）")
+                requests = []
+                for index in failed:
+                    offset = index * chunk_size
+                    body = {"name": repair.name, "offset": offset, "length": min(chunk_size, file_size - offset),
+                            "expect": expect}
+                    requests.append((index, offset, self.send_request(MSG_GET, body)))
+                still_failed = []
+                changed = False
+                for index, offset, request_id in requests:
+                    _, meta = self.read_response(request_id, (MSG_META,))
+                    # offset 不符说明服务器上的文件已变化，丢弃数据
+                    same_file = meta.get("offset") == offset
+                    data, _ = self.read_data_frames(request_id, keep=same_file)
+                    if not same_file:
+                        changed = True
+                        continue
+                    digest = new_leaf_hash(tree["algorithm"], data).hexdigest()
+                    if digest == tree["leaves"][index]:
+                        file.seek(offset)
+                        file.write(data)
+                        repair.verifier.computed[index] = digest
+                    else:
+                        still_failed.append(index)
+                if changed:
+                    print(f"{repair.name} 在服务器上已变化，请重新下载")
+                    return False
+                failed = still_failed
+        if failed:
+            print(f"{repair.name} 仍有 {len(failed)} 个块校验失败")
+            return False
+        return print_tree_result(repair.verifier)
+
+    def read_data_frames(self, request_id, keep=True, compression=None):
+        """
+        读取一个响应剩余的 DATA（或 ZDATA）帧直到 DIGEST 帧。
+        输出:
+        - (数据，keep 为 False 时为 None, DIGEST 的内容)
+        """
+        data = bytearray()
+        while True:
+            frame = self.connection.recv_frame()
+            if frame is None:
+                raise ConnectionError('连接在传输结束前断开')
+            msg_type, response_id, payload = frame
+            if response_id != request_id:
+                raise ProtocolError('响应顺序错误')
+            if msg_type == MSG_DIGEST:
+                return (data if keep else None), json.loads(payload.decode('utf-8'))
+            if msg_type == MSG_ERROR:
+                raise RequestError(json.loads(payload.decode('utf-8'))["message"])
+            if msg_type == MSG_ZDATA and compression is not None:
+                payload = decompress_block(compression, payload)
+            elif msg_type != MSG_DATA:
+                raise ProtocolError('意外的消息类型: ' + str(msg_type))
+            if keep:
+                data += payload
+
+    def get_batch(self, names, download_folder):
+        """
+        用一个 BATCH 请求下载多个条目，服务端连续发回，省去逐个请求的往返和开销。
+        小文件在本线程中整块收下，交给线程池并发写盘和校验；大文件和文件夹按 GET 的方式接收。
+        有未完成下载日志的文件、以及小文件校验失败的，之后用 GET 重新下载；服务端不支持 BATCH 时全部用 GET。
+        输出:
+        - 每项的校验结果（True/False），与 names 顺序一致
+        """
+        if self.connection.version < 3:
+            return self.get_many(names, download_folder)
+        results = {}
+        retry = [name for name in names if load_download_journal(os.path.join(download_folder, name)) is not None]
+        resumed = set(retry)
+        batch = [name for name in names if name not in resumed]
+        repairs = []
+        writes = []
+        writers = ThreadPoolExecutor(max_workers=max(1, int(client_options["batch_writers"])))
+        write_slots = BoundedSemaphore(BATCH_WRITE_QUEUE)
+        progress = DownloadProgress(prefix='批量下载')
+        received_size = 0
+        try:
+            if batch:
+                body = {"names": batch}
+                body.update(self.transfer_options())
+                request_id = self.send_request(MSG_BATCH, body)
+            for index, name in enumerate(batch):
+                try:
+                    _, meta = self.read_response(request_id, (MSG_META,))
+                    if meta["mode"] == "FILE" and meta["size"] <= BATCH_INLINE_LIMIT:
+                        data, digest = self.read_data_frames(request_id, compression=meta.get("compression"))
+                        write_slots.acquire()
+                        future = writers.submit(write_batch_file, os.path.join(download_folder, name),
+                                                data, digest["sha1"])
+                        future.add_done_callback(lambda _: write_slots.release())
+                        writes.append((name, future))
+                        received_size += len(data)
+                        progress.update(received_size)
+                        continue
+                    result = self.receive_item(request_id, name, meta, download_folder)
+                except RequestError as e:
+                    print(f"下载 {name} 失败：{e}")
+                    result = False
+                if isinstance(result, ChunkRepair):
+                    repairs.append(result)
+                results[name] = result
+            for name, future in writes:
+                results[name] = future.result()
+                if not results[name]:
+                    print(f"{name} 校验失败，重新下载")
+                    retry.append(name)
+        finally:
+            writers.shutdown()
+        progress.update(received_size, force=True)
+        print('\n批量下载完成：{} 项，{}'.format(len(batch), format_size(received_size)))
+        # 补传和重新下载都要等 BATCH 的响应全部收完，避免与其交错
+        for repair in repairs:
+            results[repair.name] = self.repair_chunks(repair)
+        for name, result in zip(retry, self.get_many(retry, download_folder)):
+            results[name] = result
+        return [results[name] for name in names]
+
+    def close(self):
+        try:
+            self.connection.send_frame(MSG_BYE, 0)
+        except OSError:
+            pass
+
+
+def plan_folder_sync(entries, local_root):
+    """
+    比较服务端清单和本地文件夹。
+    大小和修改时间都相同的文件视为未变化；大小相同但时间不同时再比较 SHA-1。
+    绝对路径、含 '..' 或盘符的清单条目会被忽略：既不下载，也不算作本地应有的文件。
+    输出:
+    - (本地缺失需下载的条目, 本地内容不同需更新的条目, 本地多余文件的路径列表, 本地已是最新的条目)
+    """
+    fetch = []
+    changed = []
+    current = []
+    expected = set()
+    delta = client_options["delta"].lower() == 'true'
+    for entry in entries:
+        try:
+            if entry["path"].startswith(('/', '\\')):
+                raise ValueError('非法的路径: ' + entry["path"])
+            local_path = os.path.join(local_root, *split_relative_path(entry["path"]))
+        except ValueError as e:
+            print('忽略清单条目：' + str(e))
+            continue
+        expected.add(os.path.normcase(os.path.abspath(local_path)))
+        try:
+            local_stat = os.stat(local_path)
+        except OSError:
+            fetch.append(entry)
+            continue
+        if local_stat.st_size == entry["size"]:
+            if local_stat.st_mtime_ns == entry["mtime_ns"]:
+                current.append(entry)
+                continue
+            sha1_hash = hashlib.sha1()
+            with open(local_path, 'rb') as file:
+                hash_file_region(file, 0, local_stat.st_size, sha1_hash)
+            if sha1_hash.hexdigest() == entry["sha1"]:
+                current.append(entry)
+                continue
+        if delta and local_stat.st_size > 0 and load_download_journal(local_path) is None:
+            changed.append(entry)
+        else:
+            fetch.append(entry)
+    extras = []
+    for root, dirs, files in os.walk(local_root):
+        for file in files:
+            path = os.path.join(root, file)
+            key = os.path.normcase(os.path.abspath(path))
+            if key.endswith(DOWNLOAD_JOURNAL_SUFFIX) and key[:-len(DOWNLOAD_JOURNAL_SUFFIX)] in expected:
+                # 未完成下载的日志随对应文件一起处理
+                continue
+            if key not in expected:
+                extras.append(path)
+    return fetch, changed, extras, current
+
+
+def choose_segment_count(file_size, free_sessions=None):
+    """
+    根据配置决定分段数：segments 为 auto 时每 SEGMENT_MIN_SIZE 字节一段，不超过 max_segments。
+    free_sessions 为 STAT 返回的服务端空闲会话名额，每段占用一个名额，分段数不超过它。
+    """
+    option = client_options["segments"].lower()
+    if option != 'auto':
+        segments = int(option)
+    else:
+        segments = min(int(client_options["max_segments"]), file_size // SEGMENT_MIN_SIZE)
+    if free_sessions is not None:
+        segments = min(segments, free_sessions)
+    return max(1, segments)
+
+
+write_position_lock = Lock()
+
+def positional_write(fd, data, position):
+    """在文件的指定位置写入（多个分段线程共享同一个文件描述符）"""
+    view = memoryview(data)
+    if hasattr(os, 'pwrite'):
+        while view:
+            written = os.pwrite(fd, view, position)
+            view = view[written:]
+            position += written
+        return
+    # 没有 pwrite 的平台（Windows）：定位和写入必须成对加锁
+    with write_position_lock:
+        os.lseek(fd, position, os.SEEK_SET)
+        while view:
+            view = view[os.write(fd, view):]
+
+
+def positional_read(fd, length, position):
+    """从文件的指定位置读取 length 字节（对等分发时与写入块的线程共享文件描述符）"""
+    if hasattr(os, 'pread'):
+        data = os.pread(fd, length, position)
+        while len(data) < length:
+            more = os.pread(fd, length - len(data), position + len(data))
+            if not more:
+                raise IOError('文件比预期的短')
+            data += more
+        return data
+    with write_position_lock:
+        os.lseek(fd, position, os.SEEK_SET)
+        data = b''
+        while len(data) < length:
+            more = os.read(fd, length - len(data))
+            if not more:
+                raise IOError('文件比预期的短')
+            data += more
+        return data
+
+
+class SegmentProgress:
+    """多个分段线程共享的下载进度"""
+    def __init__(self, total_size):
+        self.total_size = total_size
+        self.received_size = 0
+        self.start_time = time.time()
+        self.lock = Lock()
+
+    def add(self, n):
+        with self.lock:
+            self.received_size += n
+
+    def show(self, segments, unit='段'):
+        elapsed_time = time.time() - self.start_time
+        progress = int(self.received_size / self.total_size * 100) if self.total_size else 100
+        download_speed = self.received_size / elapsed_time / 1024 if elapsed_time > 0 else 0
+        print('\r下载进度：{}% 下载速度：{:.2f} KB/s  {}{}  {}'.format(
+            progress, download_speed, segments, unit, print_progress_bar(progress)), end='')
+
+
+class SegmentJournal:
+    """
+    分段下载的日志，与普通下载日志使用同一个文件名：
+    {"name", "size", "mtime_ns", "segments": [[段起点, 段长度, 已校验的字节数], ...]}，多个分段线程共享
+    """
+    def __init__(self, file_path, journal):
+        self.file_path = file_path
+        self.journal = journal
+        self.lock = Lock()
+        self.last_save_time = 0
+
+    @property
+    def segments(self):
+        return self.journal["segments"]
+
+    def mark(self, segment, done):
+        """记录一段已校验通过的字节数，距上次写盘超过 JOURNAL_SAVE_INTERVAL 时写入日志文件"""
+        with self.lock:
+            segment[2] = done
+            if time.time() - self.last_save_time >= JOURNAL_SAVE_INTERVAL:
+                self.save_locked()
+
+    def save(self):
+        with self.lock:
+            self.save_locked()
 
-            if key == b'\r':  # Enter 键
-                if selected_option == 0:  # 如果当前选项是“确认”
-                    if user_input.strip() == "":  # 如果输入内容为空
-                        break  # 重新输入
-                    else:
-                        return user_input  # 返回用户输入的内容
-                elif selected_option == 1:  # 如果当前选项是“取消”
-                    return False  # 返回 False
+    def save_locked(self):
+        save_download_journal(self.file_path, self.journal)
+        self.last_save_time = time.time()
 
-            elif key == b'\xe0':  # 方向键
-                direction = msvcrt.getch()
 
-                if direction == b'K':  # 左方向键
-                    selected_option = (selected_option - 1) % 2
-                elif direction == b'M':  # 右方向键
-                    selected_option = (selected_option + 1) % 2
-            
-            elif key == b'\x08':  # 退格键
-                user_input = user_input[:-1]  # 删除最后一个字符
-                
-            else:
-                try:
-                    # 捕获用户输入的字符，忽略解码错误
-                    user_input += key.decode('utf-8', errors='ignore')
-                except Exception as e:
-                    print(f"解码错误: {e}")
+def resumable_segment_journal(journal, meta, file_path):
+    """分段下载的日志是否仍可续传：服务端文件未变化，本地文件是预分配好的完整大小"""
+    try:
+        return meta["mode"] == "FILE" and meta["size"] == journal["size"] and \
+            meta["mtime_ns"] == journal["mtime_ns"] and os.path.getsize(file_path) == journal["size"]
+    except (OSError, KeyError):
+        return False
 
-def show_progress_bar(progress, total, bar_length=40):
+
+class SegmentDownloadThread(Thread):
     """
-    在控制台显示进度条。
-    输入:
-    - progress: 当前进度（整数）
-    - total: 总进度（整数）
-    - bar_length: 进度条长度（默认40）
-    输出:
-    - 动态更新的进度条显示
+    分段下载中的一段：用独立的连接按 SEGMENT_PIECE_SIZE 依次请求该段中尚未完成的区间，按位置写入目标文件，
+    每个区间单独校验摘要；校验通过的部分记入日志，中断后从这里续传
     """
-    # 计算进度的百分比
-    percent = float(progress) / total
-    # 计算进度条中多少是满的
-    filled_length = int(bar_length * percent)
-    
-    # 生成进度条字符串
-    bar = '█' * filled_length + '-' * (bar_length - filled_length)
-    # 通过覆盖上一行输出，动态显示进度
-    sys.stdout.write(f'\r进度: |{bar}| {percent * 100:.1f}% 已完成')
-    sys.stdout.flush()
+    def __init__(self, server_ip, name, fd, segment, expect, progress, journal):
+        super(SegmentDownloadThread, self).__init__(daemon=True)
+        self.server_ip = server_ip
+        self.name = name
+        self.fd = fd
+        self.segment = segment
+        self.expect = expect
+        self.progress = progress
+        self.journal = journal
+        self.error = None
 
-    # 在进度完成时换行
-    if progress == total:
-        print()
-def render_options(input_type, array_size=None, options=None, prompt="选择一个选项", visible_rows=25):
-    clear_console()
-    text=prompt
+    def run(self):
+        for attempt in range(SEGMENT_RETRIES):
+            try:
+                self.download()
+                self.error = None
+                return
+            except RequestError as e:
+                # 文件已变化等无法通过重试解决的错误
+                self.error = e
+                return
+            except (OSError, ProtocolError, ValueError) as e:
+                self.error = e
+                print('\n[Client]Segment {} retry {}: {}'.format(self.segment[0], attempt + 1, e))
+
+    def download(self):
+        offset, length, done = self.segment
+        end = offset + length
+        client_socket, session = open_session(self.server_ip)
+        try:
+            pending = self.request(session, offset + done, end)
+            while pending is not None:
+                request_id, position, piece_length = pending
+                # 先发出下一个区间的请求，省去区间之间的一次往返
+                pending = self.request(session, position + piece_length, end)
+                self.receive_piece(session, request_id, position, piece_length)
+                self.journal.mark(self.segment, position + piece_length - offset)
+            session.close()
+        finally:
+            client_socket.close()
+
+    def request(self, session, position, end):
+        """请求 [position, end) 中的下一个区间，已到段尾时返回 None"""
+        if position >= end:
+            return None
+        piece_length = min(SEGMENT_PIECE_SIZE, end - position)
+        request_id = session.send_request(MSG_GET, {
+            "name": self.name, "offset": position, "length": piece_length,
+            "range_digest": True, "expect": self.expect})
+        return request_id, position, piece_length
+
+    def receive_piece(self, session, request_id, offset, length):
+        _, meta = session.read_response(request_id, (MSG_META,))
+        if meta.get("offset") != offset or meta.get("length") != length:
+            raise RequestError('服务器上的文件已变化')
+        connection = session.connection
+        range_hash = hashlib.sha1()
+        position = offset
+        buffer = bytearray(data_frame_size)
+        view = memoryview(buffer)
+        counted = 0
+        try:
+            while True:
+                header = connection.recv_frame_header()
+                if header is None:
+                    raise ConnectionError('连接在传输结束前断开')
+                msg_type, response_id, frame_length = header
+                if response_id != request_id:
+                    raise ProtocolError('响应顺序错误')
+                if msg_type == MSG_DIGEST:
+                    digest = json.loads(connection.recv_exact(frame_length).decode('utf-8'))
+                    break
+                if msg_type != MSG_DATA:
+                    raise ProtocolError('意外的消息类型: ' + str(msg_type))
+                if frame_length > len(buffer):
+                    buffer = bytearray(frame_length)
+                    view = memoryview(buffer)
+                connection.recv_into(view[:frame_length])
+                positional_write(self.fd, view[:frame_length], position)
+                range_hash.update(view[:frame_length])
+                position += frame_length
+                counted += frame_length
+                self.progress.add(frame_length)
+        except BaseException:
+            # 重试时从本区间的起点开始，撤销已计入的进度
+            self.progress.add(-counted)
+            raise
+        if position != offset + length or digest.get("range_sha1") != range_hash.hexdigest():
+            self.progress.add(-counted)
+            raise ProtocolError('分段校验失败')
+
+
+def segmented_download(server_ip, name, download_folder, meta, journal=None):
     """
+    多连接分段下载一个普通文件：预分配目标文件，N 个连接各自请求互不重叠的区间并按位置写入，每个区间单独校验。
+    各段的进度记在下载日志中，中断后再次下载时只请求尚未完成的部分。
     输入:
-    - input_type: 1表示普通列表，2表示二维数组
-    - array_size: (rows, cols)，二维数组的大小 (仅当 input_type 为 2 时启用)
-    - options: 普通列表或二维数组
-    - text: 要显示的提示词
-    - visible_rows: 最多的显示行数 默认25
+    - meta: STAT 返回的文件元数据
+    - journal: 上次中断时留下的分段下载日志（已由 resumable_segment_journal 确认可续传），None 表示重新下载
     输出:
-    - 选择的选项的下标（对于列表）或坐标（对于二维数组）
+    - 所有分段是否都校验通过
     """
-    def get_max_width(options):
-        if isinstance(options[0], list):  # 检查是否为二维数组
-            return max(len(item) for row in options for item in row)
+    file_size = meta["size"]
+    file_path = os.path.join(download_folder, name)
+    if journal is None:
+        segments = choose_segment_count(file_size, meta.get("free_sessions"))
+        os.makedirs(os.path.dirname(file_path) or '.', exist_ok=True)
+        fd = os.open(file_path, os.O_RDWR | os.O_CREAT | os.O_TRUNC | getattr(os, 'O_BINARY', 0), 0o666)
+        segment_size = -(-file_size // segments)
+        journal = {"name": name, "size": file_size, "mtime_ns": meta["mtime_ns"],
+                   "segments": [[offset, min(segment_size, file_size - offset), 0]
+                                for offset in range(0, file_size, segment_size)]}
+    else:
+        fd = os.open(file_path, os.O_RDWR | getattr(os, 'O_BINARY', 0))
+    journal = SegmentJournal(file_path, journal)
+    threads = []
+    try:
+        if not any(segment[2] for segment in journal.segments):
+            # 预分配空间，避免多段交错写入造成碎片
+            if hasattr(os, 'posix_fallocate') and file_size > 0:
+                os.posix_fallocate(fd, 0, file_size)
+            else:
+                os.ftruncate(fd, file_size)
+            print('[Client]Segmented download: {} segments'.format(len(journal.segments)))
         else:
-            return max(len(item) for item in options)
+            print('[Client]Segmented download: resume {} of {} segments'.format(
+                sum(segment[2] < segment[1] for segment in journal.segments), len(journal.segments)))
+        journal.save()
+        progress = SegmentProgress(file_size)
+        progress.add(sum(segment[2] for segment in journal.segments))
+        expect = {"size": file_size, "mtime_ns": meta["mtime_ns"]}
+        threads = [SegmentDownloadThread(server_ip, name, fd, segment, expect, progress, journal)
+                   for segment in journal.segments if segment[2] < segment[1]]
+        for thread in threads:
+            thread.start()
+        while any(thread.is_alive() for thread in threads):
+            for thread in threads:
+                thread.join(0.2)
+            progress.show(len(threads))
+        progress.show(len(threads))
+        print()
+    finally:
+        os.close(fd)
+        # 中断（包括 Ctrl+C）时记下各段已完成的位置
+        if any(segment[2] < segment[1] for segment in journal.segments):
+            journal.save()
+    errors = [thread.error for thread in threads if thread.error is not None]
+    if errors:
+        print("分段下载失败：" + str(errors[0]))
+        return False
+    remove_download_journal(file_path)
+    print("所有分段校验通过")
+    return True
 
-    # 初始化选项下标
-    selected_row = 0
-    selected_col = 0
-    scroll_offset = 0  # 当前滚动的偏移量
 
-    max_width = get_max_width(options) + 2  # 获取最大宽度并在两边添加2个空格用于对齐
+class SwarmPeerServer(Thread):
+    """对等分发时本端的对等服务：其他节点用 CHUNK 请求取本端已经校验过的块"""
+    def __init__(self, swarm, port):
+        super(SwarmPeerServer, self).__init__(daemon=True)
+        self.swarm = swarm
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        configure_socket(self.listener, client_options)
+        self.listener.bind(('', port))
+        self.listener.listen(16)
+        # 定时醒来检查是否已关闭（关闭监听套接字不一定能唤醒阻塞中的 accept）
+        self.listener.settimeout(0.5)
+        self.port = self.listener.getsockname()[1]
+        self.closed = False
 
-    # 首次渲染提示文本（仅显示一次）
-    rows, cols = array_size if array_size else (len(options), 1)  # 计算行和列
-    print(text)  # 只输出一次提示文本
-    print()
+    def run(self):
+        try:
+            while not self.closed:
+                try:
+                    sock, _ = self.listener.accept()
+                except socket.timeout:
+                    continue
+                Thread(target=self.serve, args=(sock,), daemon=True).start()
+        except OSError:
+            pass
+        finally:
+            self.listener.close()
 
-    # 渲染可见的选项
-    def render_page():
-        for row in range(scroll_offset, min(scroll_offset + visible_rows, rows)):
-            if input_type == 1:
-                print("  " + options[row].ljust(max_width))
-            elif input_type == 2:
-                for col in range(cols):
-                    print(f"  {options[row][col].ljust(max_width)}", end="")
-                print()
+    def serve(self, sock):
+        """一个对等连接：握手后循环处理 CHUNK 请求，直到对方发送 BYE、断开或本端停止服务"""
+        try:
+            sock.settimeout(SWARM_PEER_TIMEOUT)
+            # 与服务端一致：先发送（空的）文件列表，再读取握手
+            send_legacy_greeting(sock, [])
+            connection = FramedConnection(sock, 'peer')
+            hello = connection.recv_exact(len(PROTOCOL_MAGIC) + 1)
+            if hello is None or hello[:len(PROTOCOL_MAGIC)] != PROTOCOL_MAGIC:
+                return
+            connection.version = min(hello[-1], PROTOCOL_VERSION)
+            sock.sendall(PROTOCOL_MAGIC + bytes([connection.version]))
+            while not self.closed:
+                frame = connection.recv_frame()
+                if frame is None or frame[0] == MSG_BYE:
+                    return
+                msg_type, request_id, payload = frame
+                try:
+                    if msg_type != MSG_CHUNK:
+                        raise RequestError('对等节点只支持 CHUNK 请求')
+                    data = self.swarm.read_chunk(json.loads(payload.decode('utf-8')))
+                except (RequestError, ValueError, KeyError) as e:
+                    connection.send_json(MSG_ERROR, request_id, {"message": str(e)})
+                    continue
+                connection.send_frame(MSG_DATA, request_id, data)
+        except (OSError, ProtocolError):
+            pass  # 对方断开或超时只影响这一个连接
+        finally:
+            sock.close()
 
-    render_page()
+    def close(self):
+        """停止接受新连接；未启动时直接关闭监听套接字"""
+        self.closed = True
+        if not self.is_alive():
+            self.listener.close()
 
-    while True:
-        # 使用转义码移动光标到选项部分
-        for _ in range(min(visible_rows, rows)):  # 回退到选项部分
-            print("\033[F", end="")
-
-        # 重新渲染选项，只更新高亮部分
-        if input_type == 1:  # 处理普通列表
-            for idx in range(scroll_offset, min(scroll_offset + visible_rows, len(options))):
-                padded_option = options[idx].ljust(max_width)  # 使选项左对齐并按最大宽度填充
-                if idx == selected_row:
-                    print(f"> {WHITE_ON_BLACK}{padded_option}{RESET}")  # 用白字黑底高亮当前选项
-                else:
-                    print(f"  {padded_option}")
-
-        elif input_type == 2:  # 处理二维数组
-            for row in range(scroll_offset, min(scroll_offset + visible_rows, rows)):
-                for col in range(cols):
-                    padded_option = options[row][col].ljust(max_width)  # 左对齐并按最大宽度填充
-                    if row == selected_row and col == selected_col:
-                        print(f"  {WHITE_ON_BLACK}{padded_option}{RESET}", end="")  # 用白字黑底高亮当前选项
-                    else:
-                        print(f"  {padded_option}", end="")
-                print()  # 换行
 
-        # 捕获键盘输入
-        key = msvcrt.getch()
-
-        if key == b'\r':  # Enter 键
-            if input_type == 1:
-                return selected_row  # 返回选项下标
-            elif input_type == 2:
-                return (selected_row, selected_col)  # 返回二维数组坐标
-
-        elif key == b'\xe0':  # 特殊按键（方向键）
-            direction = msvcrt.getch()
-
-            if direction == b'H':  # 上方向键
-                if selected_row > 0:
-                    selected_row -= 1
-                if selected_row < scroll_offset:
-                    scroll_offset -= 1  # 向上滚动
-            elif direction == b'P':  # 下方向键
-                if selected_row < rows - 1:
-                    selected_row += 1
-                if selected_row >= scroll_offset + visible_rows:
-                    scroll_offset += 1  # 向下滚动
-            elif direction == b'K':  # 左方向键 (仅对二维数组有效)
-                if input_type == 2:
-                    selected_col = (selected_col - 1) % cols
-            elif direction == b'M':  # 右方向键 (仅对二维数组有效)
-                if input_type == 2:
-                    selected_col = (selected_col + 1) % cols
-
-
-def compress_folder(folder_path, zip_file_path):
-    with zipfile.ZipFile(zip_file_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
-        for root, _, files in os.walk(folder_path):
-            for file in files:
-                file_path = os.path.join(root, file)
-                rel_path = os.path.relpath(file_path, folder_path)
-                zipf.write(file_path, rel_path)
+class SwarmDownload:
+    """
+    对等分发下载一个普通文件（一对多分发时服务端只需发出约一份数据）。
+    按服务端哈希树的块划分，有其他节点持有的块从节点取（最稀有的优先），还没有节点持有的块才向服务端取；
+    每块与哈希树的叶子比对通过后才写入并对外提供，所以节点发错或篡改的数据不会扩散。
+    下载完成后继续做种，直到其他节点都已完成或 swarm_seed_idle 秒内没有节点来取块。
+    """
+    def __init__(self, session, name, download_folder):
+        self.session = session
+        self.name = name
+        self.file_path = os.path.join(download_folder, name)
+        self.lock = Condition()
+        self.peers = {}         # 节点地址 -> 块图（bytes）
+        self.availability = []  # 块号 -> 持有该块的节点数
+        self.bad_peers = set()  # 发来过校验失败的块的节点，本次下载不再向其请求
+        self.peer_load = {}     # 节点地址 -> 正在向它请求的块数
+        self.server_load = 0    # 正在向服务端请求的块数
+        self.in_flight = set()
+        self.served = bytearray()  # 服务端已经向某个节点发出的块（位图）
+        self.others_complete = False
+        self.error = None
+        self.fd = None
+        self.file_lock = Lock()  # 对等服务读块与关闭文件互斥
+        self.last_served = 0
+        self.counts = {"peer": 0, "server": 0, "served": 0}
 
-def run_server():
-    try:
-        global server_files_folder
-        host = ''
-        port = int(server_port)
-        print('[Main_Server_Output]Port Opened:'+str(port))
-        backlog = 5
-        server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        server_socket.bind((host, port))
-        server_socket.listen(backlog)
-        print('等待客户端连接...')
+    def run(self):
+        """
+        输出:
+        - 是否所有块都校验通过；服务端不支持或未开启对等分发时返回 None，由调用方改用普通下载
+        """
+        self.peer_server = SwarmPeerServer(self, int(client_options["swarm_port"]))
+        try:
+            reply = self.session.swarm_announce(self.name, self.peer_server.port)
+        except RequestError as e:
+            self.peer_server.close()
+            print('[Client]Swarm unavailable, fallback to GET: ' + str(e))
+            return None
+        except BaseException:
+            self.peer_server.close()
+            raise
+        self.tree = reply["tree"]
+        self.root = self.tree["root"]
+        self.size = reply["size"]
+        self.chunk_size = self.tree["chunk_size"]
+        self.chunk_count = len(self.tree["leaves"])
+        self.have = [False] * self.chunk_count
+        self.remaining = self.chunk_count
+        self.full_map = bytes.fromhex(encode_chunk_map([True] * self.chunk_count))
+        # 同样稀有的块按各自随机的顺序取，同时开始的节点最初从服务端取到的块互不相同
+        self.order = random.sample(range(self.chunk_count), self.chunk_count)
+        self.interval = float(client_options["swarm_announce_interval"])
+        self.progress_time = time.monotonic()
+        self.update_peers(reply["peers"], reply.get("served", ''))
+        try:
+            os.makedirs(os.path.dirname(self.file_path) or '.', exist_ok=True)
+            self.fd = os.open(self.file_path, os.O_RDWR | os.O_CREAT | os.O_TRUNC | getattr(os, 'O_BINARY', 0), 0o666)
+            if hasattr(os, 'posix_fallocate') and self.size > 0:
+                os.posix_fallocate(self.fd, 0, self.size)
+            else:
+                os.ftruncate(self.fd, self.size)
+            self.peer_server.start()
+            print('[Client]Swarm download: {} chunks, {} peers'.format(self.chunk_count, len(self.peers)))
+            with metrics.span('swarm', name=self.name, bytes=self.size):
+                self.fetch_all()
+            if self.error is not None:
+                print("对等分发下载失败：" + str(self.error))
+                return False
+            print('[Client]Swarm done: {} chunks from peers, {} from server'.format(
+                self.counts["peer"], self.counts["server"]))
+            print("哈希树根摘要({})：{}".format(self.tree["algorithm"], self.root))
+            print("逐块校验通过")
+            self.seed()
+            print('[Client]Swarm seeding finished: {} chunks served'.format(self.counts["served"]))
+            return True
+        finally:
+            self.leave()
 
-        while True:
-            client_socket, client_address = server_socket.accept()
-            print('[Main_Server_Output]Cilent conntining')
-            print('客户端 %s 连接成功！' % client_address[0])
-            # 发送文件列表
-            file_list = os.listdir(server_files_folder)
-            file_names = '\n'.join(file_list)
-            client_socket.send(file_names.encode() + b'<<EOF>>')
-            print('[Main_Server_Output]Files list sent!')
-            # 接收客户端请求的文件或文件夹名称
-            folder_name = client_socket.recv(buf_size).decode()
-
-            # 判断是否是文件夹，是则压缩发送
-            folder_path = os.path.join(server_files_folder, folder_name)
-            if os.path.isdir(folder_path):
-                print('[Main_Server_Output]Cilent Download Mode:ZIP')
-                # 发送压缩文件的通知
-                client_socket.send(b'ZIP')
-                print('[Main_Server_Output]Mode sent')
-
-                # 压缩文件夹并发送
-                zip_file_path = os.path.join(
-                    server_files_folder, f"{folder_name}.zip")
-                total_files = sum(len(files)
-                                for _, _, files in os.walk(folder_path))
-                processed_files = 0
+    def fetch_all(self):
+        """启动 swarm_connections 个取块线程，并按 swarm_announce_interval 重新登记、刷新其他节点的块图"""
+        self.progress = SegmentProgress(self.size)
+        workers = [Thread(target=self.work_loop, daemon=True) for _ in range(int(client_options["swarm_connections"]))]
+        for worker in workers:
+            worker.start()
+        next_announce = time.monotonic() + self.interval
+        try:
+            while any(worker.is_alive() for worker in workers):
+                workers[0].join(0.2)
+                if time.monotonic() >= next_announce:
+                    self.announce()
+                    next_announce = time.monotonic() + self.interval
+                self.progress.show(len(self.peers), '个节点')
+        except BaseException as e:
+            with self.lock:
+                self.error = self.error or e
+                self.lock.notify_all()
+            raise
+        finally:
+            self.progress.show(len(self.peers), '个节点')
+            print()
 
-                print('[Main_Server_Output]压缩中...')
-                with zipfile.ZipFile(zip_file_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
-                    for root, _, files in os.walk(folder_path):
-                        for file in files:
-                            file_path = os.path.join(root, file)
-                            rel_path = os.path.relpath(file_path, folder_path)
-                            zipf.write(file_path, rel_path)
-                            # 更新压缩进度
-                            processed_files += 1
-                            progress = processed_files / total_files * 100
-                            print('\r压缩进度：{}'.format(print_progress_bar(round(progress))), end='')
+    def announce(self, leave=False):
+        with self.lock:
+            chunk_map = encode_chunk_map(self.have)
+        reply = self.session.swarm_announce(self.name, self.peer_server.port, chunk_map, self.root, leave)
+        if not leave:
+            self.update_peers(reply["peers"], reply.get("served", ''))
 
-                print('\n[Main_Server_Output]压缩完成:'+zip_file_path)
+    def update_peers(self, peers, served):
+        """换上服务端最新返回的节点及其块图，重新统计每块的持有节点数"""
+        peers = {peer["address"]: bytes.fromhex(peer["have"]) for peer in peers}
+        availability = [0] * self.chunk_count
+        for bits in peers.values():
+            for index in range(self.chunk_count):
+                if chunk_map_has(bits, index):
+                    availability[index] += 1
+        with self.lock:
+            self.others_complete = all(bits == self.full_map for bits in peers.values())
+            self.peers = {address: bits for address, bits in peers.items() if address not in self.bad_peers}
+            for address in self.bad_peers & peers.keys():
+                for index in range(self.chunk_count):
+                    if chunk_map_has(peers[address], index):
+                        availability[index] -= 1
+            self.availability = availability
+            self.served = bytearray.fromhex(served)
+            self.lock.notify_all()
 
-                # 发送压缩文件
-                print('[Main_Server_Output]Starting Send File...')
-                with open(zip_file_path, 'rb') as zip_file:
-                    print('[Main_Server_Output]Sending...')
-                    file_size = os.path.getsize(zip_file_path)
-                    client_socket.send(str(file_size).encode())
-                    while True:
-                        data = zip_file.read(buf_size)
-                        if not data:
-                            break
-                        client_socket.sendall(data)
-                print('[Main_Server_Output]Finshed.')
+    def drop_peer(self, address, bad):
+        """连接失败的节点在下次登记前不再请求；发来错误数据的节点（bad）本次下载都不再请求"""
+        with self.lock:
+            if bad:
+                self.bad_peers.add(address)
+            bits = self.peers.pop(address, None)
+            if bits is not None:
+                for index in range(self.chunk_count):
+                    if chunk_map_has(bits, index):
+                        self.availability[index] -= 1
 
-                # 计算压缩文件的SHA-1值
-                with open(zip_file_path, 'rb') as file:
-                    file_data = file.read()
-                    sha1_hash = hashlib.sha1()
-                    sha1_hash.update(file_data)
-                    file_sha1 = sha1_hash.hexdigest()
+    def next_task(self):
+        """
+        选出下一块及其来源（节点地址，服务端为 None），调用时须持有 self.lock。
+        服务端的带宽最宝贵，有空闲名额且还有服务端没有发出过的块时先向服务端取；
+        否则在有节点持有的块中取持有者最少的，从持有者中正在请求数最少的节点取。
+        服务端发出过、但还没有节点登记持有的块等对方登记；超过三个登记间隔没有任何进展（对方可能已离开）才向服务端再要。
+        没有可取的块时返回 None。
+        """
+        if self.error is not None or not self.remaining:
+            return None
+        free_peers = [address for address in self.peers if self.peer_load.get(address, 0) < SWARM_PEER_SLOTS]
+        server_free = self.server_load < SWARM_SERVER_SLOTS
+        best = None
+        deferred = None
+        for index in self.order:
+            if self.have[index] or index in self.in_flight:
+                continue
+            count = self.availability[index]
+            if count == 0:
+                if not server_free:
+                    continue
+                if not chunk_map_has(self.served, index):
+                    return index, None
+                if deferred is None:
+                    deferred = index
+            elif free_peers and (best is None or count < best[0]):
+                holders = [address for address in free_peers if chunk_map_has(self.peers[address], index)]
+                if holders:
+                    best = (count, index, min(holders, key=lambda address: self.peer_load.get(address, 0)))
+        if best is not None:
+            return best[1:]
+        if deferred is not None and time.monotonic() - self.progress_time > 3 * self.interval:
+            return deferred, None
+        return None
 
-                    # 将SHA-1值发送给客户端
-                    print('[Main_Server_Output]Sending SHA-1...')
-                    client_socket.send(file_sha1.encode())
-                    print('[Main_Server_Output]SHA-1 sent :' + file_sha1)
+    def work_loop(self):
+        """取块线程：向每个来源（节点或服务端）各开一个连接，在线程内复用"""
+        sessions = {}
+        try:
+            while True:
+                with self.lock:
+                    task = self.next_task()
+                    while task is None and self.remaining and self.error is None:
+                        self.lock.wait(self.interval)
+                        task = self.next_task()
+                    if task is None:
+                        return
+                    index, source = task
+                    self.in_flight.add(index)
+                    if source is None:
+                        self.server_load += 1
+                    else:
+                        self.peer_load[source] = self.peer_load.get(source, 0) + 1
+                try:
+                    self.fetch(sessions, index, source)
+                finally:
+                    with self.lock:
+                        self.in_flight.discard(index)
+                        if source is None:
+                            self.server_load -= 1
+                        else:
+                            self.peer_load[source] -= 1
+                        self.lock.notify_all()
+        except BaseException as e:
+            with self.lock:
+                self.error = self.error or e
+                self.lock.notify_all()
+        finally:
+            for session in sessions.values():
+                session.close()
+                session.connection.sock.close()
 
-                # 删除压缩文件
-                os.remove(zip_file_path)
+    def fetch(self, sessions, index, source):
+        """取一块并校验；节点出错时放弃该节点（块留给下次选择），服务端出错则整个下载失败"""
+        offset = index * self.chunk_size
+        length = min(self.chunk_size, self.size - offset)
+        try:
+            session = sessions.get(source)
+            if session is None:
+                sock, session = open_session(source or self.session.server_ip)
+                sock.settimeout(SWARM_PEER_TIMEOUT)
+                sessions[source] = session
+            # 自认为服务端还没发出过的块让服务端去重；等不到持有者而重新要的块则必须发送
+            unserved_only = source is None and not chunk_map_has(self.served, index)
+            data = session.get_chunk(self.name, offset, length, self.root, unserved_only)
+        except (OSError, ProtocolError, RequestError):
+            if source is None:
+                raise
+            session = sessions.pop(source, None)
+            if session is not None:
+                session.connection.sock.close()
+            self.drop_peer(source, False)
+            return
+        if data is None:
+            with self.lock:
+                set_chunk_bit(self.served, index)
+            return
+        if new_leaf_hash(self.tree["algorithm"], data).hexdigest() != self.tree["leaves"][index]:
+            if source is None:
+                raise ProtocolError('服务端发来的第 {} 块校验失败（文件可能在分发过程中被修改）'.format(index))
+            print('\n[Client]Chunk {} from peer {} failed verification, peer dropped'.format(index, source))
+            metrics.inc('swarm_chunk_failures_total')
+            self.drop_peer(source, True)
+            return
+        positional_write(self.fd, data, offset)
+        kind = 'server' if source is None else 'peer'
+        with self.lock:
+            self.have[index] = True
+            self.remaining -= 1
+            self.counts[kind] += 1
+            self.progress_time = time.monotonic()
+        metrics.inc('swarm_chunks_total', source=kind)
+        self.progress.add(length)
 
-            else:
-                # 如果不是文件夹，则发送普通文件
-                client_socket.send(b'FILE')
-                print('[Main_Server_Output]Cilent Download Mode:NORMAL FILE')
-
-                # 发送文件大
-                print('[Main_Server_Output]Sending File Size:')
-                client_socket.send(str(os.path.getsize(folder_path)).encode())
-                print('[Main_Server_Output]Sent!')
-
-                # 发送文件内容
-                with open(folder_path, 'rb') as file:
-                    print('[Main_Server_Output]Starting Send File...')
-                    print('[Main_Server_Output]Sending...')
-                    while True:
-                        data = file.read(buf_size)
-                        if not data:
-                            break
-                        client_socket.sendall(data)
-                print('[Main_Server_Output]Finshed!')
-                print("[Main_Server_Output]Getting SHA-1...")
-                # 计算文件的SHA-1值
-                with open(folder_path, 'rb') as file:
-                    file_data = file.read()
-                    sha1_hash = hashlib.sha1()
-                    sha1_hash.update(file_data)
-                    file_sha1 = sha1_hash.hexdigest()
-                    print('[Main_Server_Output]Finshed!')
-                    # 将SHA-1值发送给客户端
-                    print('[Main_Server_Output]Sending SHA-1...')
-                    client_socket.send(file_sha1.encode())
-                    print('[Main_Server_Output]SHA-1 sent :' + file_sha1)
+    def read_chunk(self, request):
+        """对等服务读取本端已校验的一整块"""
+        if request.get("root") != self.root:
+            raise RequestError('文件版本不同')
+        offset = int(request["offset"])
+        length = int(request["length"])
+        index = offset // self.chunk_size
+        if offset % self.chunk_size or not 0 <= index < self.chunk_count or \
+                length != min(self.chunk_size, self.size - offset):
+            raise RequestError('请求的不是完整的块')
+        if not self.have[index]:
+            raise RequestError('本节点还没有第 {} 块'.format(index))
+        with self.file_lock:
+            if self.fd is None:
+                raise RequestError('本节点已停止对等服务')
+            data = positional_read(self.fd, length, offset)
+        with self.lock:
+            self.counts["served"] += 1
+            self.last_served = time.monotonic()
+        metrics.inc('swarm_chunks_served_total')
+        return data
 
-            client_socket.close()
-            print('[Main_Server_Output]Cilent '+client_address[0]+' losted contiune')
-    except Exception as e:
-        # print('[Main_Server_Output]ERROR!:'+str(e))
-        # print('[Main_Server_Output]Press Enter to contiune...')
-        # input()
-        # print('[Main_Server_Output]Server will restart after 2 secs...')
-        server_socket.close()
-        # time.sleep(2)
-        run_server()
+    def seed(self):
+        """下载完成后继续提供块，直到其他节点都已完成，或 swarm_seed_idle 秒内没有节点来取块"""
+        idle_limit = float(client_options["swarm_seed_idle"])
+        done_time = time.monotonic()
+        while True:
+            self.announce()
+            if self.others_complete or time.monotonic() - max(done_time, self.last_served) >= idle_limit:
+                return
+            time.sleep(self.interval)
 
+    def leave(self):
+        """停止对等服务、关闭文件并注销登记（服务端连接已断开时由登记超时清理）"""
+        self.peer_server.close()
+        with self.file_lock:
+            if self.fd is not None:
+                os.close(self.fd)
+                self.fd = None
+        try:
+            self.announce(leave=True)
+        except (OSError, ProtocolError, RequestError):
+            pass
 
-def run_client(server_ip, download_folder):
-    try:
-        client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        server_ip_c = server_ip.split(':')[0]
-        print(server_ip_c)
-        server_port = server_ip.split(':')[1]
-        client_socket.connect((server_ip_c, int(server_port)))
-        print('已连接至服务器 %s:25565' % server_ip)
-
-        # 接收并打印服务端的文件列表
-        print('服务器文件列表：')
-        file_list = []  # 初始化为空列表
-        while True:
-            data = client_socket.recv(buf_size)
-            if data.endswith(b'<<EOF>>'):
-                # 处理最后一部分数据，去掉结束标记并分割成文件名
-                file_list.extend(data.decode()[:-7].splitlines())  # 按行分割并添加到列表中
-                break
-            else:
-                # 将接收到的数据按行分割并添加到列表中
-                file_list.extend(data.decode().splitlines())
 
-        print(type(file_list))  # 现在应该是 <class 'list'>
-        print(file_list)  # 输出文件名列表
-        folder_name_down = render_options(1,options=file_list,prompt="请选择要下载的文件")
-        # 输入要下载的文件或文件夹名称
-        folder_name = file_list[folder_name_down]
-        client_socket.send(folder_name.encode())
+def open_tcp_connection(host, port, options):
+    """同 socket.create_connection，但在连接之前按配置设置套接字（见 configure_socket）"""
+    error = OSError('无法解析地址: ' + host)
+    for family, socktype, proto, _, address in socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM):
+        sock = socket.socket(family, socktype, proto)
+        try:
+            configure_socket(sock, options)
+            sock.connect(address)
+            return sock
+        except OSError as e:
+            sock.close()
+            error = e
+    raise error
 
-        # 接收服务端的响应
-        response = client_socket.recv(buf_size).decode()
 
-        if response == 'ZIP':
-            print("请稍候服务端正在压缩...")
-            # 接收压缩文件大小
-            file_size = int(client_socket.recv(buf_size).decode())
+def read_legacy_greeting(client_socket):
+    """读取服务端连接后立即发送的文件列表，输出: (列表部分（不含 <<EOF>>）, 列表之后已经收到的数据)"""
+    data = bytearray()
+    while True:
+        end = data.find(b'<<EOF>>')
+        if end >= 0:
+            return bytes(data[:end]), bytes(data[end + len(b'<<EOF>>'):])
+        packet = client_socket.recv(64 * 1024)
+        if not packet:
+            raise ConnectionError('服务器在发送文件列表之前关闭了连接')
+        data += packet
 
-            # 创建并启动 FileDownloadThread 线程来接收并解压缩 ZIP 文件
-            zip_file_path = os.path.join(download_folder, folder_name + ".zip")
-            file_download_thread = FileDownloadThread(
-                client_socket, folder_name + ".zip", file_size, download_folder)
-            file_download_thread.start()
-            file_download_thread.join()
-            print("正在计算SHA-1...")
-            # 计算 ZIP 文件的 SHA-1 值
-            sha1_hash = hashlib.sha1()
-            with open(zip_file_path, 'rb') as zip_file:
-                while True:
-                    data = zip_file.read(buf_size)
-                    if not data:
-                        break
-                    sha1_hash.update(data)
-            zip_file_sha1 = sha1_hash.hexdigest()
 
-            # 解压文件到临时文件夹
-            temp_extract_folder = os.path.join(download_folder, 'temp_extract')
-            with zipfile.ZipFile(zip_file_path, 'r') as zip_ref:
-                zip_ref.extractall(temp_extract_folder)
+def open_connection(server_ip, protocol=None):
+    """
+    连接服务器并协商协议。新旧服务端都在连接后立即发送文件列表，新版服务端的列表以换行结尾。
+    输入:
+    - protocol: 覆盖配置中的 protocol；framed 时不等文件列表立即握手，省去一次往返
+    输出:
+    - (套接字, ClientSession, None)；服务器只支持旧协议或 protocol 为 legacy 时返回 (套接字, None, 文件列表)
+    """
+    host, port = server_ip.rsplit(':', 1)
+    client_socket = open_tcp_connection(host, int(port), client_options)
+    protocol = (protocol or client_options["protocol"]).lower()
+    handshake_start = time.perf_counter()
+    if protocol == 'framed':
+        client_socket.sendall(PROTOCOL_MAGIC + bytes([PROTOCOL_VERSION]))
+    listing, rest = read_legacy_greeting(client_socket)
+    if protocol != 'framed':
+        if protocol == 'legacy' or not listing.endswith(b'\n'):
+            # 旧版服务端（或空的共享文件夹，这时两种协议都没有可下载的内容）
+            return client_socket, None, listing.decode().splitlines()
+        handshake_start = time.perf_counter()
+        client_socket.sendall(PROTOCOL_MAGIC + bytes([PROTOCOL_VERSION]))
+    connection = FramedConnection(client_socket)
+    connection.recv_buffer += rest
+    reply = connection.recv_exact(len(PROTOCOL_MAGIC) + 1)
+    if reply is None or reply[:len(PROTOCOL_MAGIC)] != PROTOCOL_MAGIC:
+        raise ProtocolError('服务器不支持分帧协议')
+    connection.version = reply[-1]
+    connection.tuner = SocketTuner(client_socket, client_options, "recv_buffer_kb", '\n')
+    # 握手恰好是一次往返
+    connection.tuner.note_rtt(time.perf_counter() - handshake_start)
+    return client_socket, ClientSession(connection, server_ip), None
 
-            # 获取压缩文件中的文件结构信息
-            files_structure = []
-            for root, dirs, files in os.walk(temp_extract_folder):
-                for file in files:
-                    file_path = os.path.join(root, file)
-                    rel_path = os.path.relpath(file_path, temp_extract_folder)
-                    files_structure.append((file_path, rel_path))
 
-            # 根据文件结构信息将文件移动到下载文件夹的相应位置
-            for file_path, rel_path in files_structure:
-                target_path = os.path.join(
-                    download_folder+"\\"+folder_name, rel_path)
-                os.makedirs(os.path.dirname(target_path), exist_ok=True)
+def open_session(server_ip):
+    """以分帧协议连接服务器（已知服务端支持），输出: (套接字, ClientSession)"""
+    client_socket, session, _ = open_connection(server_ip, 'framed')
+    return client_socket, session
 
 
-            for file_path, rel_path in files_structure:
-                target_path = os.path.join(download_folder+"\\"+folder_name, rel_path)
-                os.makedirs(os.path.dirname(target_path), exist_ok=True)
+def run_client(server_ip, download_folder):
+    global client_options
+    client_socket = None
+    metrics_path = None
+    metrics.begin_session('client', server_ip)
+    try:
+        client_options = load_client_options()
+        metrics_path = client_options["metrics_file"]
+        with metrics.span('connect'):
+            client_socket, session, file_list = open_connection(server_ip)
+        print('已连接至服务器 %s' % server_ip)
+        if session is None:
+            print('[Client]Legacy protocol')
+            run_legacy_client(client_socket, download_folder, file_list)
+        else:
+            run_framed_client(session, download_folder)
+    except Exception as e:
+        print(f"运行客户端时出错：{e}\n=========================")
+        input('Press Enter to restart client')
+    finally:
+        if client_socket is not None:
+            client_socket.close()
+        metrics.end_session()
+        if metrics_path:
+            try:
+                write_metrics_file(metrics_path)
+            except OSError as e:
+                print('写入指标文件失败：' + str(e))
 
 
-            # 如果目标文件已经存在，重命名文件
-            if os.path.exists(target_path):
-                base_name, ext = os.path.splitext(target_path)
-                index = 1
-                while os.path.exists(base_name + f"_{index}" + ext):
-                    index += 1
-                new_target_path = base_name + f"_{index}" + ext
-                print(f"文件 '{target_path}' 已存在，重命名为 '{new_target_path}'")
-                os.rename(file_path, new_target_path)
+def format_size(size):
+    """把字节数格式化为便于阅读的字符串"""
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if size < 1024:
+            return '{:.0f} {}'.format(size, unit) if unit == 'B' else '{:.1f} {}'.format(size, unit)
+        size /= 1024
+    return '{:.1f} TB'.format(size)
+
+
+def format_list_entry(entry):
+    if entry["type"] == "dir":
+        return entry["name"] + '/  <文件夹>'
+    if entry["size"] is None:
+        return entry["name"]
+    return entry["name"] + '  ' + format_size(entry["size"])
+
+
+def run_framed_client(session, download_folder):
+    """分帧协议客户端：同一连接上可以分页浏览、过滤列表并反复下载"""
+    page_size = int(client_options["list_page_size"])
+    offset = 0
+    name_filter = None
+    chosen = {}  # 名称 -> 条目，翻页和筛选时保留已勾选的条目
+    while True:
+        # 含通配符的过滤条件按 glob 匹配，否则按名称前缀匹配
+        pattern = name_filter if name_filter and any(c in name_filter for c in '*?[') else None
+        prefix = name_filter if name_filter and pattern is None else None
+        with metrics.span('list'):
+            listing = session.list_files(offset=offset, limit=page_size, prefix=prefix, pattern=pattern)
+        entries = listing["entries"]
+        if not entries and offset == 0 and name_filter is None:
+            print('服务器文件列表为空')
+            break
+        actions = []
+        if offset + len(entries) < listing["total"]:
+            actions.append(("[下一页]", offset + page_size))
+        if offset > 0:
+            actions.append(("[上一页]", max(0, offset - page_size)))
+        actions.append(("[筛选（前缀或通配符）]", "filter"))
+        if name_filter is not None:
+            actions.append(("[清除筛选]", "clear"))
+        pages = max(1, -(-listing["total"] // page_size))
+        prompt = "请选择要下载的文件（第 {}/{} 页，共 {} 项{}）".format(
+            offset // page_size + 1, pages, listing["total"], "，筛选：" + name_filter if name_filter else "")
+        choice, checked = render_options(1, options=[format_list_entry(entry) for entry in entries] +
+                                         [label for label, _ in actions], prompt=prompt, multi=True,
+                                         selectable=len(entries),
+                                         selected=[i for i, entry in enumerate(entries) if entry["name"] in chosen])
+        checked = set(checked)
+        for i, entry in enumerate(entries):
+            if i in checked:
+                chosen[entry["name"]] = entry
+            else:
+                chosen.pop(entry["name"], None)
+        if choice >= len(entries):
+            action = actions[choice - len(entries)][1]
+            if action == "filter":
+                name_filter = input_box_with_prompt("请输入名称前缀或通配符（如 *.mp4）:") or name_filter
+                offset = 0
+            elif action == "clear":
+                name_filter = None
+                offset = 0
             else:
-                os.rename(file_path, target_path)
-                # 接收并比较 ZIP 文件的 SHA1 值
-                # 接收并比较SHA1值
-            print("正在接收服务端SHA-1(服务端可能正在计算)")
-            server_sha1 = client_socket.recv(buf_size).decode()
-            received_hash = sha1_hash.hexdigest()
-            print("服务器发送的SHA-1校验值：" + received_hash +
-                "\n"+"客户端计算的SHA-1下载值:"+server_sha1)
-            if received_hash == server_sha1:
-                print("文件完整性校验通过")
+                offset = action
+            continue
+        # 回车下载所有勾选的条目，没有勾选时只下载当前条目
+        selection = list(chosen.values()) or [entries[choice]]
+        with metrics.span('download', items=len(selection)) as span:
+            received = metrics.value('bytes_received_total', role='client')
+            if len(selection) == 1:
+                session.download(selection[0]["name"], download_folder)
             else:
-                print("服务器发送的SHA-1校验值：" + received_hash +
-                "\n"+"客户端计算的SHA-1下载值:"+server_sha1)
-                print("文件完整性校验失败")
+                session.download_many(selection, download_folder)
+            # 分段下载的其他连接也计入
+            span["bytes"] = metrics.value('bytes_received_total', role='client') - received
+        chosen.clear()
+        if render_options(1,options=["继续下载","断开连接"],prompt="下载结束，是否继续？") != 0:
+            break
+    session.close()
 
-            # 删除临时文件夹和压缩文
-            shutil.rmtree(temp_extract_folder)
-            os.remove(zip_file_path)
 
-        elif response == 'FILE':
+def run_legacy_client(client_socket, download_folder, file_list):
+    """旧协议客户端：从已收到的文件列表（见 open_connection）中选择并下载一个文件或文件夹"""
+    print('服务器文件列表：')
+    print(file_list)  # 输出文件名列表
+    folder_name_down = render_options(1,options=file_list,prompt="请选择要下载的文件")
+    # 输入要下载的文件或文件夹名称
+    folder_name = file_list[folder_name_down]
+    client_socket.send(folder_name.encode())
+
+    # 接收服务端的响应
+    response = client_socket.recv(buf_size).decode()
+
+    if response in ('ZIP', 'ZSTREAM'):
+        # 压缩包边接收边解压到下载文件夹中的同名文件夹
+        extract_folder = os.path.join(download_folder, folder_name)
+        if response == 'ZSTREAM':
+            # 服务端边压缩边发送，确认后开始接收分块数据
+            client_socket.send(b'OK')
+            file_download_thread = ChunkedDownloadThread(
+                client_socket, folder_name + ".zip", download_folder, extract_folder)
+        else:
+            print("请稍候服务端正在压缩...")
+            # 接收压缩文件大小
             file_size = int(client_socket.recv(buf_size).decode())
+
+            # 创建并启动 FileDownloadThread 线程来接收并解压缩 ZIP 文件
             file_download_thread = FileDownloadThread(
-                client_socket, folder_name, file_size, download_folder)
-            file_download_thread.start()
-            file_download_thread.join()
-            print('文件接收完成！')
-            sha1_hash = hashlib.sha1()
-            print("正在计算SHA-1...")
-            with open(os.path.join(download_folder, folder_name), 'rb') as file:
-                while True:
-                    data = file.read(buf_size)
-                    if not data:
-                        break
-                    sha1_hash.update(data)
+                client_socket, folder_name + ".zip", file_size, download_folder, extract_folder)
+        file_download_thread.start()
+        file_download_thread.join()
+        # ZIP 文件的 SHA-1 已在接收时算好
 
-            # 接收并比较SHA1值
-            server_sha1 = client_socket.recv(buf_size).decode()
-            received_hash = sha1_hash.hexdigest()
-            print("服务器发送的SHA-1校验值：" + received_hash +
-                "\n"+"客户端计算的SHA-1下载值:"+server_sha1)
-            if received_hash == server_sha1:
-                print("文件完整性校验通过")
-            else:
-                print("服务器发送的SHA-1校验值：" + received_hash +
-                        "\n"+"客户端计算的SHA-1下载值:"+server_sha1)
-                
-                print("文件完整性校验失败")
-    except Exception as e:
-        print(f"运行客户端时出错：{e}\n=========================")
-        input('Press Enter to restart client')
-    finally:
-        client_socket.close()
-        time.sleep(1)
+        # 接收并比较 ZIP 文件的 SHA1 值
+        print("正在接收服务端SHA-1(服务端可能正在计算)")
+        server_sha1 = client_socket.recv(buf_size).decode()
+        print_verify_result(file_download_thread.received_sha1, server_sha1)
+
+    elif response == 'FILE':
+        file_size = int(client_socket.recv(buf_size).decode())
+        file_download_thread = FileDownloadThread(
+            client_socket, folder_name, file_size, download_folder)
+        file_download_thread.start()
+        file_download_thread.join()
+        print('文件接收完成！')
+
+        # 接收并比较SHA1值（客户端的 SHA-1 已在接收时算好）
+        server_sha1 = client_socket.recv(buf_size).decode()
+        print_verify_result(file_download_thread.received_sha1, server_sha1)
 
 # 加载服务器配置
 def load_server_config():
@@ -546,6 +5265,45 @@ def load_server_config():
             config.write(configfile)
         return upload_folder,new_server_port
 
+# 服务器可选配置项及默认值（可在 server_config.ini 的 [Server] 节中覆盖）
+SERVER_OPTION_DEFAULTS = {
+    "max_sessions": "16",      # 同时服务的最大客户端数
+    "backlog": "128",          # 监听队列长度
+    "session_timeout": "300",  # 单个会话的套接字超时（秒），0 表示不超时
+    "zero_copy": "true",       # 支持时使用 sendfile 零拷贝发送文件
+    "digest_cache_entries": "10000",  # 文件摘要缓存的最大条目数
+    "zip_stream": "false",     # 旧协议下文件夹边压缩边发送（ZSTREAM 模式，只有本版本的客户端支持）；分帧协议总是边压缩边发送
+    "compress_level": "6",     # 文件夹压缩级别 0-9，0 表示全部存储不压缩
+    "compress_workers": "0",   # 并行压缩的进程数，0 表示使用全部 CPU 核心
+    "archive_cache_mb": "1024",  # 文件夹压缩包缓存上限（MB），0 表示关闭缓存
+    "legacy_detect_timeout": "1.0",  # 客户端发来的数据恰好是握手的开头时等待其余部分的时间（秒），超时按旧协议处理
+    "index_ttl": "5",          # 目录列表中文件大小和修改时间的缓存时间（秒）
+    "hash_tree_chunk_kb": "1024",  # 哈希树每块的大小（KB）
+    "compression": "zlib,bz2,lzma",  # 允许客户端协商的传输压缩算法，留空则不压缩
+    "compression_level": "6",  # 客户端未指定时的传输压缩级别 1-9（压缩跟不上链路时会自动降低）
+    "bandwidth_limit_kb": "0",  # 所有客户端合计的发送速度上限（KB/s），0 表示不限速
+    "client_bandwidth_limit_kb": "0",  # 每个客户端（按 IP）的发送速度上限（KB/s），0 表示不限速
+    "small_transfer_kb": "1024",  # 限速时不超过该大小的传输和列表等控制消息优先发送
+    "admin_port": "0",         # 本机管理端口，提供 /metrics、/metrics.json、/profile、/tracemalloc，0 表示关闭
+    "profile_sample": "0",     # 每隔多少个会话对一个会话做 cProfile 采样（结果见 /profile），0 表示关闭
+    "tracemalloc_frames": "0",  # 大于 0 时启用 tracemalloc 并记录这么多层调用栈（结果见 /tracemalloc）
+    "tcp_nodelay": "true",     # 关闭 Nagle 算法，列表、元数据等小消息不必等待客户端的延迟确认
+    "socket_buffer_kb": "auto",  # 套接字收发缓冲区（KB），在连接建立前设置；auto 或 0 表示使用系统的自动调整
+    "io_block_kb": "auto",     # 发送数据帧的大小（KB），auto 按测得的吞吐量在 64KB 到 4MB 之间选择
+    "swarm": "false",          # 是否允许客户端对等分发（默认关闭）：登记各自持有的块，互相传输，服务端只发送还没有节点持有的块
+    "swarm_peer_ttl": "10",    # 对等分发的节点超过该秒数没有重新登记视为已离开
+    "swarm_max_peers": "32",   # 每次登记最多返回的其他节点数
+}
+
+def load_server_options(section=None):
+    """读取服务器可选配置项，未配置的项使用默认值；section 为已读出的 [Server] 节时不再读文件"""
+    if section is None:
+        section = read_config_section(SERVER_CONFIG_PATH, "Server")
+    options = dict(SERVER_OPTION_DEFAULTS)
+    for key in options:
+        options[key] = section.get(key, options[key])
+    return options
+
 # 加载客户端配置
 def load_client_config():
     config = configparser.ConfigParser()
@@ -562,6 +5320,405 @@ def load_client_config():
         with open(CLIENT_CONFIG_PATH, "w") as configfile:
             config.write(configfile)
     return server_ip, download_folder
+# 客户端可选配置项及默认值（可在 client_config.ini 的 [Client] 节中覆盖）
+CLIENT_OPTION_DEFAULTS = {
+    "protocol": "auto",               # auto：自动识别新旧服务端；framed：只用分帧协议；legacy：只用旧协议
+    "pipeline_depth": "32",           # 流水线下载时最多同时在途的请求数
+    "segments": "auto",               # 大文件分段下载的连接数，auto 按文件大小自动选择，1 表示不分段
+    "max_segments": "8",              # auto 模式下的最大分段数
+    "delta": "true",                  # 本地已有旧版本时只下载变化的部分
+    "folder_sync": "true",            # 文件夹按清单只下载变化的文件；false 时整个文件夹打包下载
+    "sync_extras": "keep",            # 同步文件夹时本地多余的文件：keep 保留，delete 删除
+    "list_page_size": "200",          # 浏览服务器列表时每页的条目数
+    "recv_buffer_kb": "auto",         # 接收缓冲区大小（KB），每次最多读入这么多再写盘；auto 按测得的吞吐量在 64KB 到 4MB 之间选择
+    "progress_interval": "0.2",       # 下载进度的刷新间隔（秒）
+    "write_queue_depth": "8",         # 等待写盘的接收缓冲区个数，磁盘变慢时接收线程可先收这么多块
+    "hash_algorithms": "blake2b,sha1",  # 逐块校验使用的哈希树算法（按优先级），留空则只校验整个文件的 SHA-1
+    "compression": "",                # 传输压缩算法（按优先级，可选 zlib、bz2、lzma），留空则不压缩（服务端可用 sendfile 零拷贝发送）
+    "compression_level": "",          # 传输压缩级别 1-9，留空则由服务端决定
+    "batch_writers": "4",             # 批量下载时并发写盘的线程数
+    "metrics_file": "",               # 非空时在客户端退出时把传输指标（JSON）写入该文件
+    "tcp_nodelay": "true",            # 关闭 Nagle 算法，请求不必等待服务端的延迟确认
+    "socket_buffer_kb": "auto",       # 套接字收发缓冲区（KB），在连接建立前设置；auto 或 0 表示使用系统的自动调整
+    "swarm": "false",                 # 普通文件与同时下载它的其他客户端对等分发（服务端需开启 swarm）
+    "swarm_port": "0",                # 对等服务监听的端口，0 表示随机选择（有防火墙时指定固定端口）
+    "swarm_connections": "4",         # 对等分发时同时取块的线程数
+    "swarm_announce_interval": "0.5",  # 对等分发时向服务端重新登记、刷新其他节点块图的间隔（秒）
+    "swarm_seed_idle": "5",           # 下载完成后做种，这么多秒没有节点来取块即停止
+}
+
+def load_client_options(section=None):
+    """读取客户端可选配置项，未配置的项使用默认值；section 为已读出的 [Client] 节时不再读文件"""
+    if section is None:
+        section = read_config_section(CLIENT_CONFIG_PATH, "Client")
+    options = dict(CLIENT_OPTION_DEFAULTS)
+    for key in options:
+        options[key] = section.get(key, options[key])
+    return options
+
+
+def read_config_section(path, section):
+    """读取配置文件中的一节，文件或该节不存在时返回空字典（不提示输入）"""
+    config = configparser.ConfigParser()
+    config.read(path)
+    return dict(config[section]) if config.has_section(section) else {}
+
+
+# ---------------- 无交互模式与 Python 接口 ----------------
+# 命令行子命令和下面的函数都不弹出菜单、不提示输入：配置文件中缺少的项使用默认值，调用时可以覆盖。
+# 作为库导入时可直接调用 serve / list_remote / get_remote / sync_remote / run_jobs。
+def merge_options(options, overrides):
+    """把覆盖值（值会转为字符串）合并到配置项中，键必须是已有的配置项"""
+    for key, value in (overrides or {}).items():
+        if key not in options:
+            raise ValueError('未知的配置项: ' + str(key))
+        options[key] = str(value)
+    return options
+
+
+def apply_client_options(overrides=None):
+    """读取客户端配置项并应用覆盖值，结果作为当前的 client_options"""
+    global client_options
+    client_options = merge_options(load_client_options(), overrides)
+    return client_options
+
+
+def connect(server_ip):
+    """
+    连接服务器并返回分帧协议会话。
+    无交互模式只支持新版服务端，直接发送握手而不等待旧版服务端的探测超时；
+    服务端只支持旧协议时抛出 ProtocolError。
+    """
+    if 'client_options' not in globals():
+        apply_client_options()
+    return open_session(server_ip)[1]
+
+
+def disconnect(session):
+    session.close()
+    session.connection.sock.close()
+
+
+@contextmanager
+def remote_session(server_ip, session=None):
+    """传入了会话时直接使用（由调用者关闭），否则临时连接并在结束时断开"""
+    if session is not None:
+        yield session
+        return
+    session = connect(server_ip)
+    try:
+        yield session
+    finally:
+        disconnect(session)
+
+
+def serve(folder, port, options=None):
+    """无交互地启动服务端，一直运行到进程结束；options 覆盖 server_config.ini 中的可选项"""
+    global server_files_folder, server_port
+    server_files_folder, server_port = folder, str(port)
+    run_server(merge_options(load_server_options(), options))
+
+
+def list_remote(server_ip, path='', prefix=None, pattern=None, session=None):
+    """
+    列出服务器目录中的全部条目（自动翻页）。
+    输出:
+    - [{"name", "type", "size", "mtime_ns"}]，名称相对于 path
+    """
+    with remote_session(server_ip, session) as session:
+        page_size = int(client_options["list_page_size"])
+        entries = []
+        while True:
+            listing = session.list_files(path, len(entries), page_size, prefix, pattern)
+            entries += listing["entries"]
+            if not listing["entries"] or len(entries) >= listing["total"]:
+                return entries
+
+
+def get_remote(server_ip, names, download_folder, session=None):
+    """
+    下载一个或多个条目（名称相对于共享文件夹），多个普通文件合并为一个批量请求。
+    输出:
+    - 是否全部校验通过
+    """
+    if isinstance(names, str):
+        names = [names]
+    os.makedirs(download_folder, exist_ok=True)
+    with remote_session(server_ip, session) as session:
+        if len(names) == 1:
+            return session.download(names[0], download_folder)
+        # 流水线发出全部 STAT，读完所有响应后再报告不存在的条目，保证会话仍可继续使用
+        request_ids = [session.send_request(MSG_STAT, {"name": name}) for name in names]
+        entries = []
+        missing = []
+        for name, request_id in zip(names, request_ids):
+            try:
+                meta = session.read_response(request_id, (MSG_META,))[1]
+            except RequestError as e:
+                missing.append('{}: {}'.format(name, e))
+                continue
+            entries.append({"name": name, "type": "file" if meta["mode"] == "FILE" else "dir",
+                            "size": meta["size"]})
+        if missing:
+            raise RequestError('; '.join(missing))
+        return session.download_many(entries, download_folder)
+
+
+def sync_remote(server_ip, name, download_folder, session=None):
+    """
+    把服务器上的文件夹同步到本地（不受 folder_sync 配置影响），普通文件按 download 处理。
+    输出:
+    - 是否全部校验通过
+    """
+    os.makedirs(download_folder, exist_ok=True)
+    with remote_session(server_ip, session) as session:
+        if session.stat(name)["mode"] == "ZIP":
+            return session.sync_folder(name, download_folder)
+        return session.download(name, download_folder)
+
+
+class SessionPool:
+    """按服务器地址复用空闲会话，供并行执行的任务共用；出错的任务不归还会话"""
+    def __init__(self):
+        self.lock = Lock()
+        self.idle = {}
+
+    def acquire(self, server_ip):
+        with self.lock:
+            sessions = self.idle.get(server_ip)
+            if sessions:
+                return sessions.pop()
+        return connect(server_ip)
+
+    def release(self, server_ip, session):
+        with self.lock:
+            self.idle.setdefault(server_ip, []).append(session)
+
+    def close(self):
+        with self.lock:
+            sessions = [session for idle in self.idle.values() for session in idle]
+            self.idle.clear()
+        for session in sessions:
+            try:
+                disconnect(session)
+            except OSError:
+                pass
+
+
+def run_job(job, server_ip, download_folder, pool):
+    """
+    执行一个任务。
+    输入:
+    - job: {"action": "get" | "sync" | "list", "names" / "name" / "path" / "prefix" / "glob",
+      可选 "server" 和 "download_folder" 覆盖任务文件中的默认值}
+    输出:
+    - {"job", "ok", "seconds", "error"}，list 任务另有 "entries"
+    """
+    result = {"job": job, "ok": False, "seconds": 0.0, "error": None}
+    start_time = time.perf_counter()
+    server_ip = job.get("server", server_ip)
+    download_folder = job.get("download_folder", download_folder)
+    session = None
+    try:
+        action = job.get("action", "get")
+        if not server_ip:
+            raise ValueError('未指定服务器')
+        if action not in ("get", "sync", "list"):
+            raise ValueError('未知的任务类型: ' + str(action))
+        session = pool.acquire(server_ip)
+        if action == "list":
+            result["entries"] = list_remote(server_ip, job.get("path", ''), job.get("prefix"), job.get("glob"),
+                                            session=session)
+            result["ok"] = True
+        elif action == "get":
+            result["ok"] = get_remote(server_ip, job.get("names") or job["name"], download_folder, session=session)
+        else:
+            result["ok"] = sync_remote(server_ip, job["name"], download_folder, session=session)
+        pool.release(server_ip, session)
+    except Exception as e:
+        # 任何错误都只记在本任务的结果中，不影响其他任务
+        result["error"] = '{}: {}'.format(type(e).__name__, e)
+        if session is not None:
+            # 出错后会话状态未知（可能还有未读完的响应），直接断开
+            session.connection.sock.close()
+    result["seconds"] = time.perf_counter() - start_time
+    return result
+
+
+def run_jobs(jobs, server_ip=None, download_folder='.', parallel=1):
+    """
+    依次或并行执行多个传输任务，同一服务器的连接在任务间复用。
+    输入:
+    - jobs: run_job 接受的任务列表
+    - parallel: 同时执行的任务数，1 表示逐个执行
+    输出:
+    - 与 jobs 顺序相同的结果列表
+    """
+    pool = SessionPool()
+    try:
+        if parallel <= 1:
+            return [run_job(job, server_ip, download_folder, pool) for job in jobs]
+        with ThreadPoolExecutor(max_workers=parallel) as executor:
+            return list(executor.map(lambda job: run_job(job, server_ip, download_folder, pool), jobs))
+    finally:
+        pool.close()
+
+
+def build_arg_parser():
+    import argparse
+    parser = argparse.ArgumentParser(description='局域网文件传输：不带参数运行时进入交互菜单')
+    parser.add_argument('-q', '--quiet', action='store_true', help='不输出进度等提示信息（默认输出到 stderr）')
+    parser.add_argument('-o', '--option', action='append', default=[], metavar='KEY=VALUE',
+                        help='覆盖配置文件中的可选项，可重复')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    command = commands.add_parser('serve', help='启动服务端')
+    command.add_argument('--folder', help='共享文件夹，默认取 server_config.ini 的 upload_folder')
+    command.add_argument('--port', help='监听端口，默认取 server_config.ini 的 new_server_port')
+    command.set_defaults(handler=command_serve)
+
+    command = commands.add_parser('list', help='列出服务器上的文件')
+    command.add_argument('path', nargs='?', default='', help='要列出的目录（相对于共享文件夹）')
+    command.add_argument('--prefix', help='只列出以此开头的名称')
+    command.add_argument('--glob', help='只列出匹配通配符的名称')
+    command.add_argument('--json', action='store_true', help='以 JSON 输出完整条目')
+    command.set_defaults(handler=command_list)
+
+    command = commands.add_parser('get', help='下载文件或文件夹')
+    command.add_argument('names', nargs='+')
+    command.set_defaults(handler=command_get)
+
+    command = commands.add_parser('sync', help='把服务器上的文件夹同步到本地')
+    command.add_argument('name')
+    command.set_defaults(handler=command_sync)
+
+    command = commands.add_parser('job', help='执行 JSON 任务文件中的多个传输')
+    command.add_argument('file', help='任务文件，"-" 表示从标准输入读取')
+    command.add_argument('--parallel', type=int, help='同时执行的任务数，覆盖任务文件中的 parallel')
+    command.add_argument('--json', action='store_true', help='以 JSON 输出每个任务的结果')
+    command.set_defaults(handler=command_job)
+
+    for name in ('list', 'get', 'sync', 'job'):
+        command = commands.choices[name]
+        command.add_argument('--server', help='服务器地址 IP:端口，默认取 client_config.ini 的 server_ip')
+        if name != 'list':
+            command.add_argument('--dest', help='下载文件夹，默认取 client_config.ini 的 download_folder')
+    return parser
+
+
+def parse_overrides(pairs):
+    overrides = {}
+    for pair in pairs:
+        key, separator, value = pair.partition('=')
+        if not separator:
+            raise ValueError('配置项格式应为 KEY=VALUE: ' + pair)
+        overrides[key.strip()] = value.strip()
+    return overrides
+
+
+def client_defaults(args):
+    """命令行未指定服务器和下载文件夹时取 client_config.ini 中的值"""
+    section = read_config_section(CLIENT_CONFIG_PATH, "Client")
+    apply_client_options(parse_overrides(args.option))
+    server_ip = args.server or section.get("server_ip")
+    download_folder = getattr(args, 'dest', None) or section.get("download_folder") or '.'
+    return server_ip, download_folder
+
+
+def require_server(server_ip):
+    if not server_ip:
+        raise ValueError('未指定服务器（--server 或 client_config.ini 的 server_ip）')
+    return server_ip
+
+
+def command_serve(args, output):
+    global server_files_folder, server_port
+    section = read_config_section(SERVER_CONFIG_PATH, "Server")
+    folder = args.folder or section.get("upload_folder")
+    port = args.port or section.get("new_server_port")
+    if not folder or not port:
+        raise ValueError('未指定共享文件夹或端口（--folder/--port 或 server_config.ini）')
+    server_files_folder, server_port = folder, port
+    try:
+        run_server(merge_options(load_server_options(section), parse_overrides(args.option)))
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+def command_list(args, output):
+    server_ip, download_folder = client_defaults(args)
+    entries = list_remote(require_server(server_ip), args.path, args.prefix, args.glob)
+    if args.json:
+        json.dump(entries, output, ensure_ascii=False, indent=1)
+        output.write('\n')
+    else:
+        for entry in entries:
+            output.write(format_list_entry(entry) + '\n')
+    return 0
+
+
+def command_get(args, output):
+    server_ip, download_folder = client_defaults(args)
+    return 0 if get_remote(require_server(server_ip), args.names, download_folder) else 1
+
+
+def command_sync(args, output):
+    server_ip, download_folder = client_defaults(args)
+    return 0 if sync_remote(require_server(server_ip), args.name, download_folder) else 1
+
+
+def command_job(args, output):
+    """任务文件: {"server", "download_folder", "parallel", "options": {客户端配置项}, "jobs": [任务...]}"""
+    if args.file == '-':
+        job_file = json.load(sys.stdin)
+    else:
+        with open(args.file, 'r', encoding='utf-8') as file:
+            job_file = json.load(file)
+    args.option = ['{}={}'.format(key, value) for key, value in job_file.get("options", {}).items()] + args.option
+    server_ip, download_folder = client_defaults(args)
+    server_ip = args.server or job_file.get("server") or server_ip
+    download_folder = args.dest or job_file.get("download_folder") or download_folder
+    parallel = args.parallel or int(job_file.get("parallel", 1))
+    results = run_jobs(job_file["jobs"], server_ip, download_folder, parallel)
+    if args.json:
+        json.dump(results, output, ensure_ascii=False, indent=1)
+        output.write('\n')
+    else:
+        for result in results:
+            job = result["job"]
+            target = ' '.join(job.get("names") or [job.get("name") or job.get("path", '')])
+            output.write('{:<4} {:>8.2f}s {} {}{}\n'.format(
+                'ok' if result["ok"] else 'FAIL', result["seconds"], job.get("action", "get"), target,
+                '  ' + result["error"] if result["error"] else ''))
+    return 0 if all(result["ok"] for result in results) else 1
+
+
+def main(argv=None):
+    """
+    命令行入口：不带参数时进入交互菜单，否则按子命令无交互地执行。
+    提示信息和进度输出到 stderr（--quiet 时丢弃），stdout 只输出结果，便于在脚本中使用。
+    输出:
+    - 进程退出码，0 表示成功
+    """
+    argv = sys.argv[1:] if argv is None else argv
+    if not argv:
+        start()
+        return 0
+    args = build_arg_parser().parse_args(argv)
+    output = sys.stdout
+    with open(os.devnull, 'w') if args.quiet else nullcontext(sys.stderr) as chatter:
+        with redirect_stdout(chatter):
+            try:
+                return args.handler(args, output)
+            except (OSError, ProtocolError, RequestError, ValueError, KeyError) as e:
+                sys.stderr.write('错误：{}: {}\n'.format(type(e).__name__, e))
+                return 1
+            except KeyboardInterrupt:
+                # 与 shell 的约定一致：被 SIGINT 中断时退出码为 128 + 2；未完成的下载留有日志，可再次运行续传
+                sys.stderr.write('已中断\n')
+                return 130
+
 def clear_console():
     """ 清屏，模拟类似 curses 的效果 """
     os.system('cls' if os.name == 'nt' else 'clear')
@@ -599,22 +5756,22 @@ def display_aligned_text(text_list, alignment='left', padding=2):
 
 
 def start():
-    print('loading')
-    time.sleep(1)
     global server_files_folder,server_port
     while True:
         pdyj = str(render_options(1,options=['服务器(发送)', '客户端(接受)' ,'修改配置',"**更新日志**"],prompt='===============\n版本B0.5.7\nGUI TESTING VERISON\nTESTING VER:BUILD - 4\n==============='))
-        time.sleep(1)
         if pdyj == '0':
             # total_steps = 100
             # for i in range(total_steps + 1):
             #     show_progress_bar(i, total_steps)
             #     time.sleep(0.01)  # 模拟一些操作
             clear_console()
-            server_files_folder = load_server_config()[0]
-            server_port = load_server_config()[1]
-            run_server()
-            start()
+            server_files_folder, server_port = load_server_config()
+            try:
+                run_server()
+            except OSError as e:
+                # 监听套接字无法建立（如端口被占用）
+                print('[Main_Server_Output]ERROR!:'+str(e))
+                input('[Main_Server_Output]Press Enter to contiune...')
         elif pdyj == '1':
             # total_steps = 100
             # for i in range(total_steps + 1):
@@ -623,7 +5780,6 @@ def start():
             clear_console()
             client_ip, client_download_folder = load_client_config()
             run_client(client_ip, client_download_folder)
-            start()
         elif pdyj == '3':
             clear_console()
             config_choice2 = render_options(1,options=["确定"],prompt="Update Log\n更新日志\nVerison:B 0.5.7 GUI_TESTING VER - BUILD 3\n1.全新GUI画面\n2.修复MD5和BASE64编码问题\n3.加入输入框\n4.列表滚动不再闪烁(引用了转义符)")
@@ -639,11 +5795,11 @@ def start():
                 new_server_port = input_box_with_prompt(prompt="请输入新的服务器端口: ")
                 if(new_server_port == False):
                     render_options(1,options=["确定"],prompt="请重新选择并输入")
-                    start()
+                    continue
                 new_upload_folder = input_box_with_prompt(prompt="请输入新的服务器上传文件夹路径:\n(若你输的路径带有中文 请输入chinese进行input输入)")
                 if(new_upload_folder == False):
                     render_options(1,options=["确定"],prompt="请重新选择并输入")
-                    start()
+                    continue
                 if(new_upload_folder == "chinese"):
                     new_upload_folder = input("请输入新的服务器上传文件夹路径:")
                 
@@ -653,7 +5809,6 @@ def start():
                 with open(SERVER_CONFIG_PATH, "w") as configfile:
                     config.write(configfile)
                 print("服务器配置已更新")
-                start()
             elif config_choice == '2':
                 config = configparser.ConfigParser()
                 config.read(CLIENT_CONFIG_PATH)
@@ -661,11 +5816,11 @@ def start():
                 new_server_ip = input_box_with_prompt(prompt="请输入新的服务器IP(xxx.xxx.xx.xx:port):")
                 if(new_server_ip == False):
                     render_options(1,options=["确定"],prompt="请重新选择并输入")
-                    start()
+                    continue
                 new_download_folder = input_box_with_prompt(prompt="请输入新的客户端下载文件夹路径:\n(若你输的路径带有中文 请输入chinese进行input输入)")
                 if(new_download_folder == False):
                     render_options(1,options=["确定"],prompt="请重新选择并输入")
-                    start()
+                    continue
                 if(new_download_folder == "chinese"):
                     new_download_folder = input("请输入新的客户端下载文件夹路径: ")
                 print(new_download_folder)
@@ -674,13 +5829,12 @@ def start():
                 with open(CLIENT_CONFIG_PATH, "w") as configfile:
                     config.write(configfile)
                 print("客户端配置已更新")
-                start()
             else:
                 print('错误数值，请重新输入')
-                start()
         else:
             print('错误数值，请重新输入')
-            start()
-    
 
-start()
+
+if __name__ == '__main__':
+    # 压缩进程池在 Windows 下以 spawn 方式重新导入本文件，入口必须受保护
+    sys.exit(main())
@@ -0,0 +1,660 @@
+"""
+IPV4Files 回环基准测试。
+
+在本机为每个用例启动一个服务端子进程，再启动一个客户端子进程通过分帧协议（不经过交互界面）下载测试数据，
+记录吞吐量、首字节时间、双方的 CPU 时间和峰值内存。结果保存为 JSON，可与之前保存的基准结果比较，
+有指标变差超过容差时以退出码 1 结束，便于在改动前后对比或在 CI 中发现性能回退。
+
+用法:
+    python benchmark.py                                  # 快速用例
+    python benchmark.py --full                           # 1KB 到 4GB 的文件、1/4/16 个并发客户端
+    python benchmark.py --sizes 1K,1G --clients 1,8 --trees 5000x4K
+    python benchmark.py --save-baseline bench_baseline.json
+    python benchmark.py --baseline bench_baseline.json
+    python benchmark.py --server-option compression= --only "tree-*"
+    python benchmark.py --latency-ms 40 --link-mb 20        # 经过模拟的 40ms 往返、20MB/s 链路
+    python benchmark.py --sizes 64M --clients 1,8 --link-mb 20 --client-option swarm=true  # 对等分发
+
+测试数据按固定种子生成，缓存在 --data-dir 中，再次运行时直接复用。
+指定 --latency-ms 或 --link-mb 时，客户端经过本进程中的链路模拟代理连接服务端（所有连接共用同一条链路），
+结果中的 link_utilization 为吞吐量占链路带宽的比例。对等分发时客户端之间直接连接、不经过模拟链路，
+该比例可以超过 100%，即服务端链路之外由客户端互相传输的部分。
+"""
+import collections
+import argparse
+import fnmatch
+import glob
+import importlib.util
+import json
+import os
+import platform
+import random
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+try:
+    import resource
+except ImportError:  # Windows 没有 resource 模块，不统计峰值内存
+    resource = None
+
+BENCH_FORMAT = 1               # 结果 JSON 的格式版本
+QUICK_PRESET = {"sizes": "1K,1M,64M,256M", "clients": "1,4", "trees": "2000x16K"}
+FULL_PRESET = {"sizes": "1K,1M,64M,1G,4G", "clients": "1,4,16", "trees": "2000x16K,200x1M"}
+SIZE_UNITS = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+GENERATE_BLOCK = 1024 * 1024   # 生成测试数据时每次写入的大小
+SERVER_READY_TIMEOUT = 30      # 等待服务端子进程开始监听的时间（秒）
+LINK_READ_SIZE = 64 * 1024     # 链路模拟代理每次读取的大小
+LINK_QUEUE_EXTRA = 256 * 1024  # 链路模拟的排队缓冲：带宽时延积之外最多再积压这么多字节，超出后不再读取发送方
+
+# 与基准比较的指标：(名称, 数值越大越好, 低于该绝对差值时视为噪声)
+COMPARED_METRICS = (
+    ("mb_s", True, 0.0),
+    ("ttfb_ms", False, 2.0),
+    ("client_cpu_s", False, 0.05),
+    ("server_cpu_s", False, 0.05),
+    ("client_peak_rss_mb", False, 5.0),
+    ("server_peak_rss_mb", False, 5.0),
+)
+
+
+def parse_size(text):
+    """'64M' -> 67108864，单位为 1024 进制"""
+    text = text.strip().upper().rstrip('B')
+    if text and text[-1] in SIZE_UNITS:
+        return int(float(text[:-1]) * SIZE_UNITS[text[-1]])
+    return int(text)
+
+
+def format_size(size):
+    for unit in ('G', 'M', 'K'):
+        if size >= SIZE_UNITS[unit] and size % SIZE_UNITS[unit] == 0:
+            return str(size // SIZE_UNITS[unit]) + unit
+    return str(size)
+
+
+def cpu_seconds(children=False):
+    """本进程（所有线程）的用户态加内核态 CPU 时间，children 为 True 时加上已结束的子进程"""
+    times = os.times()
+    total = times.user + times.system
+    if children:
+        total += times.children_user + times.children_system
+    return total
+
+
+def peak_rss_mb():
+    """本进程的峰值常驻内存（MB），不支持的平台返回 None"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux 上单位是 KB，macOS 上是字节
+    return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+
+def find_app():
+    """与本脚本放在一起的 IPV4FILESR-send-recv-*.py，有多个版本时取文件名最大的"""
+    candidates = sorted(glob.glob(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                               'IPV4FILESR-send-recv-*.py')))
+    if not candidates:
+        raise SystemExit('找不到 IPV4FILESR-send-recv-*.py，请用 --app 指定')
+    return candidates[-1]
+
+
+def load_app(app_path):
+    """按路径导入主程序（文件名含连字符，不能直接 import）"""
+    spec = importlib.util.spec_from_file_location('ipv4files_app', app_path)
+    app = importlib.util.module_from_spec(spec)
+    # 登记到 sys.modules 供本进程使用；子进程无法按该名称导入，文件夹压缩会改用线程池
+    sys.modules[spec.name] = app
+    spec.loader.exec_module(app)
+    return app
+
+
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as probe:
+        probe.bind(('127.0.0.1', 0))
+        return probe.getsockname()[1]
+
+
+# ---------------- 测试数据 ----------------
+
+def write_random_file(path, size, seed):
+    """按种子生成不可压缩的内容，先写临时文件再改名，中断后不会留下不完整的数据"""
+    rng = random.Random(seed)
+    temp_path = path + '.tmp'
+    with open(temp_path, 'wb') as file:
+        remaining = size
+        while remaining:
+            n = min(GENERATE_BLOCK, remaining)
+            file.write(rng.randbytes(n))
+            remaining -= n
+    os.replace(temp_path, path)
+
+
+def prepare_file(served_dir, size):
+    name = 'file-' + format_size(size) + '.bin'
+    path = os.path.join(served_dir, name)
+    if not os.path.isfile(path) or os.path.getsize(path) != size:
+        print('生成 ' + name)
+        write_random_file(path, size, size)
+    return name
+
+
+def prepare_tree(served_dir, marker_dir, count, size):
+    """count 个 size 大小的文件，每 100 个放在一个子文件夹中；生成完成后在 marker_dir 中留下标记"""
+    name = 'tree-{}x{}'.format(count, format_size(size))
+    marker = os.path.join(marker_dir, name + '.done')
+    if not os.path.exists(marker):
+        print('生成 ' + name)
+        root = os.path.join(served_dir, name)
+        shutil.rmtree(root, ignore_errors=True)
+        for index in range(count):
+            folder = os.path.join(root, 'd{:03d}'.format(index // 100))
+            os.makedirs(folder, exist_ok=True)
+            write_random_file(os.path.join(folder, 'f{:05d}.bin'.format(index)), size, index)
+        open(marker, 'w').close()
+    return name
+
+
+def build_cases(args, data_dir):
+    """生成测试数据并返回用例列表"""
+    served_dir = os.path.join(data_dir, 'served')
+    marker_dir = os.path.join(data_dir, 'markers')
+    os.makedirs(served_dir, exist_ok=True)
+    os.makedirs(marker_dir, exist_ok=True)
+    clients = [int(c) for c in args.clients.split(',') if c]
+    cases = []
+    for size in [parse_size(s) for s in args.sizes.split(',') if s]:
+        for count in clients:
+            cases.append({"name": "file-{}-c{}".format(format_size(size), count), "kind": "file",
+                          "target": 'file-' + format_size(size) + '.bin', "bytes": size, "clients": count})
+    for tree in [t for t in args.trees.split(',') if t]:
+        files, size = tree.lower().split('x')
+        files, size = int(files), parse_size(size)
+        for mode in ('zip', 'file'):
+            for count in clients:
+                cases.append({"name": "tree-{}x{}-{}-c{}".format(files, format_size(size), mode, count),
+                              "kind": "tree", "mode": mode, "target": 'tree-{}x{}'.format(files, format_size(size)),
+                              "files": files, "file_size": size, "bytes": files * size, "clients": count})
+    if args.only:
+        cases = [case for case in cases if any(fnmatch.fnmatch(case["name"], p) for p in args.only.split(','))]
+    for case in cases:
+        if case["kind"] == "file":
+            prepare_file(served_dir, case["bytes"])
+        else:
+            prepare_tree(served_dir, marker_dir, case["files"], case["file_size"])
+    return served_dir, cases
+
+
+# ---------------- 子进程 ----------------
+
+def read_command(fd):
+    """从文件描述符读一行命令，对端关闭时返回 None"""
+    line = b''
+    while not line.endswith(b'\n'):
+        data = os.read(fd, 1)
+        if not data:
+            return None
+        line += data
+    return line.decode().strip()
+
+
+def reset_server_cpu(app):
+    """结束压缩进程池（之后按需重建），返回包含其已用 CPU 时间的计数起点"""
+    if app.compress_executor is not None:
+        app.compress_executor.shutdown(wait=True)
+        app.compress_executor = None
+    return cpu_seconds(children=True)
+
+
+def child_server(app_path, served_dir, port):
+    """
+    服务端子进程：开始监听后输出 ready。
+    标准输入收到 mark 时重新开始计算 CPU 时间（预热结束），输入关闭后输出 CPU 时间和峰值内存并退出。
+    """
+    real_stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w', encoding='utf-8')
+    app = load_app(app_path)
+    app.server_files_folder = served_dir
+    app.server_port = port
+    app.client_options = app.load_client_options()
+    server = threading.Thread(target=app.run_server, daemon=True)
+    server.start()
+    deadline = time.monotonic() + SERVER_READY_TIMEOUT
+    while True:
+        try:
+            probe, session = app.open_session('127.0.0.1:' + port)
+            break
+        except OSError:
+            # 监听失败（如端口被占用）时 run_server 已经退出
+            if not server.is_alive() or time.monotonic() > deadline:
+                raise
+            time.sleep(0.05)
+    session.close()
+    probe.close()
+    start_cpu = cpu_seconds()
+    print('ready', file=real_stdout, flush=True)
+    # 直接读文件描述符：sys.stdin 的读取方法会在等待期间持有缓冲区的锁，
+    # 压缩进程池 fork 出的子进程启动时要关闭继承来的 sys.stdin，会卡在这把锁上
+    while read_command(sys.stdin.fileno()) is not None:
+        start_cpu = reset_server_cpu(app)
+        print('ok', file=real_stdout, flush=True)
+    # 进程池退出后，它们的 CPU 时间才会计入已结束的子进程
+    print(json.dumps({"cpu_s": reset_server_cpu(app) - start_cpu, "peak_rss_mb": peak_rss_mb()}),
+          file=real_stdout, flush=True)
+    # 监听线程阻塞在 accept 中，直接退出
+    os._exit(0)
+
+
+class FirstByteTimer:
+    """包装客户端套接字，记录第一次收到数据的时间，其余操作交给原套接字"""
+    def __init__(self, sock):
+        self.sock = sock
+        self.first = None
+
+    def __getattr__(self, name):
+        return getattr(self.sock, name)
+
+    def recv(self, size):
+        data = self.sock.recv(size)
+        if data and self.first is None:
+            self.first = time.perf_counter()
+        return data
+
+    def recv_into(self, view):
+        n = self.sock.recv_into(view)
+        if n and self.first is None:
+            self.first = time.perf_counter()
+        return n
+
+
+def run_client(app, server_ip, target, download_folder, barrier, result):
+    """一个并发客户端：握手后等所有客户端就绪，再按交互界面相同的方式下载目标"""
+    try:
+        client_socket, session = app.open_session(server_ip)
+        timer = FirstByteTimer(session.connection.sock)
+        session.connection.sock = timer
+        barrier.wait()
+        result["start"] = time.perf_counter()
+        result["ok"] = bool(session.download(target, download_folder))
+        result["end"] = time.perf_counter()
+        result["ttfb"] = timer.first - result["start"] if timer.first else None
+        session.close()
+        client_socket.close()
+    except Exception as e:
+        barrier.abort()
+        result["ok"] = False
+        result["error"] = repr(e)
+
+
+def child_client(app_path, case_json):
+    """
+    客户端子进程：先下载 warmup 次（不计入结果），输出 warm 并等待标准输入的 go，
+    再按用例重复下载 repeat 次，输出每次的测量结果
+    """
+    case = json.loads(case_json)
+    real_stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w', encoding='utf-8')
+    app = load_app(app_path)
+    app.client_options = app.load_client_options()
+    server_ip = '127.0.0.1:' + case["port"]
+    runs = []
+    for index in range(case["warmup"] + case["repeat"]):
+        if index == case["warmup"]:
+            runs.clear()
+            print('warm', file=real_stdout, flush=True)
+            sys.stdin.readline()
+        folders = [tempfile.mkdtemp(prefix='ipv4bench-dl-') for _ in range(case["clients"])]
+        results = [{} for _ in folders]
+        barrier = threading.Barrier(len(folders))
+        threads = [threading.Thread(target=run_client, args=(app, server_ip, case["target"], folder, barrier, result))
+                   for folder, result in zip(folders, results)]
+        start_cpu = cpu_seconds()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        cpu = cpu_seconds() - start_cpu
+        for folder in folders:
+            shutil.rmtree(folder, ignore_errors=True)
+        ok = all(result.get("ok") for result in results)
+        run = {"ok": ok, "client_cpu_s": round(cpu, 3)}
+        if ok:
+            run["seconds"] = max(r["end"] for r in results) - min(r["start"] for r in results)
+            ttfbs = [r["ttfb"] for r in results if r["ttfb"] is not None]
+            run["ttfb_ms"] = round(statistics.median(ttfbs) * 1000, 2) if ttfbs else None
+        else:
+            run["errors"] = [r["error"] for r in results if "error" in r]
+        runs.append(run)
+    print(json.dumps({"runs": runs, "client_peak_rss_mb": peak_rss_mb()}), file=real_stdout, flush=True)
+
+
+# ---------------- 链路模拟 ----------------
+# 本机回环没有时延，无法体现往返次数、Nagle 算法和窗口大小的影响。代理在两个方向上各模拟一条链路：
+# 数据按带宽依次占用链路，再经过单向时延（往返时延的一半）送达；积压超过带宽时延积加排队缓冲后停止读取发送方，
+# 由 TCP 的流控把压力传回发送方，和真实瓶颈链路的表现一致。
+
+class LinkDirection:
+    """一个方向上的链路，经过它的所有连接共用带宽"""
+    def __init__(self, rate, delay):
+        self.rate = rate
+        self.delay = delay
+        self.lock = threading.Lock()
+        self.free_at = 0.0
+
+    def schedule(self, size):
+        """返回 size 字节的数据送达对端的时间"""
+        with self.lock:
+            now = time.perf_counter()
+            if self.rate:
+                self.free_at = max(self.free_at, now) + size / self.rate
+            else:
+                self.free_at = now
+            return self.free_at + self.delay
+
+
+class LinkPipe:
+    """把 source 收到的数据经过 direction 转发给 target（读、写各一个线程）"""
+    def __init__(self, source, target, direction, queue_limit):
+        self.source = source
+        self.target = target
+        self.direction = direction
+        self.queue_limit = queue_limit
+        self.queue = collections.deque()  # (送达时间, 数据)
+        self.queued = 0
+        self.closed = False
+        self.condition = threading.Condition()
+        threading.Thread(target=self.read_loop, daemon=True).start()
+        threading.Thread(target=self.write_loop, daemon=True).start()
+
+    def read_loop(self):
+        try:
+            while True:
+                with self.condition:
+                    while self.queued >= self.queue_limit:
+                        self.condition.wait()
+                data = self.source.recv(LINK_READ_SIZE)
+                if not data:
+                    break
+                deliver_at = self.direction.schedule(len(data))
+                with self.condition:
+                    self.queue.append((deliver_at, data))
+                    self.queued += len(data)
+                    self.condition.notify_all()
+        except OSError:
+            pass
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+    def write_loop(self):
+        try:
+            while True:
+                with self.condition:
+                    while not self.queue and not self.closed:
+                        self.condition.wait()
+                    if not self.queue:
+                        break
+                    deliver_at, data = self.queue[0]
+                delay = deliver_at - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                self.target.sendall(data)
+                with self.condition:
+                    self.queue.popleft()
+                    self.queued -= len(data)
+                    self.condition.notify_all()
+            self.target.shutdown(socket.SHUT_WR)
+        except OSError:
+            # 一端已断开，关闭另一端让对端也结束
+            self.source.close()
+            self.target.close()
+
+
+class LinkEmulator:
+    """监听本机的一个端口，把每个连接经过模拟链路转发到 target_port"""
+    def __init__(self, target_port, latency, rate):
+        self.target_port = target_port
+        self.upload = LinkDirection(rate, latency / 2)
+        self.download = LinkDirection(rate, latency / 2)
+        self.queue_limit = int(rate * latency) + LINK_QUEUE_EXTRA
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.bind(('127.0.0.1', 0))
+        self.listener.listen(64)
+        self.port = self.listener.getsockname()[1]
+        threading.Thread(target=self.accept_loop, daemon=True).start()
+
+    def accept_loop(self):
+        while True:
+            try:
+                client, _ = self.listener.accept()
+            except OSError:
+                return
+            try:
+                server = socket.create_connection(('127.0.0.1', self.target_port))
+            except OSError:
+                client.close()
+                continue
+            # 代理自身不能引入额外的等待，时延只由模拟决定
+            for sock in (client, server):
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            LinkPipe(client, server, self.upload, self.queue_limit)
+            LinkPipe(server, client, self.download, self.queue_limit)
+
+    def close(self):
+        self.listener.close()
+
+
+# ---------------- 运行与比较 ----------------
+
+def write_config(path, section, values):
+    with open(path, 'w', encoding='utf-8') as config:
+        config.write('[' + section + ']\n')
+        for key, value in values.items():
+            config.write('{} = {}\n'.format(key, value))
+
+
+def parse_overrides(items):
+    overrides = {}
+    for item in items or []:
+        key, _, value = item.partition('=')
+        overrides[key.strip()] = value.strip()
+    return overrides
+
+
+def run_case(case, args, app_path, served_dir):
+    """在独立的配置目录中启动服务端和客户端子进程，返回汇总后的结果"""
+    home = tempfile.mkdtemp(prefix='ipv4bench-home-')
+    port = str(free_port())
+    config_dir = os.path.join(home, 'ipv4files')
+    os.makedirs(config_dir)
+    server_values = {"upload_folder": served_dir, "new_server_port": port}
+    server_values.update(parse_overrides(args.server_option))
+    write_config(os.path.join(config_dir, 'server_config.ini'), 'Server', server_values)
+    client_values = {"server_ip": '127.0.0.1:' + port, "download_folder": home, "protocol": "framed",
+                     "folder_sync": 'true' if case.get("mode") == 'file' else 'false'}
+    client_values.update(parse_overrides(args.client_option))
+    write_config(os.path.join(config_dir, 'client_config.ini'), 'Client', client_values)
+    # 主程序的配置目录取自用户主目录
+    env = dict(os.environ, HOME=home, USERPROFILE=home)
+    script = os.path.abspath(__file__)
+    server = subprocess.Popen([sys.executable, script, '--child-server', app_path, served_dir, port],
+                              stdin=subprocess.PIPE, stdout=subprocess.PIPE, env=env, text=True)
+    link = None
+    try:
+        if server.stdout.readline().strip() != 'ready':
+            raise RuntimeError('服务端子进程启动失败')
+        client_port = port
+        if args.latency_ms or args.link_mb:
+            link = LinkEmulator(int(port), args.latency_ms / 1000, args.link_mb * 1024 * 1024)
+            client_port = str(link.port)
+        child_case = dict(case, port=client_port, repeat=args.repeat, warmup=args.warmup)
+        client = subprocess.Popen([sys.executable, script, '--child-client', app_path, json.dumps(child_case)],
+                                  stdin=subprocess.PIPE, stdout=subprocess.PIPE, env=env, text=True)
+        try:
+            # 预热结束后服务端重新开始计算 CPU 时间，再让客户端开始正式测量
+            if client.stdout.readline().strip() == 'warm':
+                server.stdin.write('mark\n')
+                server.stdin.flush()
+                server.stdout.readline()
+                client.stdin.write('go\n')
+                client.stdin.flush()
+            output = client.communicate(timeout=args.timeout)[0]
+        finally:
+            if client.poll() is None:
+                client.kill()
+                client.wait()
+        if client.returncode != 0:
+            raise RuntimeError('客户端子进程异常退出：' + str(client.returncode))
+        client_report = json.loads(output.strip().splitlines()[-1])
+        server.stdin.close()
+        server_report = json.loads(server.stdout.readline())
+        server.wait(timeout=10)
+    finally:
+        if link is not None:
+            link.close()
+        if server.poll() is None:
+            server.kill()
+            server.wait()
+        shutil.rmtree(home, ignore_errors=True)
+    return summarize(case, client_report, server_report, args.link_mb)
+
+
+def summarize(case, client_report, server_report, link_mb=0):
+    """取各次运行的中位数；任一次下载失败则整个用例记为失败"""
+    runs = client_report["runs"]
+    result = {"bytes": case["bytes"], "clients": case["clients"], "ok": all(run["ok"] for run in runs),
+              "runs": runs, "client_peak_rss_mb": client_report["client_peak_rss_mb"],
+              "server_peak_rss_mb": server_report["peak_rss_mb"],
+              "server_cpu_s": round(server_report["cpu_s"] / len(runs), 3),
+              "client_cpu_s": round(statistics.median(run["client_cpu_s"] for run in runs), 3)}
+    if result["ok"]:
+        all_seconds = [run["seconds"] for run in runs]
+        seconds = statistics.median(all_seconds)
+        result["seconds"] = round(seconds, 4)
+        # 各次运行耗时的相对波动，比较吞吐量时容差至少取该值
+        result["spread"] = round((max(all_seconds) - min(all_seconds)) / seconds, 3)
+        result["mb_s"] = round(case["bytes"] * case["clients"] / seconds / 1024 / 1024, 2)
+        if link_mb:
+            result["link_utilization"] = round(result["mb_s"] / link_mb, 3)
+        ttfbs = [run["ttfb_ms"] for run in runs if run["ttfb_ms"] is not None]
+        result["ttfb_ms"] = round(statistics.median(ttfbs), 2) if ttfbs else None
+    return result
+
+
+def compare(results, baseline, tolerance):
+    """返回变差超过容差的指标列表 [(用例, 指标, 基准值, 本次值)]"""
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if base is None:
+            continue
+        if base.get("ok") and not result.get("ok"):
+            regressions.append((name, "ok", True, False))
+            continue
+        for metric, higher_is_better, noise in COMPARED_METRICS:
+            old, new = base.get(metric), result.get(metric)
+            if old is None or new is None or abs(new - old) <= noise:
+                continue
+            allowed = tolerance
+            if metric == "mb_s":
+                allowed = max(tolerance, base.get("spread", 0), result.get("spread", 0))
+            if (new < old * (1 - allowed)) if higher_is_better else (new > old * (1 + allowed)):
+                regressions.append((name, metric, old, new))
+    return regressions
+
+
+def print_table(results, baseline):
+    header = '{:<28} {:>10} {:>7} {:>9} {:>9} {:>9} {:>9} {:>9}  {}'.format(
+        '用例', 'MB/s', '链路%', '首字节ms', '客户端CPU', '服务端CPU', '客户端MB', '服务端MB', '结果')
+    print(header)
+    for name, result in results.items():
+        mb_s = result.get("mb_s")
+        change = ''
+        base = baseline.get(name, {}).get("mb_s") if baseline else None
+        if base and mb_s:
+            change = ' ({:+.0f}%)'.format((mb_s / base - 1) * 100)
+        utilization = result.get("link_utilization")
+        print('{:<28} {:>10} {:>7} {:>9} {:>9} {:>9} {:>9} {:>9}  {}'.format(
+            name, str(mb_s) + change if mb_s is not None else '-',
+            '{:.0f}'.format(utilization * 100) if utilization is not None else '-', str(result.get("ttfb_ms", '-')),
+            result["client_cpu_s"], result["server_cpu_s"], str(result["client_peak_rss_mb"]),
+            str(result["server_peak_rss_mb"]), '通过' if result["ok"] else '失败'))
+
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] == '--child-server':
+        child_server(*sys.argv[2:5])
+        return
+    if len(sys.argv) > 1 and sys.argv[1] == '--child-client':
+        child_client(*sys.argv[2:4])
+        return
+    parser = argparse.ArgumentParser(description='IPV4Files 回环基准测试')
+    parser.add_argument('--app', help='主程序路径（默认为同目录下的 IPV4FILESR-send-recv-*.py）')
+    parser.add_argument('--full', action='store_true', help='使用完整用例（文件最大 4GB，最多 16 个客户端）')
+    parser.add_argument('--sizes', help='单文件用例的大小，逗号分隔，如 1K,1M,1G')
+    parser.add_argument('--clients', help='并发客户端数，逗号分隔')
+    parser.add_argument('--trees', help='文件夹用例，文件数x单个文件大小，逗号分隔，如 2000x16K；ZIP 和逐文件两种模式各测一次')
+    parser.add_argument('--only', help='只运行名称匹配的用例（通配符，逗号分隔）')
+    parser.add_argument('--repeat', type=int, default=3, help='每个用例的运行次数，取中位数')
+    parser.add_argument('--warmup', type=int, default=1,
+                        help='正式测量前不计入结果的运行次数（预热服务端的摘要缓存和压缩包缓存），0 表示测量冷缓存')
+    parser.add_argument('--timeout', type=float, default=1800, help='单个用例的超时时间（秒）')
+    parser.add_argument('--data-dir', default=os.path.join(tempfile.gettempdir(), 'ipv4files-bench'),
+                        help='测试数据目录，生成后复用')
+    parser.add_argument('--server-option', action='append', metavar='KEY=VALUE', help='覆盖服务端配置项，可重复')
+    parser.add_argument('--client-option', action='append', metavar='KEY=VALUE', help='覆盖客户端配置项，可重复')
+    parser.add_argument('--latency-ms', type=float, default=0, help='模拟链路的往返时延（毫秒），0 表示不模拟')
+    parser.add_argument('--link-mb', type=float, default=0, help='模拟链路的带宽（MB/s），0 表示不限带宽')
+    parser.add_argument('--output', default='bench_results.json', help='结果 JSON 的保存路径')
+    parser.add_argument('--baseline', help='与该基准结果比较，有回退时退出码为 1')
+    parser.add_argument('--save-baseline', help='把本次结果另存为基准')
+    parser.add_argument('--tolerance', type=float, default=0.15,
+                        help='允许的相对变化（默认 0.15 即 15%%；吞吐量取该值与各次运行波动中的较大者）')
+    args = parser.parse_args()
+    preset = FULL_PRESET if args.full else QUICK_PRESET
+    for key, value in preset.items():
+        if getattr(args, key) is None:
+            setattr(args, key, value)
+
+    app_path = os.path.abspath(args.app or find_app())
+    served_dir, cases = build_cases(args, args.data_dir)
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as file:
+            baseline = json.load(file)["cases"]
+
+    results = {}
+    for case in cases:
+        print('运行 ' + case["name"] + ' ...', flush=True)
+        results[case["name"]] = run_case(case, args, app_path, served_dir)
+
+    report = {"format": BENCH_FORMAT, "created": time.strftime('%Y-%m-%dT%H:%M:%S'),
+              "app": os.path.basename(app_path), "python": platform.python_version(),
+              "platform": platform.platform(), "cpu_count": os.cpu_count(), "repeat": args.repeat, "warmup": args.warmup,
+              "link": {"latency_ms": args.latency_ms, "mb_s": args.link_mb},
+              "server_options": parse_overrides(args.server_option),
+              "client_options": parse_overrides(args.client_option), "cases": results}
+    for path in filter(None, (args.output, args.save_baseline)):
+        with open(path, 'w', encoding='utf-8') as file:
+            json.dump(report, file, ensure_ascii=False, indent=2)
+    print()
+    print_table(results, baseline)
+    print('结果已保存到 ' + args.output)
+
+    failed = [name for name, result in results.items() if not result["ok"]]
+    regressions = compare(results, baseline, args.tolerance) if baseline else []
+    for name in failed:
+        print('失败：' + name)
+    for name, metric, old, new in regressions:
+        print('回退：{} {} {} -> {}'.format(name, metric, old, new))
+    if failed or regressions:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
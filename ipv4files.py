@@ -0,0 +1,15 @@
+"""
+以模块名 ipv4files 导入 IPV4FILESR-send-recv-v0.5.70.py 的库接口（主程序的文件名含连字符和点，不能直接 import）。
+
+    import ipv4files
+    ipv4files.get_remote('192.168.1.2:25565', 'a.bin', 'downloads')
+
+主程序的代码在本模块的命名空间中执行，函数的模块名就是 ipv4files，
+服务端的压缩进程池在子进程中按这个名称导入，因此 Windows 等以 spawn 方式创建子进程的平台也能使用进程池。
+"""
+import os
+
+_SOURCE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'IPV4FILESR-send-recv-v0.5.70.py')
+
+with open(_SOURCE_PATH, 'r', encoding='utf-8') as _source:
+    exec(compile(_source.read(), _SOURCE_PATH, 'exec'))
@@ -0,0 +1,88 @@
+import os
+import sys
+import tempfile
+import threading
+import socket
+import time
+
+import pytest
+
+# 配置、摘要缓存和压缩包缓存的目录在导入时由用户目录决定，测试使用独立的临时目录
+_home = tempfile.mkdtemp(prefix='ipv4files-home-')
+os.environ['HOME'] = _home
+os.environ['USERPROFILE'] = _home
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import ipv4files  # noqa: E402
+
+
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def write_file(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as file:
+        file.write(data)
+    return path
+
+
+def read_file(path):
+    with open(path, 'rb') as file:
+        return file.read()
+
+
+class LoopbackServer:
+    """在后台线程中运行的服务端（同一进程只能有一个：服务端配置是模块级全局变量）"""
+    def __init__(self, folder):
+        self.folder = folder
+        self.port = free_port()
+        self.address = '127.0.0.1:{}'.format(self.port)
+        options = ipv4files.load_server_options()
+        options["admin_port"] = str(free_port())
+        self.admin_port = int(options["admin_port"])
+        self.thread = threading.Thread(target=ipv4files.serve, args=(folder, self.port, options), daemon=True)
+        self.thread.start()
+        deadline = time.monotonic() + 10
+        while True:
+            try:
+                socket.create_connection(('127.0.0.1', self.port), timeout=1).close()
+                break
+            except OSError:
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.05)
+
+
+@pytest.fixture(scope='session')
+def app():
+    return ipv4files
+
+
+@pytest.fixture(scope='session')
+def server(tmp_path_factory):
+    return LoopbackServer(str(tmp_path_factory.mktemp('shared')))
+
+
+@pytest.fixture
+def server_options(server, monkeypatch):
+    """修改服务端配置项，测试结束后恢复"""
+    def set_options(**options):
+        for key, value in options.items():
+            monkeypatch.setitem(ipv4files.server_options, key, str(value))
+    return set_options
+
+
+@pytest.fixture
+def client_options(monkeypatch):
+    """以默认客户端配置加覆盖值作为当前配置，测试结束后恢复"""
+    monkeypatch.setattr(ipv4files, 'client_options', ipv4files.load_client_options(), raising=False)
+
+    def set_options(**options):
+        for key, value in options.items():
+            ipv4files.client_options[key] = str(value)
+        return ipv4files.client_options
+    set_options()
+    return set_options
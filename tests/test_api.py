@@ -0,0 +1,69 @@
+import importlib.util
+import os
+import pickle
+import sys
+
+from conftest import read_file, write_file
+
+
+def test_library_module_is_importable_by_name(app):
+    # 压缩进程池按“模块名.函数名”把任务交给子进程
+    assert app.compress_piece.__module__ == 'ipv4files'
+    assert pickle.loads(pickle.dumps(app.compress_piece)) is app.compress_piece
+    assert app.importable_by_name()
+
+
+def test_unregistered_module_falls_back_to_threads(app):
+    spec = importlib.util.spec_from_file_location('ipv4files_unregistered', app._SOURCE_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    assert not module.importable_by_name()
+
+
+def test_module_registered_under_other_name_falls_back_to_threads(app, monkeypatch):
+    # 以 spawn 启动的子进程无法按只登记在本进程 sys.modules 中的名称导入
+    spec = importlib.util.spec_from_file_location('ipv4files_registered', app._SOURCE_PATH)
+    module = importlib.util.module_from_spec(spec)
+    monkeypatch.setitem(sys.modules, spec.name, module)
+    spec.loader.exec_module(module)
+    assert not module.importable_by_name()
+
+
+def test_get_and_list_round_trip(app, server, client_options, tmp_path):
+    data = os.urandom(300000)
+    write_file(os.path.join(server.folder, 'api', 'one.bin'), data)
+    names = [entry["name"] for entry in app.list_remote(server.address, 'api')]
+    assert names == ['one.bin']
+    assert app.get_remote(server.address, 'api/one.bin', str(tmp_path))
+    assert read_file(str(tmp_path / 'api' / 'one.bin')) == data
+
+
+def test_run_jobs_collects_every_failure(app, server, client_options, tmp_path):
+    write_file(os.path.join(server.folder, 'jobs', 'a.txt'), b'a')
+    jobs = [{"action": "get", "names": 5},  # 类型错误：不在常见的网络错误之列
+            {"action": "get", "name": "jobs/missing.txt"},
+            {"action": "get", "name": "jobs/a.txt"},
+            {"action": "unknown"}]
+    for parallel in (1, 3):
+        results = app.run_jobs(jobs, server.address, str(tmp_path / str(parallel)), parallel)
+        assert [result["ok"] for result in results] == [False, False, True, False]
+        assert results[0]["error"].startswith('TypeError')
+        assert results[1]["error"].startswith('RequestError')
+
+
+def test_cli_interrupt_exit_code(app, server, client_options, monkeypatch, tmp_path):
+    def interrupted(*args, **kwargs):
+        raise KeyboardInterrupt
+    monkeypatch.setattr(app, 'get_remote', interrupted)
+    assert app.main(['-q', 'get', 'x', '--server', server.address, '--dest', str(tmp_path)]) == 130
+
+
+def test_cli_job_file(app, server, client_options, tmp_path, capsys):
+    write_file(os.path.join(server.folder, 'cli', 'b.txt'), b'b' * 100)
+    job_file = tmp_path / 'jobs.json'
+    job_file.write_text('{"jobs": [{"name": "cli/b.txt"}, {"name": "cli/none"}]}', encoding='utf-8')
+    code = app.main(['-q', 'job', str(job_file), '--server', server.address, '--dest', str(tmp_path / 'out')])
+    assert code == 1
+    lines = capsys.readouterr().out.splitlines()
+    assert lines[0].startswith('ok') and lines[1].startswith('FAIL')
+    assert read_file(str(tmp_path / 'out' / 'cli' / 'b.txt')) == b'b' * 100
@@ -0,0 +1,34 @@
+import os
+
+from conftest import read_file, write_file
+
+
+def download_folder(app, server, name, dest):
+    session = app.connect(server.address)
+    try:
+        assert session.download(name, dest)
+    finally:
+        session.close()
+
+
+def test_folder_download_reuses_cached_archive(app, server, client_options, tmp_path):
+    client_options(folder_sync='false', compression='')
+    files = {'a.txt': b'archive ' * 2000, 'sub/b.bin': os.urandom(30000)}
+    for name, data in files.items():
+        write_file(os.path.join(server.folder, 'archived', *name.split('/')), data)
+    hits = app.metrics.value('archive_cache_total', result='hit')
+    misses = app.metrics.value('archive_cache_total', result='miss')
+    download_folder(app, server, 'archived', str(tmp_path / 'first'))
+    download_folder(app, server, 'archived', str(tmp_path / 'second'))
+    assert app.metrics.value('archive_cache_total', result='miss') == misses + 1
+    assert app.metrics.value('archive_cache_total', result='hit') == hits + 1
+    for dest in ('first', 'second'):
+        for name, data in files.items():
+            assert read_file(str(tmp_path / dest / 'archived' / name)) == data
+
+    # 文件变化后指纹不同，不会发出旧的压缩包
+    changed = write_file(os.path.join(server.folder, 'archived', 'a.txt'), b'changed')
+    os.utime(changed, ns=(1, 1))
+    download_folder(app, server, 'archived', str(tmp_path / 'third'))
+    assert app.metrics.value('archive_cache_total', result='miss') == misses + 2
+    assert read_file(str(tmp_path / 'third' / 'archived' / 'a.txt')) == b'changed'
@@ -0,0 +1,26 @@
+import os
+
+from conftest import read_file, write_file
+
+
+def test_batch_download_mixed_items(app, server, client_options, tmp_path):
+    client_options(compression='')
+    items = {'batch/small{}.txt'.format(i): os.urandom(100 * i + 1) for i in range(20)}
+    items['batch/large.bin'] = os.urandom(app.BATCH_INLINE_LIMIT + 12345)
+    items['batch/folder/inner.txt'] = b'inside a folder'
+    for name, data in items.items():
+        write_file(os.path.join(server.folder, *name.split('/')), data)
+    names = ['batch/small{}.txt'.format(i) for i in range(20)]
+    names[5:5] = ['batch/missing.txt', 'batch/large.bin', 'batch/folder']
+    before = app.metrics.value('sessions_total', role='server', protocol='framed')
+    session = app.connect(server.address)
+    try:
+        results = session.get_batch(names, str(tmp_path))
+        # 出错的一项不影响同一连接上的其他项和之后的请求
+        assert session.stat('batch/large.bin')["size"] == len(items['batch/large.bin'])
+    finally:
+        session.close()
+    assert results == [name != 'batch/missing.txt' for name in names]
+    assert app.metrics.value('sessions_total', role='server', protocol='framed') == before + 1
+    for name, data in items.items():
+        assert read_file(os.path.join(str(tmp_path), *name.split('/'))) == data
@@ -0,0 +1,61 @@
+import os
+import socket
+
+import pytest
+
+from conftest import read_file, write_file
+
+
+def received_during_get(app, server, name, dest):
+    before = app.metrics.value('bytes_received_total', role='client')
+    session = app.connect(server.address)
+    try:
+        assert session.get(name, dest)
+    finally:
+        session.close()
+    return app.metrics.value('bytes_received_total', role='client') - before
+
+
+@pytest.mark.parametrize('method', ['zlib', 'bz2', 'lzma'])
+def test_compressible_file_is_sent_as_zdata(app, server, client_options, tmp_path, method):
+    if method not in app.TRANSPORT_COMPRESSORS:
+        pytest.skip(method + ' 不可用')
+    client_options(compression=method, hash_algorithms='blake2b')
+    data = b''.join(b'line %d of a very repetitive log file\n' % i for i in range(80000))
+    write_file(os.path.join(server.folder, 'zdata', method + '.log'), data)
+    received = received_during_get(app, server, 'zdata/' + method + '.log', str(tmp_path))
+    assert read_file(str(tmp_path / 'zdata' / (method + '.log'))) == data
+    assert received < len(data) / 4
+
+
+def test_incompressible_file_bypasses_compression(app, server, client_options, tmp_path):
+    client_options(compression='zlib')
+    data = os.urandom(2 * 1024 * 1024)
+    write_file(os.path.join(server.folder, 'zdata', 'random.bin'), data)
+    received = received_during_get(app, server, 'zdata/random.bin', str(tmp_path))
+    assert read_file(str(tmp_path / 'zdata' / 'random.bin')) == data
+    assert received >= len(data)
+
+
+def test_default_get_uses_sendfile(app, server, client_options, monkeypatch, tmp_path):
+    client_options()
+    data = os.urandom(3 * 1024 * 1024)
+    path = write_file(os.path.join(server.folder, 'zdata', 'zero_copy.bin'), data)
+    # 摘要已缓存时无需边发送边计算，整个文件零拷贝发送
+    app.digest_cache.put(path, os.stat(path), app.hashlib.sha1(data).hexdigest())
+    sent = []
+    sendfile = socket.socket.sendfile
+
+    def counting_sendfile(sock, file, offset=0, count=None):
+        n = sendfile(sock, file, offset, count)
+        sent.append(n)
+        return n
+
+    monkeypatch.setattr(socket.socket, 'sendfile', counting_sendfile)
+    session = app.connect(server.address)
+    try:
+        assert session.get('zdata/zero_copy.bin', str(tmp_path))
+    finally:
+        session.close()
+    assert read_file(str(tmp_path / 'zdata' / 'zero_copy.bin')) == data
+    assert sum(sent) == len(data)
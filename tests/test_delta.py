@@ -0,0 +1,41 @@
+import os
+import re
+
+from conftest import read_file, write_file
+
+
+def delta_download(app, server, name, dest):
+    session = app.connect(server.address)
+    try:
+        return session.delta_get(name, dest)
+    finally:
+        session.close()
+
+
+def reused_kb(output):
+    return float(re.search(r'复用本地 ([\d.]+) KB', output).group(1))
+
+
+def test_delta_reconstructs_edited_file(app, server, client_options, tmp_path, capsys):
+    client_options(delta='true')
+    old = os.urandom(600000)
+    new = old[:100000] + b'inserted bytes' + old[100000:400000] + old[450000:] + b'tail'
+    write_file(os.path.join(server.folder, 'delta', 'edited.bin'), new)
+    local_path = write_file(str(tmp_path / 'delta' / 'edited.bin'), old)
+    capsys.readouterr()
+    assert delta_download(app, server, 'delta/edited.bin', str(tmp_path))
+    assert read_file(local_path) == new
+    assert not os.path.exists(local_path + app.DELTA_TEMP_SUFFIX)
+    # 插入和删除之外的部分都从本地旧版本复制
+    assert reused_kb(capsys.readouterr().out) * 1024 > len(new) * 0.8
+
+
+def test_delta_with_unrelated_basis(app, server, client_options, tmp_path, capsys):
+    client_options(delta='true')
+    new = os.urandom(200000)
+    write_file(os.path.join(server.folder, 'delta', 'unrelated.bin'), new)
+    local_path = write_file(str(tmp_path / 'delta' / 'unrelated.bin'), os.urandom(50000))
+    capsys.readouterr()
+    assert delta_download(app, server, 'delta/unrelated.bin', str(tmp_path))
+    assert read_file(local_path) == new
+    assert reused_kb(capsys.readouterr().out) == 0
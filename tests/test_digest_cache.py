@@ -0,0 +1,39 @@
+import hashlib
+import os
+
+from conftest import write_file
+
+
+def test_digest_cache_persists_and_invalidates(app, tmp_path):
+    cache_path = str(tmp_path / 'cache' / 'digest_cache.json')
+    file_path = write_file(str(tmp_path / 'f.bin'), b'first')
+    cache = app.DigestCache(cache_path, 10, save_interval=0)
+    cache.put(file_path, os.stat(file_path), hashlib.sha1(b'first').hexdigest())
+    reloaded = app.DigestCache(cache_path, 10)
+    assert reloaded.get(file_path, os.stat(file_path)) == hashlib.sha1(b'first').hexdigest()
+    # 内容变化（大小或修改时间不同）后旧条目失效
+    write_file(file_path, b'second!')
+    assert reloaded.get(file_path, os.stat(file_path)) is None
+
+
+def test_digest_cache_evicts_least_recently_used(app, tmp_path):
+    cache = app.DigestCache(str(tmp_path / 'digest_cache.json'), 2, save_interval=0)
+    paths = [write_file(str(tmp_path / name), name.encode()) for name in ('a', 'b', 'c')]
+    cache.put(paths[0], os.stat(paths[0]), 'a')
+    cache.put(paths[1], os.stat(paths[1]), 'b')
+    assert cache.get(paths[0], os.stat(paths[0])) == 'a'
+    cache.put(paths[2], os.stat(paths[2]), 'c')
+    assert cache.get(paths[1], os.stat(paths[1])) is None
+    assert app.DigestCache(str(tmp_path / 'digest_cache.json'), 2).get(paths[0], os.stat(paths[0])) == 'a'
+
+
+def test_stat_reports_cached_digest_after_get(app, server, client_options, tmp_path):
+    data = os.urandom(100000)
+    write_file(os.path.join(server.folder, 'digest', 'd.bin'), data)
+    session = app.connect(server.address)
+    try:
+        assert session.get('digest/d.bin', str(tmp_path))
+        # 发送时顺带算出的 SHA-1 进入缓存，之后的 STAT 直接返回
+        assert session.stat('digest/d.bin')["sha1"] == hashlib.sha1(data).hexdigest()
+    finally:
+        session.close()
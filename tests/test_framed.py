@@ -0,0 +1,27 @@
+import pytest
+
+
+def send_raw(session, msg_type, payload):
+    request_id = session.next_request_id
+    session.next_request_id += 1
+    session.connection.send_frame(msg_type, request_id, payload)
+    return request_id
+
+
+def test_malformed_requests_keep_the_session(app, server):
+    session = app.connect(server.address)
+    try:
+        # 全部流水线发出，再按顺序读取响应：错误的请求只得到 ERROR 帧
+        bad = [send_raw(session, app.MSG_LIST, payload) for payload in (b'null', b'[]', b'"x"')]
+        bad.append(session.send_request(app.MSG_LIST, {"offset": "a"}))
+        bad.append(session.send_request(app.MSG_LIST, {"path": 5}))
+        bad.append(session.send_request(app.MSG_BATCH, {"names": 5}))
+        bad.append(session.send_request(app.MSG_GET, {"name": "x", "expect": 1}))
+        good = session.send_request(app.MSG_LIST, {"path": ""})
+        for request_id in bad:
+            with pytest.raises(app.RequestError):
+                session.read_response(request_id, (app.MSG_LIST,))
+        _, listing = session.read_response(good, (app.MSG_LIST,))
+        assert "entries" in listing
+    finally:
+        session.close()
@@ -0,0 +1,72 @@
+import hashlib
+import os
+
+from conftest import read_file, write_file
+
+
+def blake2b(data):
+    return hashlib.blake2b(data, digest_size=32).digest()
+
+
+def test_merkle_root_domain_separation(app):
+    leaves = [blake2b(b'\x00' + bytes([i])) for i in range(3)]
+    hex_leaves = [leaf.hex() for leaf in leaves]
+    assert app.merkle_root(hex_leaves[:1], 'blake2b') == hex_leaves[0]
+    pair = blake2b(b'\x01' + leaves[0] + leaves[1])
+    assert app.merkle_root(hex_leaves[:2], 'blake2b') == pair.hex()
+    # 奇数个节点时最后一个原样进入上一层
+    assert app.merkle_root(hex_leaves, 'blake2b') == blake2b(b'\x01' + pair + leaves[2]).hex()
+    # 内部节点不能当作叶子：两片叶子拼成的数据作为一块时得到不同的根
+    assert app.new_leaf_hash('blake2b', leaves[0] + leaves[1]).hexdigest() != pair.hex()
+
+
+def test_hash_tree_cache_stays_out_of_shared_folder(app, tmp_path):
+    file_path = write_file(str(tmp_path / 'big.bin'), os.urandom(3000))
+    tree = app.load_hash_tree(file_path, os.stat(file_path), 'sha256', 1024)
+    data = read_file(file_path)
+    assert tree["leaves"] == [hashlib.sha256(b'\x00' + data[i:i + 1024]).hexdigest() for i in range(0, 3000, 1024)]
+    assert os.listdir(str(tmp_path)) == ['big.bin']
+    cache_path = app.hash_tree_cache_path(file_path, 'sha256', 1024)
+    assert os.path.dirname(cache_path) == app.HASH_TREE_CACHE_DIR and os.path.isfile(cache_path)
+    assert app.load_hash_tree(file_path, os.stat(file_path), 'sha256', 1024) == tree
+
+
+def test_user_files_with_tree_suffix_are_listed(app, server, client_options):
+    write_file(os.path.join(server.folder, 'treelist', 'notes.ipv4tree'), b'user data')
+    names = [entry["name"] for entry in app.list_remote(server.address, 'treelist')]
+    assert names == ['notes.ipv4tree']
+
+
+def test_corrupted_chunk_is_detected_and_repaired(app, server, server_options, client_options, monkeypatch,
+                                                  tmp_path):
+    server_options(hash_tree_chunk_kb=64)
+    client_options(hash_algorithms='blake2b', compression='', segments=1, delta='false', swarm='false')
+    data = os.urandom(400 * 1024)
+    write_file(os.path.join(server.folder, 'tree', 'data.bin'), data)
+    recv_into = app.FramedConnection.recv_into
+    state = {"received": 0, "corrupted": False}
+
+    def corrupting_recv_into(connection, view):
+        recv_into(connection, view)
+        state["received"] += len(view)
+        # 在第二块中翻转一个字节，模拟传输中损坏的数据
+        if not state["corrupted"] and state["received"] > 100 * 1024:
+            view[0] ^= 0xFF
+            state["corrupted"] = True
+
+    repaired = []
+    repair_chunks = app.ClientSession.repair_chunks
+
+    def counting_repair(session, repair):
+        repaired.extend(repair.verifier.failed)
+        return repair_chunks(session, repair)
+
+    monkeypatch.setattr(app.FramedConnection, 'recv_into', corrupting_recv_into)
+    monkeypatch.setattr(app.ClientSession, 'repair_chunks', counting_repair)
+    session = app.connect(server.address)
+    try:
+        assert session.get('tree/data.bin', str(tmp_path))
+    finally:
+        session.close()
+    assert state["corrupted"] and len(repaired) == 1
+    assert read_file(str(tmp_path / 'tree' / 'data.bin')) == data
@@ -0,0 +1,123 @@
+import io
+import os
+import re
+import socket
+import threading
+import time
+import zipfile
+
+from conftest import write_file
+
+
+def legacy_exchange(server, name):
+    """按旧版客户端的方式完成一次会话：不发送任何数据直到收到文件列表，再发送名称并读到连接关闭"""
+    with socket.create_connection(('127.0.0.1', server.port), timeout=10) as sock:
+        start = time.monotonic()
+        greeting = b''
+        while not greeting.endswith(b'<<EOF>>'):
+            packet = sock.recv(65536)
+            assert packet
+            greeting += packet
+        elapsed = time.monotonic() - start
+        sock.sendall(name.encode())
+        response = b''
+        while True:
+            packet = sock.recv(65536)
+            if not packet:
+                break
+            response += packet
+    return greeting, elapsed, response
+
+
+def parse_response(response, mode):
+    """旧协议响应：模式字符串、十进制大小、数据、40 位十六进制 SHA-1"""
+    assert response.startswith(mode)
+    match = re.match(rb'(\d+)', response[len(mode):])
+    size = int(match.group(1))
+    data = response[len(mode) + len(match.group(1)):]
+    assert len(data) == size + 40
+    return data[:size], data[size:].decode()
+
+
+def test_legacy_folder_exchange(app, server, server_options):
+    server_options(zip_stream='false')
+    files = {'a.txt': b'hello' * 1000, 'sub/b.bin': os.urandom(50000)}
+    for name, data in files.items():
+        write_file(os.path.join(server.folder, 'legacy_dir', *name.split('/')), data)
+    greeting, elapsed, response = legacy_exchange(server, 'legacy_dir')
+    # 旧版客户端按行分割列表：末尾的换行不会产生空文件名
+    assert all(greeting.decode()[:-7].splitlines())
+    assert elapsed < 0.5
+    zip_data, sha1 = parse_response(response, b'ZIP')
+    assert sha1 == app.hashlib.sha1(zip_data).hexdigest()
+    with zipfile.ZipFile(io.BytesIO(zip_data)) as archive:
+        assert {name: archive.read(name) for name in archive.namelist() if not name.endswith('/')} == files
+
+
+def test_legacy_file_exchange(app, server):
+    content = b'x' + os.urandom(100000)
+    write_file(os.path.join(server.folder, 'legacy_file.bin'), content)
+    _, elapsed, response = legacy_exchange(server, 'legacy_file.bin')
+    assert elapsed < 0.5
+    data, sha1 = parse_response(response, b'FILE')
+    assert data == content
+    assert sha1 == app.hashlib.sha1(content).hexdigest()
+
+
+def test_auto_detects_framed_server_without_waiting(app, server, client_options):
+    client_options(protocol='auto')
+    start = time.monotonic()
+    sock, session, file_list = app.open_connection(server.address)
+    try:
+        assert session is not None and file_list is None
+        assert session.list_files('')
+    finally:
+        sock.close()
+    assert time.monotonic() - start < 0.5
+
+
+def test_auto_detects_legacy_server_without_waiting(app, client_options):
+    client_options(protocol='auto')
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(1)
+    received = []
+
+    def baseline_server():
+        # 旧版服务端：连接后立即发送文件列表，然后等待名称
+        conn, _ = listener.accept()
+        with conn:
+            conn.send('\n'.join(['one.txt', 'two']).encode() + b'<<EOF>>')
+            received.append(conn.recv(1024))
+
+    thread = threading.Thread(target=baseline_server, daemon=True)
+    thread.start()
+    start = time.monotonic()
+    sock, session, file_list = app.open_connection('127.0.0.1:{}'.format(listener.getsockname()[1]))
+    try:
+        assert time.monotonic() - start < 0.5
+        assert session is None and file_list == ['one.txt', 'two']
+        sock.sendall(b'two')
+        thread.join(5)
+        assert received == [b'two']
+    finally:
+        sock.close()
+        listener.close()
+
+
+def test_legacy_zstream_with_repo_client(app, server, server_options, client_options, monkeypatch, tmp_path):
+    server_options(zip_stream='true')
+    client_options(protocol='legacy')
+    files = {'one.txt': b'stream ' * 5000, 'nested/two.bin': os.urandom(70000)}
+    for name, data in files.items():
+        write_file(os.path.join(server.folder, 'zstream_dir', *name.split('/')), data)
+    monkeypatch.setattr(app, 'render_options', lambda *args, **kwargs: 0)
+    sock, session, _ = app.open_connection(server.address)
+    try:
+        assert session is None
+        app.run_legacy_client(sock, str(tmp_path), ['zstream_dir'])
+    finally:
+        sock.close()
+    for name, data in files.items():
+        with open(os.path.join(str(tmp_path), 'zstream_dir', *name.split('/')), 'rb') as file:
+            assert file.read() == data
@@ -0,0 +1,29 @@
+import os
+
+from conftest import write_file
+
+
+def test_list_pagination_and_filters(app, server, client_options):
+    client_options(list_page_size=7)
+    for i in range(25):
+        write_file(os.path.join(server.folder, 'listing', 'f{:02d}.{}'.format(i, 'txt' if i % 2 else 'bin')), b'x' * i)
+    os.makedirs(os.path.join(server.folder, 'listing', 'sub'))
+    session = app.connect(server.address)
+    try:
+        first = session.list_files('listing', 0, 10)
+        assert first["total"] == 26 and len(first["entries"]) == 10
+        pages = [entry for offset in range(0, 26, 10)
+                 for entry in session.list_files('listing', offset, 10)["entries"]]
+        assert len(pages) == 26 and len({entry["name"] for entry in pages}) == 26
+        by_name = {entry["name"]: entry for entry in pages}
+        assert by_name["sub"]["type"] == "dir"
+        assert by_name["f07.txt"]["type"] == "file" and by_name["f07.txt"]["size"] == 7
+        prefixed = session.list_files('listing', prefix='f1')
+        assert sorted(entry["name"] for entry in prefixed["entries"]) == ['f{}.{}'.format(i, 'txt' if i % 2 else 'bin')
+                                                                           for i in range(10, 20)]
+        globbed = session.list_files('listing', pattern='*.txt')
+        assert globbed["total"] == 12
+    finally:
+        session.close()
+    # list_remote 按 list_page_size 自动翻页
+    assert {entry["name"] for entry in app.list_remote(server.address, 'listing')} == set(by_name)
@@ -0,0 +1,37 @@
+import json
+import os
+import urllib.error
+import urllib.request
+
+import pytest
+
+from conftest import write_file
+
+
+def fetch(server, path):
+    with urllib.request.urlopen('http://127.0.0.1:{}{}'.format(server.admin_port, path), timeout=10) as response:
+        return response.headers['Content-Type'], response.read().decode('utf-8')
+
+
+def test_admin_port_serves_transfer_metrics(app, server, client_options, tmp_path):
+    data = os.urandom(150000)
+    write_file(os.path.join(server.folder, 'metrics', 'm.bin'), data)
+    assert app.get_remote(server.address, 'metrics/m.bin', str(tmp_path))
+
+    content_type, text = fetch(server, '/metrics')
+    assert content_type.startswith('text/plain; version=0.0.4')
+    assert 'ipv4files_sessions_total{' in text and 'protocol="framed"' in text
+    assert 'ipv4files_phase_seconds_bucket{' in text
+
+    _, body = fetch(server, '/metrics.json')
+    snapshot = json.loads(body)
+    counters = {(counter["name"], tuple(sorted(counter["labels"].items()))): counter["value"]
+                for counter in snapshot["counters"]}
+    assert counters[('bytes_received_total', (('role', 'client'),))] >= len(data)
+    assert any(span.get("name") == 'metrics/m.bin' for span in snapshot["recent_spans"])
+
+
+def test_admin_port_unknown_path(server):
+    with pytest.raises(urllib.error.HTTPError) as error:
+        fetch(server, '/nothing')
+    assert error.value.code == 404
@@ -0,0 +1,36 @@
+import random
+import string
+import time
+
+
+def type_query(option_filter, query):
+    """逐个字符输入查询，返回每次按键的耗时和最终结果"""
+    timings = []
+    result = None
+    for length in range(1, len(query) + 1):
+        start = time.perf_counter()
+        result = option_filter.matches(query[:length])
+        timings.append(time.perf_counter() - start)
+    return timings, result
+
+
+def test_option_filter_narrows_incrementally(app, monkeypatch):
+    rng = random.Random(13)
+    names = [''.join(rng.choice(string.ascii_lowercase + '._') for _ in range(24)) for _ in range(100000)]
+    names[4242] = 'Quarterly_Report_Final.PDF'
+    # 在当前线程中建立索引，避免计时受后台线程影响
+    monkeypatch.setattr(app, 'FILTER_INDEX_THRESHOLD', len(names) + 1)
+    option_filter = app.OptionFilter(names)
+    option_filter.build_index()
+    timings, result = type_query(option_filter, 'report_final')
+    assert result == [index for index, name in enumerate(names) if 'report_final' in name.lower()]
+    assert 4242 in result
+    # 第三个字符起只在上一次结果中比较：每次按键都低于一次全表扫描，之后的按键几乎不花时间
+    start = time.perf_counter()
+    [name for name in option_filter.keys if 'report_final' in name]
+    full_scan = max(time.perf_counter() - start, 0.002)
+    assert max(timings[2:]) < full_scan / 2
+    assert sum(timings[3:]) < full_scan / 2
+    # 退格回到更短的查询时直接复用之前的结果
+    assert option_filter.matches('repo') == [index for index, name in enumerate(names) if 'repo' in name.lower()]
+    assert option_filter.matches('') is None
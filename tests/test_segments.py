@@ -0,0 +1,78 @@
+import os
+import stat
+
+from conftest import read_file, write_file
+
+
+PIECE = 64 * 1024
+
+
+def current_umask():
+    mask = os.umask(0)
+    os.umask(mask)
+    return mask
+
+
+def test_segmented_download_integrity(app, server, client_options, monkeypatch, tmp_path):
+    client_options(segments=4, delta='false', swarm='false')
+    monkeypatch.setattr(app, 'SEGMENT_PIECE_SIZE', PIECE)
+    data = os.urandom(PIECE * 10 + 123)
+    write_file(os.path.join(server.folder, 'seg', 'whole.bin'), data)
+    session = app.connect(server.address)
+    try:
+        meta = session.stat('seg/whole.bin')
+        assert meta["free_sessions"] >= 1
+        assert session.download('seg/whole.bin', str(tmp_path))
+    finally:
+        session.close()
+    file_path = str(tmp_path / 'seg' / 'whole.bin')
+    assert read_file(file_path) == data
+    assert not os.path.exists(file_path + app.DOWNLOAD_JOURNAL_SUFFIX)
+    if os.name != 'nt':
+        assert stat.S_IMODE(os.stat(file_path).st_mode) == 0o666 & ~current_umask()
+
+
+def test_segment_count_is_capped_by_free_sessions(app, client_options):
+    client_options(segments=8)
+    assert app.choose_segment_count(1 << 30) == 8
+    assert app.choose_segment_count(1 << 30, free_sessions=3) == 3
+    assert app.choose_segment_count(1 << 30, free_sessions=0) == 1
+
+
+def test_segmented_download_resumes_after_interruption(app, server, client_options, monkeypatch, tmp_path):
+    client_options(segments=3, delta='false', swarm='false')
+    monkeypatch.setattr(app, 'SEGMENT_PIECE_SIZE', PIECE)
+    monkeypatch.setattr(app, 'JOURNAL_SAVE_INTERVAL', 0)
+    data = os.urandom(PIECE * 12)
+    write_file(os.path.join(server.folder, 'seg', 'resume.bin'), data)
+    file_path = str(tmp_path / 'seg' / 'resume.bin')
+    receive_piece = app.SegmentDownloadThread.receive_piece
+    requested = []
+
+    def interrupted(thread, session, request_id, offset, length):
+        # 每段收完两个区间后断开
+        if thread.segment[2] >= 2 * PIECE:
+            raise app.RequestError('中断')
+        requested.append(offset)
+        receive_piece(thread, session, request_id, offset, length)
+
+    monkeypatch.setattr(app.SegmentDownloadThread, 'receive_piece', interrupted)
+    session = app.connect(server.address)
+    try:
+        assert not session.download('seg/resume.bin', str(tmp_path))
+        journal = app.load_download_journal(file_path)
+        assert [segment[2] for segment in journal["segments"]] == [2 * PIECE] * 3
+        assert len(requested) == 6
+
+        def counted(thread, session, request_id, offset, length):
+            requested.append(offset)
+            receive_piece(thread, session, request_id, offset, length)
+
+        monkeypatch.setattr(app.SegmentDownloadThread, 'receive_piece', counted)
+        assert session.download('seg/resume.bin', str(tmp_path))
+    finally:
+        session.close()
+    # 续传只请求尚未完成的区间
+    assert sorted(requested) == list(range(0, len(data), PIECE))
+    assert read_file(file_path) == data
+    assert app.load_download_journal(file_path) is None
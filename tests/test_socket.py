@@ -0,0 +1,28 @@
+import socket
+
+
+def test_tuner_only_adjusts_block_size(app, client_options):
+    options = client_options(socket_buffer_kb='auto', recv_buffer_kb='auto')
+    left, right = socket.socketpair()
+    try:
+        before = left.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)
+        tuner = app.SocketTuner(left, options, 'recv_buffer_kb', '')
+        tuner.rtt = 0.2
+        tuner.rate = 1024 * 1024 * 1024
+        tuner.adjust()
+        # 已建立的连接上不设置缓冲区，保留系统的自动调整
+        assert left.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF) == before
+        assert tuner.block_size == app.TUNE_BLOCK_RANGE[1]
+    finally:
+        left.close()
+        right.close()
+
+
+def test_fixed_buffers_are_set_before_connect_only(app, client_options):
+    options = client_options(socket_buffer_kb=256)
+    with socket.socket() as unconnected, socket.socket() as accepted:
+        default = accepted.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)
+        app.configure_socket(unconnected, options)
+        app.configure_socket(accepted, options, connected=True)
+        assert unconnected.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF) != default
+        assert accepted.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF) == default
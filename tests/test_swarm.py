@@ -0,0 +1,55 @@
+import os
+import threading
+
+from conftest import read_file, write_file
+
+
+def test_concurrent_swarm_downloads_are_intact(app, server, server_options, client_options, monkeypatch, tmp_path):
+    server_options(swarm='true', hash_tree_chunk_kb=64)
+    client_options(swarm='true', swarm_seed_idle=0.5, swarm_announce_interval=0.1, delta='false')
+    data = os.urandom(3 * 1024 * 1024 + 777)
+    write_file(os.path.join(server.folder, 'swarm', 'rollout.bin'), data)
+    results = {}
+    counts = []
+    run = app.SwarmDownload.run
+
+    def counting_run(swarm):
+        try:
+            return run(swarm)
+        finally:
+            counts.append(dict(swarm.counts))
+
+    monkeypatch.setattr(app.SwarmDownload, 'run', counting_run)
+
+    def download(index):
+        session = app.connect(server.address)
+        try:
+            results[index] = session.download('swarm/rollout.bin', str(tmp_path / str(index)))
+        finally:
+            session.close()
+
+    threads = [threading.Thread(target=download, args=(index,)) for index in range(3)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(60)
+    assert results == {0: True, 1: True, 2: True}
+    # 服务端大约只发出一份数据，其余的块由节点之间互相传输
+    chunks = -(-len(data) // (64 * 1024))
+    assert sum(count["server"] for count in counts) < 2 * chunks
+    assert sum(count["peer"] for count in counts) > 0
+    for index in range(3):
+        assert read_file(str(tmp_path / str(index) / 'swarm' / 'rollout.bin')) == data
+
+
+def test_swarm_disabled_on_server_falls_back_to_get(app, server, server_options, client_options, tmp_path):
+    server_options(swarm='false')
+    client_options(swarm='true', delta='false')
+    data = os.urandom(300000)
+    write_file(os.path.join(server.folder, 'swarm', 'plain.bin'), data)
+    session = app.connect(server.address)
+    try:
+        assert session.download('swarm/plain.bin', str(tmp_path))
+    finally:
+        session.close()
+    assert read_file(str(tmp_path / 'swarm' / 'plain.bin')) == data
@@ -0,0 +1,74 @@
+import hashlib
+import os
+
+import pytest
+
+from conftest import read_file, write_file
+
+
+def manifest_entry(path, data, mtime_ns=1_600_000_000_000_000_000):
+    return {"path": path, "size": len(data), "mtime_ns": mtime_ns, "sha1": hashlib.sha1(data).hexdigest()}
+
+
+@pytest.mark.parametrize('path', ['../evil.txt', 'a/../../evil.txt', 'C:/evil', 'C:evil', ''])
+def test_split_relative_path_rejects_escapes(app, path):
+    with pytest.raises(ValueError):
+        app.split_relative_path(path)
+
+
+def test_plan_folder_sync(app, client_options, tmp_path):
+    client_options(delta='true')
+    root = str(tmp_path / 'local')
+    same = write_file(os.path.join(root, 'same.txt'), b'same')
+    os.utime(same, ns=(1_600_000_000_000_000_000,) * 2)
+    write_file(os.path.join(root, 'touched.txt'), b'touched')
+    write_file(os.path.join(root, 'sub', 'old.bin'), b'old contents')
+    write_file(os.path.join(root, 'extra.txt'), b'extra')
+    write_file(os.path.join(str(tmp_path), 'outside.txt'), b'outside')
+    entries = [manifest_entry('same.txt', b'same'),
+               manifest_entry('touched.txt', b'touched'),
+               manifest_entry('sub/old.bin', b'new contents!'),
+               manifest_entry('missing.txt', b'missing'),
+               manifest_entry('../outside.txt', b'outside'),
+               manifest_entry('/abs.txt', b'abs')]
+    fetch, changed, extras, current = app.plan_folder_sync(entries, root)
+    assert [entry["path"] for entry in fetch] == ['missing.txt']
+    assert [entry["path"] for entry in changed] == ['sub/old.bin']
+    assert [entry["path"] for entry in current] == ['same.txt', 'touched.txt']
+    # 被拒绝的条目不算作本地应有的文件，文件夹之外的文件也不会被列为多余
+    assert extras == [os.path.join(root, 'extra.txt')]
+
+
+def test_sync_folder_round_trip(app, server, client_options, tmp_path):
+    client_options(folder_sync='true', sync_extras='delete', delta='true', swarm='false')
+    files = {'a.txt': b'a' * 5000, 'sub/b.bin': os.urandom(200000), 'sub/deep/c.txt': b'c'}
+    for name, data in files.items():
+        write_file(os.path.join(server.folder, 'syncdir', *name.split('/')), data)
+    local_root = str(tmp_path / 'syncdir')
+    write_file(os.path.join(local_root, 'sub', 'b.bin'), files['sub/b.bin'][:150000] + os.urandom(1000))
+    write_file(os.path.join(local_root, 'stale', 'gone.txt'), b'gone')
+    session = app.connect(server.address)
+    try:
+        assert session.download('syncdir', str(tmp_path))
+    finally:
+        session.close()
+    for name, data in files.items():
+        local_path = os.path.join(local_root, *name.split('/'))
+        assert read_file(local_path) == data
+        server_path = os.path.join(server.folder, 'syncdir', *name.split('/'))
+        assert os.stat(local_path).st_mtime_ns == os.stat(server_path).st_mtime_ns
+    assert not os.path.exists(os.path.join(local_root, 'stale'))
+
+
+def test_sync_folder_keeps_mtime_of_failed_entries(app, server, client_options, monkeypatch, tmp_path):
+    client_options(folder_sync='true', sync_extras='keep', delta='true', swarm='false')
+    write_file(os.path.join(server.folder, 'syncfail', 'f.bin'), b'new' * 1000)
+    local_path = write_file(str(tmp_path / 'syncfail' / 'f.bin'), b'old' * 900)
+    local_mtime = os.stat(local_path).st_mtime_ns
+    monkeypatch.setattr(app.ClientSession, 'delta_get', lambda self, name, download_folder: False)
+    session = app.connect(server.address)
+    try:
+        assert not session.download('syncfail', str(tmp_path))
+    finally:
+        session.close()
+    assert os.stat(local_path).st_mtime_ns == local_mtime
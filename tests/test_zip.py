@@ -0,0 +1,100 @@
+import io
+import os
+import random
+import zipfile
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from conftest import write_file
+
+
+class StreamOnly:
+    """只能顺序写入的输出（没有 seek / tell），模拟套接字流"""
+    def __init__(self):
+        self.buffer = io.BytesIO()
+
+    def write(self, data):
+        self.buffer.write(data)
+        return len(data)
+
+    def getvalue(self):
+        return self.buffer.getvalue()
+
+
+def test_crc32_combine_matches_crc_of_concatenation(app):
+    rng = random.Random(1)
+    for _ in range(50):
+        first = rng.randbytes(rng.randrange(0, 5000))
+        second = rng.randbytes(rng.randrange(0, 5000))
+        combined = app.crc32_combine(zlib.crc32(first), zlib.crc32(second), len(second))
+        assert combined == zlib.crc32(first + second)
+
+
+@pytest.fixture
+def folder(tmp_path):
+    rng = random.Random(2)
+    files = {
+        'empty.txt': b'',
+        'text/a.txt': b'hello world\n' * 5000,
+        'text/deeper/b.log': b''.join(b'line %d\n' % i for i in range(20000)),
+        'random.bin': rng.randbytes(300000),     # 不值得压缩，按存储方式写入
+        'mixed.bin': rng.randbytes(100000) + b'\0' * 200000,  # 多片压缩，使用数据描述符
+        '中文名.txt': '内容'.encode('utf-8'),
+    }
+    for name, data in files.items():
+        write_file(str(tmp_path / 'src' / name), data)
+    return str(tmp_path / 'src'), files
+
+
+def build_zip(app, folder_path, level, executor=None, workers=1, position=0):
+    out = StreamOnly()
+    writer = app.ParallelZipWriter(out, level, executor, workers, piece_size=64 * 1024)
+    writer.position = position
+    writer.add_folder(folder_path)
+    writer.close()
+    return out.getvalue()
+
+
+def check_archive(data, files):
+    with zipfile.ZipFile(io.BytesIO(data)) as archive:
+        assert archive.testzip() is None
+        assert sorted(archive.namelist()) == sorted(files)
+        for name, content in files.items():
+            assert archive.read(name) == content
+
+
+@pytest.mark.parametrize('level', [0, 6])
+def test_round_trip_to_stream(app, folder, level):
+    folder_path, files = folder
+    check_archive(build_zip(app, folder_path, level), files)
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        check_archive(build_zip(app, folder_path, level, executor, 3), files)
+
+
+def test_zip64_offsets_and_sizes(app, folder, monkeypatch):
+    folder_path, files = folder
+    # 把写入位置从 5 GiB 开始计：所有条目的偏移和中央目录位置都超过 4 GiB，需要 ZIP64 字段和结束记录；
+    # 实际数据不含前面的 5 GiB，zipfile 会把整体偏移当作前置数据处理
+    data = build_zip(app, folder_path, 6, position=5 << 30)
+    assert b'PK\x06\x06' in data and b'PK\x06\x07' in data
+    check_archive(data, files)
+    # 条目本身按 ZIP64 写入（门限调小，代替真正超过 4 GiB 的文件）
+    monkeypatch.setattr(app, 'ZIP64_THRESHOLD', 1000)
+    check_archive(build_zip(app, folder_path, 6), files)
+    check_archive(build_zip(app, folder_path, 0), files)
+
+
+def test_more_than_65535_entries(app, tmp_path):
+    path = write_file(str(tmp_path / 'tiny.txt'), b'x')
+    file_stat = os.stat(path)
+    count = 0x10000 + 5
+    out = StreamOnly()
+    writer = app.ParallelZipWriter(out, 6)
+    writer.add_entries([app.ZipEntryState(path, 'f/{}.txt'.format(i), file_stat) for i in range(count)])
+    writer.close()
+    with zipfile.ZipFile(io.BytesIO(out.getvalue())) as archive:
+        names = archive.namelist()
+        assert len(names) == count
+        assert archive.read(names[-1]) == b'x'